@@ -0,0 +1,7 @@
+"""
+Benchmarking Tools (benchmark)
+
+This package generates synthetic inputs with the same schemas as the hospital extracts
+and times the preprocessing stages and the full pipeline on them, so the pipeline can
+be measured anywhere without the real data.
+"""
@@ -0,0 +1,146 @@
+"""
+Scaling benchmark for the preprocessing pipeline.
+
+For every scale, synthetic inputs are generated into a scratch directory holding a copy
+of config.json and reference/, then each stage's preprocess() is timed on its own
+(demographic first, since it writes the cohort) followed by the full main() with the
+stage cache disabled. Results are written as JSON together with the environment they
+were measured in, so runs on different machines or commits can be compared.
+
+Usage (from the repository root):
+    python -m benchmark.run --scales 1000 10000 100000 --events 20 --output benchmark_results.json
+"""
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmark.synthetic import generate, write_inputs
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGE_ORDER = ["demographic", "diagnosis", "drugs", "labs", "clinical", "merge"]
+
+
+def environment():
+    """Describe the machine and library versions the benchmark ran with."""
+    return {
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def _prepare_workdir(workdir):
+    """Copy config.json and the reference tables into a scratch directory."""
+    shutil.copy(os.path.join(REPO_ROOT, "config.json"), workdir)
+    shutil.copytree(os.path.join(REPO_ROOT, "reference"), os.path.join(workdir, "reference"))
+    for folder in ("input", "output", "logs"):
+        os.makedirs(os.path.join(workdir, folder), exist_ok=True)
+
+
+def _timed(function, repeat=1):
+    """Run `function` `repeat` times with stdout silenced and return the best wall time in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run_scale(n_patients, events_per_patient, seed=0, repeat=1, max_workers=None):
+    """
+    Generate inputs for one scale and time every stage and the full pipeline.
+
+    Must be called with the working directory set to a prepared scratch directory.
+
+    Args:
+    - n_patients (int): Number of patients to generate.
+    - events_per_patient (int): Average rows per patient in each event extract.
+    - seed (int): Random seed for the generator.
+    - repeat (int): Number of timed runs; the fastest is reported.
+    - max_workers (int, optional): Process pool size for main().
+
+    Returns:
+    - dict: Input row counts, per-stage seconds and pipeline seconds.
+    """
+    datasets = generate(n_patients, events_per_patient, seed=seed)
+    write_inputs(datasets)
+
+    # The preprocess modules read config.json from the working directory on import
+    modules = {name: importlib.import_module(f"preprocess.{name}") for name in STAGE_ORDER}
+    pipeline = importlib.import_module("main")
+
+    stages = {name: _timed(modules[name].preprocess, repeat) for name in STAGE_ORDER}
+    total = _timed(lambda: pipeline.main(max_workers=max_workers, use_cache=False), repeat)
+
+    return {
+        "patients": n_patients,
+        "events_per_patient": events_per_patient,
+        "input_rows": {name: len(df) for name, df in datasets.items()},
+        "stage_seconds": stages,
+        "pipeline_seconds": total,
+    }
+
+
+def run(scales, events_per_patient=20, seed=0, repeat=1, max_workers=None):
+    """
+    Run the benchmark at every scale in a scratch directory.
+
+    Args:
+    - scales (list): Patient counts to benchmark.
+    - events_per_patient (int): Average rows per patient in each event extract.
+    - seed (int): Random seed for the generator.
+    - repeat (int): Number of timed runs per measurement.
+    - max_workers (int, optional): Process pool size for main().
+
+    Returns:
+    - dict: Environment description and one result per scale.
+    """
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="pompe-benchmark-") as workdir:
+        _prepare_workdir(workdir)
+        os.chdir(workdir)
+        try:
+            for n_patients in scales:
+                result = run_scale(n_patients, events_per_patient, seed=seed, repeat=repeat, max_workers=max_workers)
+                print(f"{n_patients} patients: pipeline {result['pipeline_seconds']:.2f}s, "
+                      + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in result["stage_seconds"].items()))
+                results.append(result)
+        finally:
+            os.chdir(cwd)
+
+    return {"environment": environment(), "repeat": repeat, "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing pipeline on synthetic data.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000, 100000], help="Patient counts to benchmark.")
+    parser.add_argument("--events", type=int, default=20, help="Average events per patient in each event extract.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1, help="Timed runs per measurement; the fastest is kept.")
+    parser.add_argument("--workers", type=int, default=None, help="Process pool size for the full pipeline run.")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the JSON results.")
+    args = parser.parse_args()
+
+    report = run(args.scales, args.events, seed=args.seed, repeat=args.repeat, max_workers=args.workers)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
@@ -0,0 +1,197 @@
+"""
+Synthetic input generator.
+
+Produces the five raw extracts (demographic, diagnosis, drugs, labs, clinical) with the
+columns, value vocabularies and quirks the preprocessing modules expect:
+
+- dates formatted with the `date_format` of each dataset in config.json, padded with
+  trailing whitespace;
+- POMPE as YES/NO (plus UNKNOWN in diagnosis);
+- duplicated demographic rows and repeated (PERSONID, ENCNTRID, code) encounters;
+- junk EVENTDATETIME values containing "4557", null-like and non-numeric EVENTRESULTs,
+  and EVENTNAMEs with a trailing ".";
+- events for PERSONIDs outside the cohort.
+
+Usage:
+    python -m benchmark.synthetic --patients 10000 --events 20
+"""
+
+import argparse
+import json
+
+import numpy as np
+import pandas as pd
+
+from helper import write_data, resolve_paths, nationality_to_country
+
+DEFAULT_DATE_FORMAT = "%d/%b/%Y"
+DEFAULT_DATETIME_FORMAT = "%d/%b/%Y %H:%M:%S"
+FIRST_PERSONID = 60000000
+
+# Feature names that exist in more than one extract, as in the real data
+SHARED_LAB_EVENTS = ["ACTH", "ADAMTS13 ACTIVITY", "ALT", "ANDROSTENEDIONE", "SELENIUM"]
+SHARED_DRUGS = ["ACETAMINOPHEN", "ACETYLCYSTEINE", "ADENOSINE", "SELENIUM"]
+
+
+def _load_configs(config_path):
+    with open(config_path, 'r') as file:
+        return {config["name"]: config for config in json.load(file)["dataframes"]}
+
+
+def _date_strings(rng, n, start, days, date_format, pool_size=None):
+    """Draw `n` formatted dates from a pool of distinct values, as repeated timestamps are in the real extracts."""
+    pool_size = min(n, pool_size or max(1000, n // 10)) or 1
+    seconds = rng.integers(0, days * 86400, pool_size)
+    pool = (pd.Timestamp(start) + pd.to_timedelta(seconds, unit="s")).strftime(date_format)
+    pool = np.asarray(pool, dtype=object) + " "
+    return pool[rng.integers(0, pool_size, n)]
+
+
+def _event_person_ids(rng, person_ids, n, outside_share=0.02):
+    """Sample PERSONIDs for `n` events, a small share of them outside the cohort."""
+    ids = rng.choice(person_ids, n)
+    outside = rng.random(n) < outside_share
+    ids[outside] = rng.integers(1, FIRST_PERSONID, outside.sum())
+    return ids
+
+
+def generate(n_patients, events_per_patient=20, seed=0, config_path="config.json",
+             n_icd_codes=2000, n_drugs=1500, n_lab_catalogs=800, n_event_names=300):
+    """
+    Generate the five raw extracts.
+
+    Args:
+    - n_patients (int): Number of patients in the demographic extract.
+    - events_per_patient (int): Average number of rows per patient in each event extract.
+    - seed (int): Random seed.
+    - config_path (str): config.json to take the date formats from.
+    - n_icd_codes, n_drugs, n_lab_catalogs, n_event_names (int): Vocabulary sizes.
+
+    Returns:
+    - dict: Dataset name -> raw DataFrame.
+    """
+    rng = np.random.default_rng(seed)
+    configs = _load_configs(config_path)
+
+    def date_format(name, default):
+        return configs.get(name, {}).get("parameters", {}).get("date_format", default)
+
+    person_ids = FIRST_PERSONID + rng.choice(n_patients * 10, n_patients, replace=False)
+    pompe = rng.choice(np.array(["YES", "NO"], dtype=object), n_patients, p=[0.05, 0.95])
+    pompe_of = pd.Series(pompe, index=person_ids)
+    n_events = n_patients * events_per_patient
+
+    def event_pompe(ids):
+        return pompe_of.reindex(ids).fillna("NO").to_numpy()
+
+    # DEMOGRAPHIC
+    nationalities = np.array(list(nationality_to_country) + ["UNKNOWN NATIONALITY"], dtype=object)
+    demographic_format = date_format("demographic", DEFAULT_DATE_FORMAT)
+    dob = _date_strings(rng, n_patients, "1930-01-01", 365 * 93, demographic_format)
+    dob[rng.random(n_patients) < 0.001] = None
+    doe = _date_strings(rng, n_patients, "2015-01-01", 365 * 8, demographic_format)
+    doe[rng.random(n_patients) > 0.05] = None
+    demographic = pd.DataFrame({
+        "PERSONID": person_ids,
+        "GENDER": rng.choice(np.array(["Male", "Female", "Unknown"], dtype=object), n_patients, p=[0.49, 0.49, 0.02]),
+        "NATIONALITY": rng.choice(nationalities, n_patients),
+        "DOB": dob,
+        "DOE": doe,
+        "POMPE": pompe,
+    })
+    duplicates = demographic.sample(frac=0.01, random_state=seed)
+    demographic = pd.concat([demographic, duplicates], ignore_index=True)
+
+    # DIAGNOSIS
+    codes = np.array([f"{chr(65 + i % 26)}{i // 26 % 100:02d}.{i % 10}" for i in range(n_icd_codes)], dtype=object)
+    codes[0] = "E74.02"  # Pompe disease
+    n_diagnoses = max(1, n_events // 4)
+    diagnosis_ids = _event_person_ids(rng, person_ids, n_diagnoses)
+    code_index = np.minimum(rng.zipf(1.3, n_diagnoses) - 1, n_icd_codes - 1)
+    diagnosis = pd.DataFrame({
+        "PERSONID": diagnosis_ids,
+        "ENCNTRID": rng.integers(1, 10 ** 8, n_diagnoses),
+        "ICDCODE": codes[code_index],
+        "ICDDESCRIPTION": np.char.add("DESCRIPTION OF ", codes[code_index].astype(str)).astype(object),
+        "DIAGNOSISTYPE": rng.choice(np.array(["PRINCIPAL", "SECONDARY"], dtype=object), n_diagnoses),
+        "POMPE": event_pompe(diagnosis_ids),
+    })
+    diagnosis.loc[rng.random(n_diagnoses) < 0.01, "POMPE"] = "UNKNOWN"
+    diagnosis = pd.concat([diagnosis, diagnosis.sample(frac=0.1, random_state=seed)], ignore_index=True)
+
+    # DRUGS
+    drug_names = np.array(SHARED_DRUGS + [f"DRUG {i:05d}" for i in range(n_drugs - len(SHARED_DRUGS))], dtype=object)
+    drug_ids = _event_person_ids(rng, person_ids, n_events)
+    drug_index = np.minimum(rng.zipf(1.3, n_events) - 1, len(drug_names) - 1)
+    drugs = pd.DataFrame({
+        "PERSONID": drug_ids,
+        "ENCNTRID": rng.integers(1, 10 ** 8, n_events),
+        "ORDERMNEMONIC": drug_names[drug_index] + np.where(rng.random(n_events) < 0.1, " ", ""),
+        "ORDERDATE": _date_strings(rng, n_events, "2015-01-01", 365 * 8, date_format("drugs", DEFAULT_DATETIME_FORMAT)),
+        "POMPE": event_pompe(drug_ids),
+    })
+    drugs = pd.concat([drugs, drugs.sample(frac=0.1, random_state=seed)], ignore_index=True)
+
+    # LABS
+    catalogs = np.array(SHARED_LAB_EVENTS + [f"LAB {i:04d}" for i in range(n_lab_catalogs - len(SHARED_LAB_EVENTS))], dtype=object)
+    lab_ids = _event_person_ids(rng, person_ids, n_events)
+    labs = pd.DataFrame({
+        "PERSONID": lab_ids,
+        "ORDERCATALOG": catalogs[np.minimum(rng.zipf(1.2, n_events) - 1, len(catalogs) - 1)],
+        "RESULTVALUE": np.round(rng.lognormal(3, 1, n_events), 2).astype(str).astype(object),
+        "ORDERDATE": _date_strings(rng, n_events, "2015-01-01", 365 * 8, date_format("labs", DEFAULT_DATETIME_FORMAT)),
+        "POMPE": event_pompe(lab_ids),
+    })
+
+    # CLINICAL
+    event_names = np.array(SHARED_LAB_EVENTS + [f"EVENT {i:04d}" for i in range(n_event_names - len(SHARED_LAB_EVENTS))], dtype=object)
+    event_names = event_names + np.where(rng.random(len(event_names)) < 0.1, ".", "")
+    clinical_ids = _event_person_ids(rng, person_ids, n_events)
+    results = np.round(rng.normal(80, 20, n_events), 1).astype(str).astype(object)
+    junk = rng.random(n_events)
+    results[junk < 0.02] = "nan"
+    results[(junk >= 0.02) & (junk < 0.04)] = "None"
+    results[(junk >= 0.04) & (junk < 0.05)] = None
+    results[(junk >= 0.05) & (junk < 0.08)] = "POSITIVE"
+    results[(junk >= 0.08) & (junk < 0.10)] = np.char.add(results[(junk >= 0.08) & (junk < 0.10)].astype(str), " ").astype(object)
+    event_datetimes = _date_strings(rng, n_events, "2015-01-01", 365 * 8, date_format("clinical", DEFAULT_DATETIME_FORMAT))
+    event_datetimes[rng.random(n_events) < 0.001] = "01/Jan/4557 00:00:00 "
+    clinical = pd.DataFrame({
+        "PERSONID": clinical_ids,
+        "ORDERID": rng.integers(1, 10 ** 9, n_events),
+        "CLINICALEVENTID": rng.integers(1, 10 ** 9, n_events),
+        "TASKASSAY": rng.integers(1, 10 ** 6, n_events),
+        "EVENTNAME": event_names[np.minimum(rng.zipf(1.2, n_events) - 1, len(event_names) - 1)],
+        "EVENTRESULT": results,
+        "EVENTDATETIME": event_datetimes,
+        "POMPE": event_pompe(clinical_ids),
+    })
+
+    return {
+        "demographic": demographic,
+        "diagnosis": diagnosis,
+        "drugs": drugs,
+        "labs": labs,
+        "clinical": clinical,
+    }
+
+
+def write_inputs(datasets, config_path="config.json"):
+    """Write generated extracts to the source path, format and compression configured for each dataset."""
+    configs = _load_configs(config_path)
+    for name, df in datasets.items():
+        file_path, _ = resolve_paths(configs[name])
+        source = configs[name]["source"]
+        compression = source["compression"]["method"] if source["compression"]["enabled"] else None
+        kwargs = {"compression": compression} if source["format"] != "parquet" or compression else {}
+        write_data(df, file_path, source["format"], index=False, **kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic raw extracts.")
+    parser.add_argument("--patients", type=int, default=10000, help="Number of patients.")
+    parser.add_argument("--events", type=int, default=20, help="Average events per patient in each event extract.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--config", default="config.json", help="Config that defines the source paths and date formats.")
+    args = parser.parse_args()
+    write_inputs(generate(args.patients, args.events, seed=args.seed, config_path=args.config), config_path=args.config)
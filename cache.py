@@ -0,0 +1,179 @@
+"""
+Content-addressed cache of stage outputs.
+
+A stage's cache key is a hash of its config block and the pipeline's `partitioning`, the
+source code of its module, of helper.py and of the engine it selects (see engines), and the
+contents of every input file, including upstream artifacts such as the cohort index
+`cohort.npy`. After a stage runs, its output files are copied into
+`<cache path>/<stage>/<key>/` and recorded in `manifest.json`. When a later run computes
+the same key, the stored outputs are copied back instead of running the stage.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import time
+
+MANIFEST_NAME = "manifest.json"
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def load_manifest(cache_path):
+    """Load the cache manifest, or return an empty one."""
+    manifest_path = os.path.join(cache_path, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {"stages": {}, "files": {}}
+    with open(manifest_path, 'r') as file:
+        return json.load(file)
+
+
+def save_manifest(cache_path, manifest):
+    """Write the cache manifest atomically."""
+    os.makedirs(cache_path, exist_ok=True)
+    manifest_path = os.path.join(cache_path, MANIFEST_NAME)
+    with open(f"{manifest_path}.tmp", 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+def file_digest(path, manifest):
+    """
+    Return the sha256 of a file's contents.
+
+    Digests are remembered in the manifest by (size, mtime), so unchanged inputs are not
+    re-read on every run. A directory (e.g. a partitioned output) is digested as the
+    names and digests of the files it contains.
+    """
+    if os.path.isdir(path):
+        digest = hashlib.sha256()
+        for root, folders, files in os.walk(path):
+            folders.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                digest.update(f"{os.path.relpath(file_path, path)}:{file_digest(file_path, manifest)}".encode())
+        return digest.hexdigest()
+
+    stat = os.stat(path)
+    remembered = manifest["files"].get(path)
+    if remembered and remembered["size"] == stat.st_size and remembered["mtime_ns"] == stat.st_mtime_ns:
+        return remembered["sha256"]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    manifest["files"][path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+    return digest.hexdigest()
+
+
+def stage_key(name, module, manifest):
+    """
+    Compute the cache key of a stage.
+
+    Args:
+    - name (str): Stage name.
+    - module (module): Preprocessing module exposing CONFIG and stage_files().
+    - manifest (dict): Cache manifest, used to remember file digests.
+
+    Returns:
+    - str: Hex digest identifying this combination of config, code and inputs.
+    """
+    import helper
+    from engines import get_engine
+
+    inputs = {}
+    for path in module.stage_files()["inputs"]:
+        if path is None:
+            continue
+        inputs[path] = file_digest(path, manifest) if os.path.exists(path) else None
+
+    code = [module, helper]
+    if "engine" in module.CONFIG["parameters"]:
+        code.append(get_engine(module.CONFIG))
+    payload = {
+        "stage": name,
+        "config": module.CONFIG,
+        # The output layout of every stage also depends on the pipeline's partitioning
+        "partitioning": helper.load_pipeline_config().get("partitioning"),
+        "code": hashlib.sha256("".join(inspect.getsource(source) for source in code).encode()).hexdigest(),
+        "inputs": inputs,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _copy(source, destination):
+    """Copy a file or a directory tree, replacing whatever is at `destination`."""
+    if os.path.isdir(destination):
+        shutil.rmtree(destination)
+    if os.path.dirname(destination):
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+    if os.path.isdir(source):
+        shutil.copytree(source, destination)
+    else:
+        shutil.copy2(source, destination)
+
+
+def restore(cache_path, manifest, name, key):
+    """
+    Copy the cached outputs of `name` for `key` back to their destination paths.
+
+    Returns:
+    - bool: True on a cache hit, False if there is no usable entry.
+    """
+    entry = manifest["stages"].get(name, {}).get(key)
+    if entry is None:
+        return False
+
+    entry_path = os.path.join(cache_path, name, key)
+    stored = [os.path.join(entry_path, str(index)) for index in range(len(entry["outputs"]))]
+    if not all(os.path.exists(path) for path in stored):
+        # The entry was partially deleted by hand; forget it and rerun the stage
+        del manifest["stages"][name][key]
+        return False
+
+    for path, output in zip(stored, entry["outputs"]):
+        _copy(path, output)
+    entry["last_used"] = time.time()
+    return True
+
+
+def store(cache_path, manifest, name, key, outputs, max_entries=None):
+    """
+    Copy the outputs of a finished stage into the cache and record them in the manifest.
+
+    Args:
+    - cache_path (str): Root directory of the cache.
+    - manifest (dict): Cache manifest, updated in place.
+    - name (str): Stage name.
+    - key (str): Cache key from stage_key().
+    - outputs (list): Output paths of the stage; missing ones are skipped.
+    - max_entries (int, optional): Number of entries to keep per stage, see evict().
+    """
+    outputs = [path for path in outputs if os.path.exists(path)]
+    entry_path = os.path.join(cache_path, name, key)
+    if os.path.exists(entry_path):
+        shutil.rmtree(entry_path)
+    os.makedirs(entry_path)
+    for index, output in enumerate(outputs):
+        _copy(output, os.path.join(entry_path, str(index)))
+
+    now = time.time()
+    manifest["stages"].setdefault(name, {})[key] = {"outputs": outputs, "created": now, "last_used": now}
+    if max_entries:
+        evict(cache_path, manifest, name, max_entries)
+
+
+def invalidate(cache_path, manifest, name):
+    """Delete every entry of a stage, e.g. once its outputs were updated in place by a delta."""
+    evict(cache_path, manifest, name, 0)
+
+
+def evict(cache_path, manifest, name, max_entries):
+    """Delete all but the `max_entries` most recently used entries of a stage."""
+    entries = manifest["stages"].get(name, {})
+    stale = sorted(entries, key=lambda key: entries[key]["last_used"], reverse=True)[max_entries:]
+    for key in stale:
+        shutil.rmtree(os.path.join(cache_path, name, key), ignore_errors=True)
+        del entries[key]
@@ -0,0 +1,42 @@
+"""
+Execution Engines for the Stage Operations (engines)
+
+The cleaning and reduction rules of the event stages (labs, clinical, drugs) are written
+once against the functions of an engine module, and `parameters.engine` in config.json
+picks the module that runs them:
+
+- pandas_engine: eager pandas, the default. Every function runs immediately.
+- polars_engine: lazy Polars (optional dependency). The functions add to one query plan
+  per stage, which collect() optimizes and runs on all cores.
+
+Both modules expose scan, cast, drop, clean_columns, drop_missing, keep_numeric, keep_text,
+quarantine_dates, optimize_dtypes, latest_per_key and collect. collect() returns a pandas
+DataFrame, so the pivots, writers and statistics after it are the same for every engine.
+"""
+
+import importlib
+
+# Engine name -> module implementing it; modules are only imported when selected
+ENGINES = {
+    "pandas": "engines.pandas_engine",
+    "polars": "engines.polars_engine",
+}
+
+
+def get_engine(config):
+    """
+    Return the engine module selected by a stage's `parameters.engine` ("pandas" when absent).
+
+    Args:
+    - config (dict): The stage's config block.
+
+    Returns:
+    - module: pandas_engine or polars_engine.
+    """
+    name = config["parameters"].get("engine", "pandas")
+    if name not in ENGINES:
+        raise ValueError(f"Unsupported engine: {name}")
+    try:
+        return importlib.import_module(ENGINES[name])
+    except ModuleNotFoundError as e:
+        raise ImportError(f"The {name} engine needs {e.name}; install requirements/optional.txt") from e
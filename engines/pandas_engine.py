@@ -0,0 +1,70 @@
+"""
+Eager pandas engine, the default (see engines/__init__.py).
+
+Every function takes a DataFrame, runs right away with the helpers the stages share, and
+returns the result; some modify their input in place, as the stages always did.
+"""
+
+import numpy as np
+import pandas as pd
+import helper
+
+
+def scan(config, df=None, ids=None):
+    """Read the stage's source rows of the cohort (see helper.read_source)."""
+    return helper.read_source(config, df, ids=ids)
+
+
+def cast(df, dtype_conversion):
+    """Apply a `dtype_conversion` config block (see helper.apply_dtypes)."""
+    return helper.apply_dtypes(df, dtype_conversion)
+
+
+def drop(df, columns):
+    """Drop the given columns where present."""
+    df.drop(columns=columns, inplace=True, errors="ignore")
+    return df
+
+
+def clean_columns(df, rules):
+    """Strip, nullify and map the declared columns in one pass each (see helper.clean_columns)."""
+    return helper.clean_columns(df, rules)
+
+
+def drop_missing(df, column):
+    """Keep the rows where `column` is not missing."""
+    return df[df[column].notnull()].copy()
+
+
+def keep_numeric(df, column, dtype=None):
+    """Keep the rows where `column` parses as a number, with the parsed numbers as `dtype` when it is given."""
+    numeric = pd.to_numeric(df[column], errors='coerce').to_numpy(dtype="float64", na_value=np.nan)
+    if dtype is not None:
+        df[column] = numeric.astype(dtype)
+    return df[~np.isnan(numeric)].copy()
+
+
+def keep_text(df, column):
+    """Keep the rows where `column` is present but does not parse as a number."""
+    numeric = pd.to_numeric(df[column], errors='coerce').to_numpy(dtype="float64", na_value=np.nan)
+    return df[np.isnan(numeric) & df[column].notna().to_numpy()].copy()
+
+
+def quarantine_dates(df, column, date_format, report_path=None, append=False):
+    """Parse a date column and set aside unparseable rows (see helper.quarantine_dates)."""
+    return helper.quarantine_dates(df, column, date_format, report_path=report_path, append=append)
+
+
+def optimize_dtypes(df, config):
+    """Shrink the dtypes with the stage's `parameters.dtype_optimization` (see helper.apply_dtype_optimization)."""
+    return helper.apply_dtype_optimization(helper.as_object_strings(df), config)
+
+
+def latest_per_key(df, keys, order_by, keep="latest", ties="first"):
+    """Keep one row per key (see helper.latest_per_key)."""
+    return helper.latest_per_key(df, keys, order_by, keep=keep, ties=ties)
+
+
+def collect(df):
+    """Return the result; pandas has already computed it."""
+    return df
@@ -0,0 +1,231 @@
+"""
+Lazy Polars engine (see engines/__init__.py).
+
+scan() starts a LazyFrame and the other functions add to its query plan; nothing is
+computed until collect(). There Polars pushes the cohort filter and the column selection
+into the reader, evaluates the string and date expressions without intermediate copies
+and runs the plan on all cores. The result comes back as a pandas DataFrame.
+
+The functions follow the semantics of pandas_engine, so both engines produce the same
+outputs. Requires the optional polars package (pip install polars).
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import polars as pl
+import helper
+
+# Source formats read lazily; the others are read with pandas and handed over
+SCANNERS = {
+    "parquet": pl.scan_parquet,
+    "csv": lambda file_path: pl.scan_csv(file_path, infer_schema_length=None),
+    "feather": pl.scan_ipc,
+}
+
+# Row filter operators of helper.FILTER_OPERATORS as Polars expressions
+FILTER_EXPRESSIONS = {
+    "==": lambda column, value: column == value,
+    "=": lambda column, value: column == value,
+    "!=": lambda column, value: column != value,
+    "<": lambda column, value: column < value,
+    "<=": lambda column, value: column <= value,
+    ">": lambda column, value: column > value,
+    ">=": lambda column, value: column >= value,
+    "in": lambda column, value: column.is_in(value),
+    "not in": lambda column, value: ~column.is_in(value),
+}
+
+# dtype_conversion names -> Polars types
+DTYPES = {
+    "str": pl.String,
+    "int8": pl.Int8,
+    "int16": pl.Int16,
+    "int32": pl.Int32,
+    "int64": pl.Int64,
+    "float32": pl.Float32,
+    "float64": pl.Float64,
+    "bool": pl.Boolean,
+    "category": pl.Categorical,
+}
+
+# Range of pandas' datetime64[ns] in microseconds; dates outside it are unparseable in pandas
+NS_RANGE_US = (pd.Timestamp.min.value // 1000 + 1, pd.Timestamp.max.value // 1000)
+
+
+def scan(config, df=None, ids=None, id_column="PERSONID"):
+    """
+    Start the query plan of a stage from its source, with the source's filters, the cohort and its columns.
+
+    parquet, csv (uncompressed) and feather files are scanned lazily. Other formats and
+    partitioned directories are read with helper.read_data first.
+
+    Args:
+    - config (dict): The stage's config block.
+    - df (DataFrame, optional): Raw extract already in memory, used instead of the source file.
+    - ids (array-like, optional): Cohort ids to keep.
+    - id_column (str): Column matched against `ids`.
+
+    Returns:
+    - LazyFrame: The source rows of the cohort.
+    """
+    source = config["source"]
+    file_path, _ = helper.resolve_paths(config)
+    if df is not None:
+        frame = pl.from_pandas(df).lazy()
+    elif source["format"] in SCANNERS and not os.path.isdir(file_path) \
+            and not (source["format"] == "csv" and source["compression"]["enabled"]):
+        frame = SCANNERS[source["format"]](file_path)
+    else:
+        return pl.from_pandas(helper.read_source(config, ids=ids)).lazy()
+
+    for column, op, value in source.get("filters") or []:
+        if op not in FILTER_EXPRESSIONS:
+            raise ValueError(f"Unsupported filter operator: {op}")
+        frame = frame.filter(FILTER_EXPRESSIONS[op](pl.col(column), value))
+    if ids is not None:
+        frame = frame.filter(pl.col(id_column).is_in(pl.Series(np.asarray(ids))))
+    if source.get("columns") is not None:
+        frame = frame.select(source["columns"])
+    return frame
+
+
+def cast(df, dtype_conversion):
+    """Apply a `dtype_conversion` config block; the dtypes must be keys of DTYPES."""
+    return df.with_columns(pl.col(column).cast(DTYPES[dtype]) for column, dtype in dtype_conversion.items())
+
+
+def drop(df, columns):
+    """Drop the given columns where present."""
+    return df.drop(columns, strict=False)
+
+
+def clean_columns(df, rules):
+    """
+    Strip, nullify and map the declared columns, like helper.clean_columns.
+
+    Each column gets a single expression, so Polars cleans it in one pass. Only string
+    columns are stripped and nullified. A Polars column has a single type, so when a
+    mapping's new values have another type than the old ones, values that are not in the
+    mapping become missing (pandas would keep them).
+    """
+    schema = df.collect_schema()
+    expressions = []
+    for column, rule in rules.items():
+        if column not in schema:
+            continue
+        expression = pl.col(column)
+        strip = helper.strip_arguments(rule)
+        if strip is not None and schema[column] == pl.String:
+            chars, side = strip
+            strings = expression.str
+            expression = {"both": strings.strip_chars, "left": strings.strip_chars_start,
+                          "right": strings.strip_chars_end}[side](chars)
+        if rule.get("nulls") and schema[column] == pl.String:
+            expression = expression.replace(rule["nulls"], None)
+        mapping = rule.get("mapping")
+        if mapping:
+            if all(type(new) is type(old) for old, new in mapping.items()):
+                expression = expression.replace(mapping)
+            else:
+                expression = expression.replace_strict(mapping, default=None)
+        expressions.append(expression)
+    return df.with_columns(expressions)
+
+
+def drop_missing(df, column):
+    """Keep the rows where `column` is not missing."""
+    return df.filter(pl.col(column).is_not_null())
+
+
+def keep_numeric(df, column, dtype=None):
+    """
+    Keep the rows where `column` parses as a number (NaN does not count, as in pd.to_numeric).
+
+    With a `dtype` (a key of DTYPES), the parsed numbers replace the column.
+    """
+    numeric = pl.col(column).cast(pl.Float64, strict=False)
+    df = df.filter(numeric.is_not_null() & numeric.is_not_nan())
+    return df if dtype is None else df.with_columns(numeric.cast(DTYPES[dtype]))
+
+
+def keep_text(df, column):
+    """Keep the rows where `column` is present but does not parse as a number."""
+    numeric = pl.col(column).cast(pl.Float64, strict=False)
+    return df.filter(pl.col(column).is_not_null() & (numeric.is_null() | numeric.is_nan()))
+
+
+def quarantine_dates(df, column, date_format, report_path=None, append=False):
+    """
+    Parse a date column and set aside the rows whose value cannot be parsed, like helper.quarantine_dates.
+
+    Values are stripped and parsed with `date_format`; as in pandas, dates outside the
+    datetime64[ns] range count as unparseable. The report needs the rejected values now,
+    so it is computed right away by a query over the plan so far, which counts the rows
+    per distinct value and only parses those; the rows themselves are filtered lazily.
+
+    Args:
+    - df (LazyFrame): Data with a string column to parse.
+    - column, date_format, report_path, append: See helper.quarantine_dates.
+
+    Returns:
+    - LazyFrame: The rows with a parseable (or missing) date, with `column` parsed.
+    """
+    parsed = pl.col(column).str.strip_chars().str.to_datetime(date_format, time_unit="us", strict=False)
+    parsed = pl.when(parsed.dt.epoch("us").is_between(*NS_RANGE_US)).then(parsed).dt.cast_time_unit("ns")
+    invalid = parsed.is_null() & pl.col(column).is_not_null()
+
+    report = (df.group_by(column).agg(pl.len().alias("ROWS")).filter(invalid)
+              .sort("ROWS", descending=True).rename({column: "VALUE"}).collect().to_pandas())
+    helper.write_quarantine_report(report, column, report_path=report_path, append=append)
+    return df.filter(~invalid).with_columns(parsed.alias(column))
+
+
+def optimize_dtypes(df, config):
+    """
+    Leave the dtypes as they are.
+
+    Polars already keeps strings in Arrow buffers and the plan is collected once it is
+    reduced; the stage output is downcast with the pandas optimizer after the pivot.
+    """
+    return df
+
+
+def latest_per_key(df, keys, order_by, keep="latest", ties="first"):
+    """
+    Keep one row per key: the row with the latest (or earliest) value of `order_by`, like helper.latest_per_key.
+
+    Missing (and NaN) values of `order_by` rank below every real value, rows with a
+    missing key are dropped, and `ties` picks among equally ranked rows by their position.
+    Each group only looks up the position of its best row (arg_max/arg_min) instead of
+    the whole table being sorted. The result is ordered by key, with the key columns first.
+
+    Args:
+    - df (LazyFrame): Events.
+    - keys, order_by, keep, ties: See helper.latest_per_key.
+
+    Returns:
+    - LazyFrame: The kept rows.
+    """
+    if keep not in ("latest", "earliest"):
+        raise ValueError(f"Unsupported keep: {keep}")
+    if ties not in ("first", "last"):
+        raise ValueError(f"Unsupported ties: {ties}")
+
+    schema = df.collect_schema()
+    rank = pl.col(order_by).fill_nan(None) if schema[order_by].is_float() else pl.col(order_by)
+    values = [pl.col(column) for column in schema.names() if column not in keys]
+    if ties == "last":
+        # arg_max/arg_min return the first best position, so look from the end of the group
+        rank, values = rank.reverse(), [value.reverse() for value in values]
+    # Groups without any value of `order_by` keep their first (or last) row
+    best = (rank.arg_max() if keep == "latest" else rank.arg_min()).fill_null(0)
+    return (df.filter(pl.all_horizontal(pl.col(key).is_not_null() for key in keys))
+            .group_by(keys)
+            .agg(value.get(best) for value in values)
+            .sort(keys))
+
+
+def collect(df):
+    """Run the query plan on all cores and return the result as a pandas DataFrame."""
+    return df.collect().to_pandas()
@@ -1,41 +1,658 @@
+import copy
 import json
 import logging
 import os
+import shutil
+import numpy as np
 import pandas as pd
 
 FORMAT_READERS = {
     "pkl": pd.read_pickle,
     "csv": pd.read_csv,
     "parquet": pd.read_parquet,
+    "feather": pd.read_feather,
     # Add more mappings as needed
 }
 
+# Formats that read_data can stream in chunks
+STREAMING_FORMATS = ("csv", "parquet")
+
+# Row filter operators accepted by read_data (same names as pyarrow's DNF filters)
+FILTER_OPERATORS = {
+    "==": lambda series, value: series == value,
+    "=": lambda series, value: series == value,
+    "!=": lambda series, value: series != value,
+    "<": lambda series, value: series < value,
+    "<=": lambda series, value: series <= value,
+    ">": lambda series, value: series > value,
+    ">=": lambda series, value: series >= value,
+    "in": lambda series, value: series.isin(value),
+    "not in": lambda series, value: ~series.isin(value),
+}
+
 FORMAT_WRITERS = {
     "pkl": pd.DataFrame.to_pickle,
     "csv": pd.DataFrame.to_csv,
     "parquet": pd.DataFrame.to_parquet,
+    "feather": pd.DataFrame.to_feather,
     # Add more mappings as needed
 }
 
+# Formats written through pyarrow by write_columnar, which can read back a subset of columns
+COLUMNAR_FORMATS = ("parquet", "feather")
+
+# Manifest of a partitioned output directory, see write_partitioned
+PARTITION_MANIFEST = "_manifest.json"
+
+# Rows per chunk when a source is streamed without a configured chunksize
+DEFAULT_CHUNKSIZE = 1000000
+
+# Rough peak bytes per cell while pivoting one batch to wide rows: the object values,
+# the unstack buffers and mask, the reindex/merge copies and the Arrow conversion
+PIVOT_CELL_BYTES = 40
+
+# Parsed config.json files by absolute path, with the (size, mtime) they were parsed at
+_config_files = {}
+
+def _read_config_file(file_path='config.json'):
+    """Parse config.json once per process; it is read again only if the file changes."""
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    cached = _config_files.get(file_path)
+    if cached is None or cached[0] != (stat.st_size, stat.st_mtime_ns):
+        with open(file_path, 'r') as file:
+            cached = _config_files[file_path] = ((stat.st_size, stat.st_mtime_ns), json.load(file))
+    return cached[1]
+
 def load_config(dataframe_name):
-    with open('config.json', 'r') as file:
-        configs = json.load(file)["dataframes"]
-        for config in configs:
-            if config["name"] == dataframe_name:
-                return config
-        raise ValueError(f"No config found for dataframe: {dataframe_name}")
+    configs = _read_config_file()["dataframes"]
+    for config in configs:
+        if config["name"] == dataframe_name:
+            return copy.deepcopy(config)
+    raise ValueError(f"No config found for dataframe: {dataframe_name}")
+
+def load_pipeline_config():
+    """Return the optional top-level `pipeline` block of config.json (empty dict if absent)."""
+    return copy.deepcopy(_read_config_file().get("pipeline", {}))
     
-def read_data(file_path, file_format):
+def as_cohort(ids):
+    """Return `ids` as a sorted array of unique int64 ids (no copy if it already is one)."""
+    if isinstance(ids, np.ndarray) and ids.dtype == np.int64 and np.all(ids[1:] > ids[:-1]):
+        return ids
+    return np.unique(np.asarray(ids, dtype=np.int64))
+
+def write_cohort(ids, file_path, json_path=None):
+    """
+    Save the cohort as a sorted int64 .npy array that can be memory-mapped by every stage.
+
+    Args:
+    - ids (array-like): Cohort ids, e.g. the PERSONID column.
+    - file_path (str): Destination .npy path.
+    - json_path (str, optional): Also export the ids as a JSON list (the former unique_ids.json).
+    """
+    cohort = as_cohort(ids)
+    if not os.path.exists(os.path.dirname(file_path)):
+        os.makedirs(os.path.dirname(file_path))
+    np.save(file_path, cohort)
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(cohort.tolist(), f)
+
+def load_cohort(file_path, mmap=True):
+    """Load a cohort written by write_cohort, memory-mapped read-only by default."""
+    return np.load(file_path, mmap_mode='r' if mmap else None)
+
+def in_cohort(values, cohort):
+    """
+    Vectorized membership test against a sorted cohort array.
+
+    Uses a binary search per value instead of building a hash set of the cohort.
+
+    Args:
+    - values (array-like): Ids to test, e.g. a PERSONID column.
+    - cohort (ndarray): Sorted unique ids from as_cohort() or load_cohort().
+
+    Returns:
+    - ndarray: Boolean mask aligned with `values`.
+    """
+    values = np.asarray(values)
+    if len(cohort) == 0:
+        return np.zeros(len(values), dtype=bool)
+    positions = np.searchsorted(cohort, values)
+    positions[positions == len(cohort)] = 0
+    return np.asarray(cohort[positions] == values)
+
+def apply_filters(df, filters):
+    """Keep the rows of `df` matching every (column, operator, value) filter."""
+    for column, op, value in filters:
+        if op not in FILTER_OPERATORS:
+            raise ValueError(f"Unsupported filter operator: {op}")
+        df = df[FILTER_OPERATORS[op](df[column], value)]
+    return df
+
+def parquet_filter_expression(filters):
+    """Convert (column, operator, value) filters into a pyarrow dataset expression."""
+    import pyarrow.parquet as pq
+    return pq.filters_to_expression([tuple(f) for f in filters]) if filters else None
+
+def iter_chunks(file_path, file_format, chunksize, columns=None, filters=None, compression=None, arrow_strings=None):
+    """Yield DataFrames of at most `chunksize` rows from a csv or parquet file."""
+    if file_format == "csv":
+        dtype = {column: arrow_string_dtype() for column in arrow_strings or []}
+        for chunk in pd.read_csv(file_path, chunksize=chunksize, usecols=columns, compression=compression or "infer",
+                                 dtype=dtype or None):
+            yield apply_filters(chunk, filters or [])
+    elif file_format == "parquet":
+        import pyarrow.dataset as ds
+        dataset = ds.dataset(file_path, format="parquet")
+        for batch in dataset.to_batches(columns=columns, filter=parquet_filter_expression(filters), batch_size=chunksize):
+            yield table_to_pandas(batch, arrow_strings)
+    else:
+        raise ValueError(f"Streaming is not supported for file format: {file_format}")
+
+def read_data(file_path, file_format, ids=None, columns=None, filters=None, chunksize=None, id_column="PERSONID",
+              compression=None, arrow_strings=None, partitions=None):
+    """
+    Read a data file, optionally keeping only the cohort rows and the needed columns.
+
+    For parquet, the column list and the filters (including `id_column` in `ids`) are
+    pushed down to the reader, so unused columns are never decoded and row groups whose
+    statistics rule them out are skipped. When `chunksize` is set, csv files are read in
+    bounded chunks that are filtered before being concatenated, so peak memory follows
+    the size of the cohort rather than the size of the raw extract. Other formats (e.g.
+    pkl) are read whole and filtered afterwards.
+
+    A partitioned dataset (a directory from write_partitioned) is read one partition file
+    at a time, and only the partitions that can hold `ids` (or the listed `partitions`)
+    are opened. Rows come back grouped by partition.
+
+    Args:
+    - file_path (str): Path of the file to read.
+    - file_format (str): One of the keys of FORMAT_READERS.
+    - ids (array-like, optional): Values of `id_column` to keep, typically the cohort from load_cohort().
+    - columns (list, optional): Columns to keep.
+    - filters (list, optional): Row filters as [column, operator, value] triples, e.g.
+      ["POMPE", "in", ["YES", "NO"]]. Supported operators are the keys of FILTER_OPERATORS.
+    - chunksize (int, optional): Number of rows per chunk (or parquet batch) when streaming.
+    - id_column (str): Column matched against `ids`.
+    - compression (str, optional): Compression of pkl/csv files (inferred from the extension if omitted).
+    - arrow_strings (list, optional): Columns to load as Arrow-backed strings (see as_arrow_strings).
+      Parquet columns are handed over without conversion and csv columns are parsed straight
+      into Arrow, so these columns never exist as Python string objects.
+    - partitions (list, optional): Partition numbers to read from a partitioned dataset.
+
+    Returns:
+    - DataFrame: The (filtered) data.
+    """
     if file_format not in FORMAT_READERS:
         raise ValueError(f"Unsupported file format: {file_format}")
 
+    filters = list(filters or [])
+    if ids is not None:
+        ids = as_cohort(ids)
+
+    if os.path.isdir(file_path):
+        manifest = read_partition_manifest(file_path)
+        numbers = set(range(manifest["partitions"]) if partitions is None else partitions)
+        if ids is not None:
+            numbers &= set(np.unique(partition_of(ids, manifest)).tolist())
+        # Read at least one (possibly empty) file so the result has the dataset's columns
+        parts = [entry for entry in manifest["files"] if entry["partition"] in numbers] or manifest["files"][:1]
+        frames = [read_data(os.path.join(file_path, entry["path"]), file_format, ids=ids, columns=columns,
+                            filters=filters, chunksize=chunksize, id_column=id_column, arrow_strings=arrow_strings)
+                  for entry in parts]
+        return pd.concat(frames, ignore_index=True)
+
+    def keep_cohort(df):
+        return df if ids is None else df[in_cohort(df[id_column], ids)]
+
+    if file_format == "parquet":
+        import pyarrow.dataset as ds
+        if ids is not None:
+            filters.append((id_column, "in", ids))
+        dataset = ds.dataset(file_path, format="parquet")
+        scan_options = {"batch_size": chunksize} if chunksize else {}
+        table = dataset.to_table(columns=columns, filter=parquet_filter_expression(filters), **scan_options)
+        return table_to_pandas(table, arrow_strings)
+
+    if file_format == "feather":
+        import pyarrow.feather as feather
+        table = decode_dictionaries(feather.read_table(file_path, columns=columns))
+        return keep_cohort(apply_filters(table_to_pandas(table, arrow_strings), filters)).reset_index(drop=True)
+
+    if chunksize and file_format in STREAMING_FORMATS:
+        chunks = [keep_cohort(chunk) for chunk in iter_chunks(file_path, file_format, chunksize, columns=columns,
+                                                              filters=filters, compression=compression,
+                                                              arrow_strings=arrow_strings)]
+        if not chunks:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(chunks, ignore_index=True)
+
     read_func = FORMAT_READERS[file_format]
-    return read_func(file_path)
+    return filter_frame(read_func(file_path, compression=compression or "infer"), ids=ids, columns=columns,
+                        filters=filters, id_column=id_column, arrow_strings=arrow_strings)
+
+def filter_frame(df, ids=None, columns=None, filters=None, id_column="PERSONID", arrow_strings=None):
+    """
+    Apply the row and column selection of read_data to a DataFrame that is already in memory.
+
+    Args:
+    - df (DataFrame): Data, e.g. a raw extract passed to a stage by the caller.
+    - ids, columns, filters, id_column, arrow_strings: See read_data.
+
+    Returns:
+    - DataFrame: The selected rows and columns.
+    """
+    df = apply_filters(df, filters or [])
+    if ids is not None:
+        df = df[in_cohort(df[id_column], as_cohort(ids))]
+    if columns is not None:
+        df = df[columns]
+    return as_arrow_strings(df, arrow_strings) if arrow_strings else df
+
+def read_source(config, df=None, ids=None):
+    """
+    Read a stage's source extract with the columns, filters, chunk size and Arrow strings of its config.
+
+    Args:
+    - config (dict): The stage's config block.
+    - df (DataFrame, optional): Raw extract already in memory, used instead of the source file.
+      It is not modified; the stage works on a copy.
+    - ids (array-like, optional): Cohort ids to keep.
+
+    Returns:
+    - DataFrame: The source rows of the cohort.
+    """
+    source = config["source"]
+    if df is not None:
+        selected = filter_frame(df, ids=ids, columns=source.get("columns"), filters=source.get("filters"),
+                                arrow_strings=resolve_arrow_strings(config))
+        return selected.copy() if selected is df else selected
+
+    file_path, _ = resolve_paths(config)
+    return read_data(file_path, source["format"], ids=ids, columns=source.get("columns"), filters=source.get("filters"),
+                     chunksize=source.get("chunksize"), arrow_strings=resolve_arrow_strings(config))
+
+def iter_source(config, df=None, ids=None, id_column="PERSONID"):
+    """
+    Yield a stage's source rows of the cohort in chunks of at most `source.chunksize` rows.
+
+    csv and parquet sources are streamed with iter_chunks, so the whole extract is never
+    in memory. Other formats, and a DataFrame passed in, are read whole and sliced.
+
+    Args:
+    - config (dict): The stage's config block.
+    - df (DataFrame, optional): Raw extract already in memory, used instead of the source file.
+    - ids (array-like, optional): Cohort ids to keep.
+    - id_column (str): Column matched against `ids`.
+
+    Yields:
+    - DataFrame: A chunk of source rows, safe to modify.
+    """
+    source = config["source"]
+    chunksize = source.get("chunksize") or DEFAULT_CHUNKSIZE
+    if df is None and source["format"] in STREAMING_FORMATS:
+        file_path, _ = resolve_paths(config)
+        ids = as_cohort(ids) if ids is not None else None
+        for chunk in iter_chunks(file_path, source["format"], chunksize, columns=source.get("columns"),
+                                 filters=source.get("filters"), arrow_strings=resolve_arrow_strings(config)):
+            yield chunk if ids is None else chunk[in_cohort(chunk[id_column], ids)].reset_index(drop=True)
+        return
+
+    df = read_source(config, df, ids=ids)
+    for start in range(0, len(df), chunksize):
+        yield df.iloc[start:start + chunksize].reset_index(drop=True)
+
+def decode_dictionaries(table):
+    """Decode the dictionary-encoded columns of an Arrow table that were not categoricals in pandas (see write_columnar)."""
+    import pyarrow as pa
+    metadata = table.schema.pandas_metadata or {}
+    categorical = {column["name"] for column in metadata.get("columns", []) if column["pandas_type"] == "categorical"}
+    for position, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type) and field.name not in categorical:
+            column = table.column(position)
+            decoded = pa.chunked_array([chunk.dictionary_decode() for chunk in column.chunks], type=field.type.value_type)
+            table = table.set_column(position, field.name, decoded)
+    return table
+
+def arrow_string_dtype():
+    """The Arrow-backed string dtype, whose .str methods run as pyarrow compute kernels."""
+    import pyarrow as pa
+    return pd.ArrowDtype(pa.string())
+
+def table_to_pandas(table, arrow_strings=None):
+    """Convert a pyarrow Table or RecordBatch, wrapping the `arrow_strings` columns instead of converting them."""
+    import pyarrow as pa
+    arrow_columns = [column for column in arrow_strings or [] if column in table.schema.names]
+    if not arrow_columns:
+        return table.to_pandas()
+    df = table.select([column for column in table.schema.names if column not in arrow_columns]).to_pandas()
+    for column in arrow_columns:
+        df[column] = pd.arrays.ArrowExtensionArray(table.column(column).cast(pa.string()))
+    # Index columns stored by pandas (e.g. __index_level_0__) were restored as the index
+    return df[[column for column in table.schema.names if column in df.columns]]
+
+def as_arrow_strings(df, columns):
+    """Convert the given columns of `df` (where present) to Arrow-backed strings."""
+    return df.astype({column: arrow_string_dtype() for column in columns if column in df.columns})
+
+def as_object_strings(df):
+    """Convert Arrow-backed string columns back to object columns, with NaN for missing values."""
+    for column in df.columns:
+        if df[column].dtype == arrow_string_dtype():
+            df[column] = df[column].to_numpy(dtype=object, na_value=np.nan)
+    return df
+
+def apply_dtypes(df, dtype_conversion):
+    """
+    Apply a `dtype_conversion` config block with df.astype.
+
+    Columns that are already Arrow-backed strings satisfy a "str" conversion and are left
+    as they are, instead of being turned back into Python string objects.
+    """
+    dtype_conversion = {column: dtype for column, dtype in dtype_conversion.items()
+                        if not (dtype == "str" and column in df.columns and df[column].dtype == arrow_string_dtype())}
+    return df.astype(dtype_conversion)
+
+def strip_arguments(rule):
+    """Return the (chars, side) of a cleaning rule's "strip" (True, or {"chars": ..., "side": ...}), or None."""
+    strip = rule.get("strip")
+    if not strip:
+        return None
+    strip = {} if strip is True else strip
+    side = strip.get("side", "both")
+    if side not in ("both", "left", "right"):
+        raise ValueError(f"Unsupported strip side: {side}")
+    return strip.get("chars"), side
+
+def clean_values(values, rule):
+    """
+    Apply one cleaning rule to a Series: strip, then nulls, then mapping (see clean_columns).
+
+    Only string values are stripped; the other values are left as they are.
+    """
+    strip = strip_arguments(rule)
+    if strip is not None:
+        chars, side = strip
+        is_string = values.map(lambda value: isinstance(value, str)).astype(bool)
+        strings = values[is_string].str
+        values = values.mask(is_string, {"both": strings.strip, "left": strings.lstrip, "right": strings.rstrip}[side](chars))
+    if rule.get("nulls"):
+        values = values.where(~values.isin(rule["nulls"]))
+    if rule.get("mapping"):
+        values = values.replace(rule["mapping"])
+    return values
+
+def clean_columns(df, rules):
+    """
+    Apply the `parameters.cleaning` rules of a stage, one pass per declared column.
+
+    A rule can strip whitespace (or `chars`) from one or both sides of the values, turn
+    null tokens into missing values and map values to new ones, in that order, e.g.
+    {"EVENTNAME": {"strip": {"chars": ".", "side": "right"}, "nulls": ["nan", "None"]},
+     "POMPE": {"mapping": {"YES": 1, "NO": 0}}}.
+
+    As in parse_dates, each column is factorized once and the rules only run on its
+    distinct values, which are then broadcast back through the codes. Columns without a
+    rule are not touched.
+
+    Args:
+    - df (DataFrame): Data to clean, modified in place.
+    - rules (dict): Column -> rule; columns missing from `df` are skipped.
+
+    Returns:
+    - DataFrame: `df`, with the declared columns cleaned.
+    """
+    for column, rule in rules.items():
+        if column not in df.columns:
+            continue
+        codes, uniques = pd.factorize(df[column])
+        uniques = clean_values(pd.Series(np.asarray(uniques, dtype=object), dtype=object), rule)
+        # Append a missing slot so that missing values (code -1) stay missing
+        cleaned = pd.Series(np.append(uniques.to_numpy(dtype=object), np.nan)[codes], index=df.index,
+                            name=column).infer_objects()
+        if df[column].dtype == arrow_string_dtype() and not rule.get("mapping"):
+            cleaned = cleaned.astype(arrow_string_dtype())
+        df[column] = cleaned
+    return df
+
+def optimize_dtypes(df, overrides=None, max_unique_fraction=0.5, categories=True, exclude=()):
+    """
+    Shrink the dtypes of a DataFrame column by column.
+
+    Integer columns are downcast to the smallest signed integer type that holds their
+    range, float64 columns to float32 when every value survives the round trip, and
+    string columns (object or Arrow-backed) with at most `max_unique_fraction` distinct
+    values per row become categoricals with sorted categories. Columns listed in
+    `overrides` are cast to the given dtype instead of the inferred one.
+
+    Args:
+    - df (DataFrame): Data to shrink. Only the converted columns are replaced; the others
+      are not copied.
+    - overrides (dict, optional): Column -> dtype, applied with apply_dtypes.
+    - max_unique_fraction (float): Largest ratio of distinct values to rows for a categorical.
+    - categories (bool): Whether string columns may become categoricals at all.
+    - exclude (list): Columns to leave as they are.
+
+    Returns:
+    - tuple: (DataFrame, report) where the report has one row per converted column with
+      COLUMN, FROM, TO, BYTES_BEFORE and BYTES_AFTER.
+    """
+    overrides = {column: dtype for column, dtype in (overrides or {}).items() if column in df.columns}
+    dtypes = df.dtypes
+    before = {}
+
+    df = df.copy(deep=False)
+    for column in df.columns:
+        if column in exclude or column in overrides:
+            continue
+        series = df[column]
+        if isinstance(series.dtype, np.dtype) and series.dtype.kind in "iu":
+            dtype = _smallest_integer_dtype(series.to_numpy())
+            if dtype.itemsize >= series.dtype.itemsize:
+                continue
+            converted = series.astype(dtype)
+        elif series.dtype == np.float64:
+            values = series.to_numpy()
+            if not np.array_equal(values.astype(np.float32).astype(np.float64), values, equal_nan=True):
+                continue
+            converted = series.astype(np.float32)
+        elif categories and (series.dtype == object or series.dtype == arrow_string_dtype()):
+            if pd.api.types.infer_dtype(series, skipna=True) != "string":
+                continue
+            if series.nunique(dropna=True) > max_unique_fraction * len(series):
+                continue
+            converted = series.astype("category")
+        else:
+            continue
+        before[column] = series.memory_usage(deep=True, index=False)
+        df[column] = converted
+    for column in overrides:
+        before[column] = df[column].memory_usage(deep=True, index=False)
+    if overrides:
+        df = apply_dtypes(df, overrides)
+
+    changed = [column for column in before if df[column].dtype != dtypes[column]]
+    report = pd.DataFrame({
+        "COLUMN": changed,
+        "FROM": [str(dtypes[column]) for column in changed],
+        "TO": [str(df[column].dtype) for column in changed],
+        "BYTES_BEFORE": [int(before[column]) for column in changed],
+        "BYTES_AFTER": [int(df[column].memory_usage(deep=True, index=False)) for column in changed],
+    })
+    return df, report
 
-def write_data(data, file_path, file_format, **kwargs):
+def _smallest_integer_dtype(values):
+    """Smallest signed integer dtype that holds every value of an integer array."""
+    if len(values) == 0:
+        return np.dtype(np.int8)
+    low, high = values.min(), values.max()
+    for dtype in (np.int8, np.int16, np.int32):
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+def apply_dtype_optimization(df, config, categories=True):
+    """
+    Run optimize_dtypes with the stage's `parameters.dtype_optimization` block and log the savings.
+
+    The block holds "enabled", "max_unique_fraction", "exclude" and per-column
+    "overrides"; when it is missing or disabled `df` is returned unchanged.
+
+    Args:
+    - df (DataFrame): Data to shrink.
+    - config (dict): The stage's config block.
+    - categories (bool): See optimize_dtypes; stage outputs are only downcast.
+
+    Returns:
+    - DataFrame: The data with smaller dtypes.
+    """
+    settings = config["parameters"].get("dtype_optimization", {})
+    if not settings.get("enabled"):
+        return df
+
+    df, report = optimize_dtypes(df, overrides=settings.get("overrides"),
+                                 max_unique_fraction=settings.get("max_unique_fraction", 0.5),
+                                 categories=categories, exclude=settings.get("exclude", ()))
+    for row in report.itertuples(index=False):
+        logging.debug(f"{row.COLUMN}: {row.FROM} -> {row.TO}, saved {(row.BYTES_BEFORE - row.BYTES_AFTER) / (1 << 20):.2f} MB.")
+    if len(report):
+        saved = report["BYTES_BEFORE"].sum() - report["BYTES_AFTER"].sum()
+        largest = report.assign(SAVED=report["BYTES_BEFORE"] - report["BYTES_AFTER"]).nlargest(5, "SAVED")
+        logging.info(f"Optimized {len(report)} dtypes of {config['name']}, saved {saved / (1 << 20):.2f} MB "
+                     f"({', '.join(f'{row.COLUMN} {row.SAVED / (1 << 20):.2f} MB' for row in largest.itertuples())}).")
+    return df
+
+def remove_unused_categories(df):
+    """Drop the categories no row uses, so that pivots and crosstabs only create columns for observed values."""
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].cat.remove_unused_categories()
+    return df
+
+def parse_dates(values, date_format, errors="raise"):
+    """
+    Strip surrounding whitespace from date strings and parse them with `date_format`.
+
+    The column is factorized first and only its distinct values are stripped and parsed,
+    then the results are broadcast back through the codes, so the cost follows the
+    number of distinct timestamps rather than the number of rows. Works on object and
+    Arrow-backed string columns alike.
+
+    Args:
+    - values (Series): Date strings.
+    - date_format (str): strptime format, e.g. "%d/%b/%Y %H:%M:%S".
+    - errors (str): "raise" to raise a ValueError on an unparseable value (as
+      pd.to_datetime does), "coerce" to return NaT for it.
+
+    Returns:
+    - Series: datetime64[ns] dates aligned with `values`.
+    """
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Series(np.asarray(uniques, dtype=object)).str.strip()
+    parsed = pd.to_datetime(uniques, format=date_format, errors=errors).to_numpy(dtype="datetime64[ns]")
+    # Append a NaT slot so that missing values (code -1) stay missing
+    parsed = np.append(parsed, np.datetime64("NaT", "ns"))[codes]
+    return pd.Series(parsed, index=values.index, name=values.name)
+
+def parse_numeric(values, dtype="float32"):
+    """
+    Parse result values into numbers of `dtype`; values that are not numbers become NaN.
+
+    Args:
+    - values (Series): Results as strings or numbers.
+    - dtype (str): Float dtype of the result.
+
+    Returns:
+    - Series: The parsed values, aligned with `values`.
+    """
+    parsed = pd.to_numeric(values, errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+    return pd.Series(parsed.astype(dtype), index=values.index, name=values.name)
+
+def quarantine_dates(df, column, date_format, report_path=None, append=False):
+    """
+    Parse a date column and set aside the rows whose value cannot be parsed.
+
+    Rows with a non-missing value that does not match `date_format` (or lies outside the
+    datetime64[ns] range, like the "4557" placeholder years) are dropped instead of
+    failing the stage. Each distinct rejected value and its row count are logged and
+    written to `report_path`; the report is rewritten on every call, so it is empty
+    when nothing was rejected.
+
+    Args:
+    - df (DataFrame): Data with a string column to parse.
+    - column (str): Column to parse in place.
+    - date_format (str): strptime format of the column.
+    - report_path (str, optional): csv file for the quarantine report.
+    - append (bool): Add the counts to an existing report instead of replacing it, e.g.
+      when the data is cleaned one chunk at a time.
+
+    Returns:
+    - DataFrame: The rows with a parseable (or missing) date, with `column` parsed.
+    """
+    parsed = parse_dates(df[column], date_format, errors="coerce")
+    invalid = (parsed.isna() & df[column].notna()).to_numpy()
+
+    report = df.loc[invalid, column].value_counts().rename_axis("VALUE").reset_index(name="ROWS")
+    write_quarantine_report(report, column, report_path=report_path, append=append)
+
+    if invalid.any():
+        # A copy, so that the later steps assign into a frame of their own rather than a view
+        df, parsed = df[~invalid].copy(), parsed[~invalid]
+    df[column] = parsed
+    return df
+
+def write_quarantine_report(report, column, report_path=None, append=False):
+    """
+    Log the rows set aside by quarantine_dates and write its report.
+
+    Args:
+    - report (DataFrame): VALUE and ROWS: each rejected value of `column` and its row count.
+    - column (str): The parsed column.
+    - report_path (str, optional): csv file for the report.
+    - append (bool): See quarantine_dates.
+    """
+    rows = int(report["ROWS"].sum())
+    report.insert(0, "COLUMN", column)
+    if report_path:
+        if append and os.path.exists(report_path):
+            report = _sum_reports([read_report(report_path), report.astype({"VALUE": str})])
+        write_data(report, report_path, "csv", index=False)
+    if rows:
+        logging.warning(f"Quarantined {rows} rows with {len(report)} unparseable {column} values.")
+
+def read_report(report_path):
+    """Read a quarantine report written by quarantine_dates, keeping the values as written."""
+    return pd.read_csv(report_path, dtype={"COLUMN": str, "VALUE": str}, keep_default_na=False)
+
+def _sum_reports(reports):
+    return pd.concat(reports, ignore_index=True).groupby(["COLUMN", "VALUE"], sort=False, as_index=False)["ROWS"].sum()
+
+def write_data(data, file_path, file_format, options=None, partitioning=None, **kwargs):
+    """
+    Write a DataFrame in the given format.
+
+    Parquet and Feather files are written by write_columnar with the writer `options` of
+    the destination (see resolve_writer_options), or as a partitioned dataset in a
+    directory named `file_path` when `partitioning` is given (see write_partitioned).
+    Other formats go through pandas with `kwargs` (e.g. index, compression).
+    """
     if not os.path.exists(os.path.dirname(file_path)):
         os.makedirs(os.path.dirname(file_path))
 
+    if partitioning and file_format in COLUMNAR_FORMATS:
+        write_partitioned(data, file_path, file_format, partitioning, index=kwargs.get("index", False),
+                          compression=kwargs.get("compression"), options=options)
+        return
+    if os.path.isdir(file_path):
+        # A partitioned dataset written earlier under the same name
+        shutil.rmtree(file_path)
+
+    if file_format in COLUMNAR_FORMATS and isinstance(data, pd.DataFrame):
+        write_columnar(data, file_path, file_format, index=kwargs.get("index", False),
+                       compression=kwargs.get("compression"), options=options)
+        return
+
     if file_format == "pkl":
         # Remove 'index' argument for pickle format
         if 'index' in kwargs:
@@ -46,7 +663,716 @@ def write_data(data, file_path, file_format, **kwargs):
         writer_function(data, file_path, **kwargs)
     else:
         raise ValueError(f"Unsupported file format: {file_format}")
+
+def write_columnar(df, file_path, file_format, index=False, compression=None, options=None):
+    """
+    Write a DataFrame as parquet or Feather (Arrow IPC) through pyarrow.
+
+    The frame is converted to an Arrow table once (on several threads unless disabled) and
+    written with the codec, row-group size and dictionary encoding from `options`. Feather
+    compresses its record batches on Arrow's thread pool. Both formats keep the pandas
+    metadata, so dtypes such as categoricals survive a round trip, and both can be read
+    back one column subset at a time.
+
+    Args:
+    - df (DataFrame or pyarrow.Table): Data to write.
+    - file_path (str): Destination path.
+    - file_format (str): "parquet" or "feather".
+    - index (bool): Store the index as a column.
+    - compression (str, optional): Codec used when `options` does not name one.
+    - options (dict, optional): Writer options:
+      - "codec" (str): "zstd", "lz4", "snappy", "gzip" or "brotli" (parquet), "zstd" or "lz4" (feather);
+      - "compression_level" (int): Codec level, e.g. 1-22 for zstd;
+      - "row_group_size" (int): Rows per parquet row group or Feather record batch;
+      - "use_dictionary" (bool or list): Dictionary-encode all (or the listed) columns; for
+        Feather only string columns are encoded, and read_data decodes them again;
+      - "use_threads" (bool): Convert and compress on several threads (default True).
+    """
+    import pyarrow as pa
+
+    options = options or {}
+    codec = options.get("codec", compression)
+    level = options.get("compression_level")
+    use_threads = options.get("use_threads", True)
+    use_dictionary = options.get("use_dictionary", file_format == "parquet")
+
+    table = df if isinstance(df, pa.Table) else pa.Table.from_pandas(df, preserve_index=bool(index),
+                                                                     nthreads=None if use_threads else 1)
+
+    if file_format == "parquet":
+        import pyarrow.parquet as pq
+        pq.write_table(table, file_path, compression=codec or "none", compression_level=level,
+                       row_group_size=options.get("row_group_size"), use_dictionary=use_dictionary)
+        return
+
+    if use_dictionary:
+        encode = set(use_dictionary) if isinstance(use_dictionary, list) else set(table.column_names)
+        for position, field in enumerate(table.schema):
+            if field.name in encode and pa.types.is_string(field.type):
+                table = table.set_column(position, field.name, table.column(position).dictionary_encode())
+
+    write_options = pa.ipc.IpcWriteOptions(compression=pa.Codec(codec, level) if codec else None, use_threads=use_threads)
+    with pa.OSFile(file_path, "wb") as sink, pa.ipc.new_file(sink, table.schema, options=write_options) as writer:
+        writer.write_table(table, max_chunksize=options.get("row_group_size"))
     
+def range_boundaries(ids, partitions):
+    """Split sorted unique ids (e.g. the cohort) into `partitions` ranges of equal size and return the lower bounds of ranges 1..n-1."""
+    ids = as_cohort(ids)
+    if len(ids) == 0:
+        return []
+    positions = (np.arange(1, partitions) * len(ids)) // partitions
+    return np.unique(ids[positions]).tolist()
+
+def partition_of(ids, partitioning):
+    """
+    Partition number of each id.
+
+    "hash" partitioning uses pandas' stable 64-bit hash of the id, so the assignment does
+    not depend on which ids a dataset happens to contain. "range" partitioning looks the
+    id up in the `boundaries` of the partitioning (see range_boundaries).
+
+    Args:
+    - ids (array-like): Integer ids, e.g. a PERSONID column.
+    - partitioning (dict): "method", "partitions" and, for ranges, "boundaries".
+
+    Returns:
+    - ndarray: Partition numbers in [0, partitions).
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    if partitioning.get("method", "hash") == "range":
+        return np.searchsorted(np.asarray(partitioning["boundaries"], dtype=np.int64), ids, side="right")
+    return (pd.util.hash_array(ids, categorize=False) % np.uint64(partitioning["partitions"])).astype(np.int64)
+
+def write_partitioned(df, directory, file_format, partitioning, index=False, compression=None, options=None):
+    """
+    Write a DataFrame as one file per partition of its id column, plus a manifest.
+
+    Every partition gets a `part-<n>.<format>` file, empty or not, so the same partition
+    number of any two datasets written with the same partitioning holds the same ids and
+    can be joined on its own. Rows keep their order within a partition. The manifest
+    (`_manifest.json`) records the partitioning and the rows and id range of each file.
+
+    Args:
+    - df (DataFrame): Data to write.
+    - directory (str): Destination directory; replaced if it exists.
+    - file_format (str): "parquet" or "feather".
+    - partitioning (dict): "column" (default PERSONID), "method" ("hash" or "range"),
+      "partitions" and, for ranges, "boundaries".
+    - index, compression, options: See write_columnar.
+    """
+    column = partitioning.get("column", "PERSONID")
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    elif os.path.exists(directory):
+        os.remove(directory)
+    os.makedirs(directory)
+
+    import pyarrow as pa
+
+    codes = partition_of(df[column], partitioning)
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(partitioning["partitions"] + 1))
+    ids = df[column].to_numpy()[order]
+
+    # Convert once and slice, so that every file has the same schema (even where a column is all missing)
+    use_threads = (options or {}).get("use_threads", True)
+    table = pa.Table.from_pandas(df.iloc[order].reset_index(drop=not index), preserve_index=False,
+                                 nthreads=None if use_threads else 1)
+
+    files = []
+    for number in range(partitioning["partitions"]):
+        start, end = bounds[number], bounds[number + 1]
+        name = f"part-{number:05d}.{file_format}"
+        write_columnar(table.slice(start, end - start), os.path.join(directory, name), file_format,
+                       compression=compression, options=options)
+        files.append({"partition": number, "path": name, "rows": int(end - start),
+                      "min": int(ids[start:end].min()) if end > start else None,
+                      "max": int(ids[start:end].max()) if end > start else None})
+
+    manifest = {key: partitioning[key] for key in ("method", "partitions", "boundaries") if key in partitioning}
+    manifest.update({"column": column, "format": file_format, "files": files})
+    with open(os.path.join(directory, PARTITION_MANIFEST), 'w') as file:
+        json.dump(manifest, file, indent=2)
+
+def read_partition_manifest(directory):
+    """Load the manifest of a dataset written by write_partitioned."""
+    with open(os.path.join(directory, PARTITION_MANIFEST), 'r') as file:
+        return json.load(file)
+
+def write_batched_pivot(config, chunks, clean, reduce, transform, key_column, cohort, id_column="PERSONID"):
+    """
+    Pivot a stage's events to one row per id within a memory budget, one batch of ids at a time.
+
+    First every chunk of raw events is cleaned and reduced on its own and spilled to a
+    scratch parquet file, while the distinct values of `key_column` are collected as the
+    column vocabulary. `reduce` must give the same rows when it is applied again to the
+    concatenated reduced chunks, as latest_per_key does. From the spilled size and the
+    vocabulary the ids are split into batches whose pivot fits in
+    `parameters.batched_pivot.memory_budget_mb`: the partitions of `pipeline.partitioning`
+    when it is enabled (each split further if needed), else ranges of the cohort. Each
+    batch is read back, reduced, transformed, given every vocabulary column in sorted
+    order and written as one file of a partitioned dataset (see write_partitioned) with
+    the same schema as the others. Only one batch is ever pivoted in memory.
+
+    Args:
+    - config (dict): The stage's config block.
+    - chunks (iterable): DataFrames of raw events, e.g. from iter_source.
+    - clean (callable): Called as clean(chunk, append_report=...) so that per-chunk reports accumulate.
+    - reduce (callable): Cleaned events -> one row per key, e.g. the latest value per (id, item).
+    - transform (callable): Reduced events -> wide rows with `id_column`, the pivoted items and the label.
+    - key_column (str): Column whose values become the pivoted columns, e.g. ORDERCATALOG.
+    - cohort (array-like): Cohort ids, used to split the batches.
+    - id_column (str): Row key.
+
+    Returns:
+    - DataFrame: Column statistics of the whole output (see column_statistics), summed over the batches.
+    """
+    import math
+    import tempfile
+    import pyarrow as pa
+
+    destination = config["destination"]
+    file_format = destination["format"]
+    compression = destination["compression"]["method"] if destination["compression"]["enabled"] else None
+    options = resolve_writer_options(config)
+    _, save_path = resolve_paths(config)
+    settings = config["parameters"].get("batched_pivot", {})
+    budget = settings.get("memory_budget_mb", 1024) * (1 << 20)
+    cohort = as_cohort(cohort)
+
+    os.makedirs(destination["path"], exist_ok=True)
+    spill_directory = tempfile.mkdtemp(prefix=f".{config['name']}-spill-", dir=settings.get("spill_path", destination["path"]))
+    try:
+        # SPILL REDUCED CHUNKS
+        spill_files, vocabulary, spilled_bytes = [], set(), 0
+        for number, chunk in enumerate(chunks):
+            reduced = reduce(clean(chunk, append_report=number > 0))
+            if reduced.empty:
+                continue
+            vocabulary.update(np.asarray(reduced[key_column].dropna().unique(), dtype=object).tolist())
+            spilled_bytes += int(reduced.memory_usage(deep=True).sum())
+            spill_files.append(os.path.join(spill_directory, f"chunk-{number:05d}.parquet"))
+            write_columnar(reduced, spill_files[-1], "parquet", options=options)
+        vocabulary = sorted(vocabulary)
+
+        # SPLIT THE IDS INTO BATCHES
+        estimate = spilled_bytes + len(cohort) * (len(vocabulary) + 2) * PIVOT_CELL_BYTES
+        needed = max(1, math.ceil(estimate / budget))
+        partitioning = resolve_partitioning(config)
+        if partitioning is None:
+            partitioning = {"method": "range", "partitions": needed, "boundaries": range_boundaries(cohort, needed)}
+        partitioning["column"] = id_column
+        splits = math.ceil(needed / partitioning["partitions"])
+        codes = partition_of(cohort, partitioning)
+        batches = [(number, ids) for number in range(partitioning["partitions"])
+                   for ids in np.array_split(cohort[codes == number], splits)]
+        logging.info(f"Pivoting {len(cohort)} ids x {len(vocabulary)} columns (~{estimate / (1 << 20):.0f} MB) "
+                     f"in {len(batches)} batches of {budget / (1 << 20):.0f} MB.")
+
+        # PIVOT AND WRITE EACH BATCH
+        if os.path.isdir(save_path):
+            shutil.rmtree(save_path)
+        elif os.path.exists(save_path):
+            os.remove(save_path)
+        os.makedirs(save_path)
+
+        schema, stats, files, pending = None, None, [], []
+        for number, ids in batches:
+            name = f"part-{number:05d}.{file_format}" if splits == 1 else f"part-{number:05d}-{len(files):05d}.{file_format}"
+            # The reduced chunks are sorted by id, so the range filter skips most of their row groups
+            bounds = [(id_column, ">=", int(ids[0])), (id_column, "<=", int(ids[-1]))] if len(ids) else []
+            rows = [read_data(path, "parquet", ids=ids, filters=bounds) for path in spill_files] if len(ids) else []
+            rows = pd.concat(rows, ignore_index=True) if rows else pd.DataFrame()
+            if rows.empty:
+                files.append({"partition": number, "path": name, "rows": 0, "min": None, "max": None})
+                pending.append(name)
+                continue
+
+            wide = transform(reduce(rows))
+            del rows
+            wide = wide.reindex(columns=[id_column, *vocabulary, *(column for column in wide.columns
+                                                                   if column != id_column and column not in vocabulary)])
+            batch_stats = column_statistics(wide)
+            stats = batch_stats if stats is None else stats.add(batch_stats, fill_value=0).astype("int64")
+
+            table = pa.Table.from_pandas(wide, preserve_index=False)
+            if schema is None:
+                # Every batch gets the first one's types; all-missing items (including the ones added
+                # by the reindex) take the type of the present ones
+                missing = {field.name for field, column in zip(table.schema, table.columns)
+                           if column.null_count == len(column)}
+                value_type = next((field.type for field in table.schema
+                                   if field.name in vocabulary and field.name not in missing), pa.string())
+                # The ids keep the (downcast) type of the first batch, widened to hold every id of the cohort
+                id_type = pa.from_numpy_dtype(np.promote_types(wide[id_column].dtype, _smallest_integer_dtype(cohort)))
+                schema = pa.schema([field.with_type(id_type) if field.name == id_column else
+                                    field.with_type(value_type) if field.name in missing else field
+                                    for field in table.schema], metadata=table.schema.metadata)
+            write_columnar(table.cast(schema), os.path.join(save_path, name), file_format,
+                           compression=compression, options=options)
+            files.append({"partition": number, "path": name, "rows": len(wide),
+                          "min": int(wide[id_column].min()), "max": int(wide[id_column].max())})
+            del wide, table
+
+        if schema is None:
+            schema = pa.schema([pa.field(id_column, pa.from_numpy_dtype(_smallest_integer_dtype(cohort))),
+                                *(pa.field(column, pa.string()) for column in vocabulary)])
+            stats = column_statistics(pd.DataFrame(columns=[id_column, *vocabulary]))
+        for name in pending:
+            write_columnar(schema.empty_table(), os.path.join(save_path, name), file_format,
+                           compression=compression, options=options)
+
+        manifest = {key: partitioning[key] for key in ("method", "partitions", "boundaries") if key in partitioning}
+        manifest.update({"column": id_column, "format": file_format, "files": files})
+        with open(os.path.join(save_path, PARTITION_MANIFEST), 'w') as file:
+            json.dump(manifest, file, indent=2)
+    finally:
+        shutil.rmtree(spill_directory, ignore_errors=True)
+    return stats
+
+def run_sharded(df, process, sharding, id_column="PERSONID", report_path=None):
+    """
+    Run a stage's per-id logic on hash shards of its input in a process pool.
+
+    The rows are split by the hash of `id_column` (see partition_of), so all rows of an id
+    land in the same shard and keep their order, and `process(shard, report_path)` runs on
+    every shard in its own process. The results are stacked with concat_frames. Each shard
+    writes its quarantine report next to `report_path`; the reports are summed into
+    `report_path` afterwards.
+
+    Args:
+    - df (DataFrame): The stage's raw events.
+    - process (callable): Module-level function, raw events of some ids -> rows of those ids
+      (e.g. the latest value per key), which are cheaper to send back than wide rows.
+    - sharding (dict): "shards" and optionally "max_workers" (default: one per shard, up to the CPU count).
+    - id_column (str): Column to shard on.
+    - report_path (str, optional): The stage's quarantine report.
+
+    Returns:
+    - DataFrame: The rows returned for every shard.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if df.empty:
+        return process(df, report_path)
+    shards = sharding.get("shards") or os.cpu_count() or 1
+    codes = partition_of(df[id_column], {"method": "hash", "partitions": shards})
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(shards + 1))
+    report_paths = [f"{report_path}.shard-{number}" if report_path else None for number in range(shards)]
+
+    max_workers = sharding.get("max_workers") or min(shards, os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(process, df.iloc[order[bounds[number]:bounds[number + 1]]].reset_index(drop=True),
+                               report_paths[number])
+                   for number in range(shards) if bounds[number + 1] > bounds[number]]
+        results = [future.result() for future in futures]
+
+    if report_path:
+        reports = [read_report(path) for path in report_paths if os.path.exists(path)]
+        write_data(_sum_reports(reports), report_path, "csv", index=False)
+        for path in report_paths:
+            if os.path.exists(path):
+                os.remove(path)
+    return concat_frames(results)
+
+def concat_frames(frames):
+    """
+    Stack DataFrames with the same columns, keeping the columns that are categorical in all of them categorical.
+
+    pd.concat turns categoricals with different categories into objects, so those columns
+    are first given the sorted union of the categories.
+    """
+    frames = list(frames)
+    for column in frames[0].columns:
+        if all(isinstance(frame[column].dtype, pd.CategoricalDtype) for frame in frames):
+            categories = frames[0][column].cat.categories
+            for frame in frames[1:]:
+                categories = categories.union(frame[column].cat.categories)
+            frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)}) for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+def build_indicator_matrix(rows, columns, binary=True):
+    """
+    Build a sparse PERSONID x code matrix directly from factorized keys.
+
+    This is the sparse counterpart of `pd.crosstab(rows, columns)`: rows and columns
+    come out in the same sorted order, but no dense matrix is ever materialized.
+
+    Args:
+    - rows (Series): Row keys, e.g. PERSONID.
+    - columns (Series): Column keys, e.g. ICDCODE.
+    - binary (bool): Store 1 for every present pair instead of the occurrence count.
+
+    Returns:
+    - dict: CSR arrays ("data", "indices", "indptr", "shape") and the "rows"/"columns" vocabularies.
+    """
+    row_codes, row_vocab = pd.factorize(rows, sort=True)
+    column_codes, column_vocab = pd.factorize(columns, sort=True)
+    n_rows, n_columns = len(row_vocab), len(column_vocab)
+
+    # Unique (row, column) pairs come out sorted by row then column, i.e. in CSR order
+    keys = row_codes.astype(np.int64) * n_columns + column_codes
+    keys, counts = np.unique(keys, return_counts=True)
+    row_index, column_index = np.divmod(keys, n_columns)
+
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row_index, minlength=n_rows), out=indptr[1:])
+
+    if binary:
+        data = np.ones(len(keys), dtype=np.int8)
+    else:
+        data = counts.astype(np.min_scalar_type(counts.max() if len(counts) else 0))
+
+    return {
+        "data": data,
+        "indices": column_index.astype(np.min_scalar_type(max(n_columns - 1, 0))),
+        "indptr": indptr,
+        "shape": np.array([n_rows, n_columns]),
+        "rows": np.asarray(row_vocab),
+        "columns": np.asarray(column_vocab).astype(str),
+    }
+
+def crosstab_counts(rows, columns):
+    """
+    Dense counterpart of build_indicator_matrix: `pd.crosstab(rows, columns)` in the smallest integer dtype.
+
+    The counts of the distinct (row, column) pairs are scattered into one preallocated
+    array sized by the largest count, instead of building crosstab's int64 table (which
+    also spans every category of a categorical column). Pairs with a missing key are
+    dropped, like in pd.crosstab.
+
+    Args:
+    - rows (Series): Row keys, e.g. PERSONID.
+    - columns (Series): Column keys, e.g. ICDCODE.
+
+    Returns:
+    - DataFrame: Counts indexed by the sorted distinct rows, one column per sorted distinct column key.
+    """
+    present = (rows.notna() & columns.notna()).to_numpy()
+    if not present.all():
+        rows, columns = rows[present], columns[present]
+    matrix = build_indicator_matrix(rows, columns, binary=False)
+    n_rows, n_columns = matrix["shape"]
+
+    counts = np.zeros((n_rows, n_columns), dtype=matrix["data"].dtype)
+    counts[np.repeat(np.arange(n_rows), np.diff(matrix["indptr"])), matrix["indices"]] = matrix["data"]
+    return pd.DataFrame(counts, index=pd.Index(matrix["rows"], name=rows.name),
+                        columns=pd.Index(matrix["columns"], name=columns.name))
+
+def write_sparse(matrix, file_path, labels=None, id_column="PERSONID"):
+    """
+    Save a matrix from `build_indicator_matrix` with its vocabularies as a compressed npz.
+
+    Args:
+    - matrix (dict): Output of `build_indicator_matrix`.
+    - file_path (str): Destination path (.npz).
+    - labels (DataFrame, optional): Numeric per-row columns (e.g. POMPE) indexed by the row key.
+    - id_column (str): Name given to the row vocabulary when loading.
+    """
+    if not os.path.exists(os.path.dirname(file_path)):
+        os.makedirs(os.path.dirname(file_path))
+
+    arrays = dict(matrix, id_column=np.array(id_column))
+    if labels is not None:
+        labels = labels.reindex(matrix["rows"])
+        for name in labels.columns:
+            arrays[f"label:{name}"] = pd.to_numeric(labels[name]).to_numpy(dtype=np.float32)
+
+    with open(file_path, "wb") as file:
+        np.savez_compressed(file, **arrays)
+
+def read_sparse(file_path, as_frame=True):
+    """
+    Load a matrix saved by `write_sparse`.
+
+    Args:
+    - file_path (str): Path of the .npz file.
+    - as_frame (bool): Return a DataFrame with sparse feature columns (same layout as the
+      dense output) instead of the raw CSR matrix.
+
+    Returns:
+    - DataFrame, or tuple: (scipy.sparse.csr_matrix, rows, columns, labels dict) when `as_frame` is False.
+    """
+    from scipy import sparse
+
+    with np.load(file_path, allow_pickle=False) as file:
+        csr = sparse.csr_matrix((file["data"], file["indices"], file["indptr"]), shape=tuple(file["shape"]))
+        rows, columns, id_column = file["rows"], file["columns"], str(file["id_column"])
+        labels = {key.split(":", 1)[1]: file[key] for key in file.files if key.startswith("label:")}
+
+    if not as_frame:
+        return csr, rows, columns, labels
+    return _sparse_frame(csr, rows, columns, labels, id_column)
+
+def indicator_frame(matrix, labels=None, id_column="PERSONID"):
+    """
+    In-memory counterpart of write_sparse followed by read_sparse.
+
+    Args:
+    - matrix (dict): Output of `build_indicator_matrix`.
+    - labels (DataFrame, optional): Numeric per-row columns (e.g. POMPE) indexed by the row key.
+    - id_column (str): Name of the row key column.
+
+    Returns:
+    - DataFrame: Sparse feature columns and the label columns, as returned by read_sparse.
+    """
+    from scipy import sparse
+
+    csr = sparse.csr_matrix((matrix["data"], matrix["indices"], matrix["indptr"]), shape=tuple(matrix["shape"]))
+    label_arrays = {}
+    if labels is not None:
+        labels = labels.reindex(matrix["rows"])
+        label_arrays = {name: pd.to_numeric(labels[name]).to_numpy(dtype=np.float32) for name in labels.columns}
+    return _sparse_frame(csr, matrix["rows"], matrix["columns"], label_arrays, id_column)
+
+def _sparse_frame(csr, rows, columns, labels, id_column):
+    df = pd.DataFrame.sparse.from_spmatrix(csr, index=pd.Index(rows, name=id_column), columns=columns)
+    for name, values in labels.items():
+        df[name] = values
+    return df.reset_index()
+
+def latest_per_key(df, keys, order_by, keep="latest", ties="first"):
+    """
+    Keep one row per key: the row with the latest (or earliest) value of `order_by`.
+
+    Instead of sorting the whole table, each row gets a group code and the best value
+    per group is found with unbuffered ufunc reductions, so the cost grows linearly with
+    the number of rows (plus sorting the distinct keys). Missing `order_by` values rank
+    below every real value. The result has one row per distinct key, ordered by key,
+    with the key columns first.
+
+    Args:
+    - df (DataFrame): Events.
+    - keys (list): Columns identifying an entity/feature pair, e.g. ["PERSONID", "EVENTNAME"].
+    - order_by (str): Datetime or numeric column to rank the rows of a key by.
+    - keep (str): "latest" keeps the row with the highest value, "earliest" the lowest.
+    - ties (str): "first" or "last": which of several equally ranked rows to keep, by
+      their position in `df`.
+
+    Returns:
+    - DataFrame: The kept rows with a fresh index.
+    """
+    if keep not in ("latest", "earliest"):
+        raise ValueError(f"Unsupported keep: {keep}")
+    if ties not in ("first", "last"):
+        raise ValueError(f"Unsupported ties: {ties}")
+
+    codes = df.groupby(keys, sort=True, observed=True).ngroup().to_numpy()
+    valid = codes >= 0  # rows with a missing key belong to no group
+    n_groups = codes.max() + 1 if len(codes) else 0
+
+    # Rank as int64 (datetimes) or float64, larger is better and missing is lowest
+    order = df[order_by]
+    if pd.api.types.is_datetime64_any_dtype(order):
+        rank = order.to_numpy(dtype="datetime64[ns]").view("int64")
+        missing, lowest = order.isna().to_numpy(), np.iinfo(np.int64).min
+    else:
+        rank = order.to_numpy(dtype="float64", na_value=np.nan)
+        missing, lowest = np.isnan(rank), -np.inf
+    if keep == "earliest":
+        rank = -rank
+    rank = np.where(missing, lowest, rank)
+
+    best = np.full(n_groups, lowest, dtype=rank.dtype)
+    np.maximum.at(best, codes[valid], rank[valid])
+    candidates = np.flatnonzero(valid & (rank == best[np.where(valid, codes, 0)]))
+
+    if ties == "first":
+        positions = np.full(n_groups, len(df), dtype=np.int64)
+        np.minimum.at(positions, codes[candidates], candidates)
+    else:
+        positions = np.full(n_groups, -1, dtype=np.int64)
+        np.maximum.at(positions, codes[candidates], candidates)
+
+    columns = [*keys, *(column for column in df.columns if column not in keys)]
+    return df[columns].take(positions).reset_index(drop=True)
+
+def column_statistics(df, label_column="POMPE", classes=(0, 1), id_column="PERSONID", batch_size=256):
+    """
+    Count missing and non-zero values per feature column, overall and per label class.
+
+    Each batch of columns is turned into one boolean "present" and one "non-zero" matrix,
+    so every count of a column comes from a single scan of its values. Non-numeric values
+    that are present count as non-zero.
+
+    Args:
+    - df (DataFrame): Wide stage output, one row per `id_column`.
+    - label_column (str): Label used for the class-conditional counts.
+    - classes (tuple): Label values to count separately.
+    - id_column (str): Row key, left out of the statistics.
+    - batch_size (int): Number of columns scanned at once, which bounds the size of the masks.
+
+    Returns:
+    - DataFrame: One row per feature (index COLUMN) with ROWS, NULLS, NON_ZERO and, per class c,
+      NON_NULL_<c> and NON_ZERO_<c>.
+    """
+    columns = [column for column in df.columns if column not in (id_column, label_column)]
+    # As floats, so that a nullable label (e.g. Int8 with <NA>) compares like NaN
+    label = df[label_column].to_numpy(dtype="float64", na_value=np.nan) if label_column in df.columns else np.full(len(df), np.nan)
+    class_rows = {value: label == value for value in classes}
+
+    counts = {key: np.zeros(len(columns), dtype=np.int64)
+              for key in ["NON_NULL", "NON_ZERO", *(f"{kind}_{value}" for value in classes for kind in ("NON_NULL", "NON_ZERO"))]}
+    for start in range(0, len(columns), batch_size):
+        batch = df[columns[start:start + batch_size]]
+        present = batch.notna().to_numpy()
+        non_zero = present & (batch != 0).to_numpy()
+        end = start + batch.shape[1]
+        counts["NON_NULL"][start:end] = np.count_nonzero(present, axis=0)
+        counts["NON_ZERO"][start:end] = np.count_nonzero(non_zero, axis=0)
+        for value, rows in class_rows.items():
+            counts[f"NON_NULL_{value}"][start:end] = np.count_nonzero(present[rows], axis=0)
+            counts[f"NON_ZERO_{value}"][start:end] = np.count_nonzero(non_zero[rows], axis=0)
+
+    return _statistics_frame(columns, len(df), counts)
+
+def indicator_statistics(matrix, labels=None, classes=(0, 1)):
+    """
+    Column statistics of a matrix from `build_indicator_matrix`, read off its CSR arrays.
+
+    Absent cells are zeros rather than missing values, matching the dense crosstab output.
+
+    Args:
+    - matrix (dict): Output of `build_indicator_matrix`.
+    - labels (Series, optional): Label per row key (e.g. POMPE indexed by PERSONID).
+    - classes (tuple): Label values to count separately.
+
+    Returns:
+    - DataFrame: Same layout as column_statistics.
+    """
+    n_rows, n_columns = map(int, matrix["shape"])
+    label = np.full(n_rows, np.nan) if labels is None else pd.to_numeric(labels.reindex(matrix["rows"])).to_numpy()
+    entry_label = np.repeat(label, np.diff(matrix["indptr"]))
+    stored = matrix["data"] != 0
+
+    counts = {"NON_NULL": np.full(n_columns, n_rows, dtype=np.int64),
+              "NON_ZERO": np.bincount(matrix["indices"][stored], minlength=n_columns)}
+    for value in classes:
+        counts[f"NON_NULL_{value}"] = np.full(n_columns, np.count_nonzero(label == value), dtype=np.int64)
+        counts[f"NON_ZERO_{value}"] = np.bincount(matrix["indices"][stored & (entry_label == value)], minlength=n_columns)
+
+    return _statistics_frame(matrix["columns"], n_rows, counts)
+
+def _statistics_frame(columns, n_rows, counts):
+    stats = pd.DataFrame(counts, index=pd.Index(columns, name="COLUMN"))
+    stats.insert(0, "ROWS", n_rows)
+    stats.insert(1, "NULLS", n_rows - stats["NON_NULL"])
+    return stats.drop(columns="NON_NULL")
+
+def select_columns(stats, rules):
+    """
+    Choose feature columns from their statistics, without reading the data.
+
+    A column is kept when it passes any of the configured rules:
+    - "max_null_fraction": less than this fraction of the rows is missing;
+    - "min_non_zero_fraction": more than this fraction of the rows is non-zero;
+    - "any_value_for_label": it has a value for at least one row with one of these labels;
+    - "exclusive_to_label": it is non-zero for some row with one of these labels and for no row
+      with any other label.
+
+    Args:
+    - stats (DataFrame): Output of column_statistics (or indicator_statistics).
+    - rules (dict): Rule name -> threshold or list of label values.
+
+    Returns:
+    - list: The kept columns, in their original order.
+    """
+    classes = [column[len("NON_ZERO_"):] for column in stats.columns if column.startswith("NON_ZERO_")]
+    keep = np.zeros(len(stats), dtype=bool)
+
+    if "max_null_fraction" in rules:
+        keep |= (stats["NULLS"] / stats["ROWS"] < rules["max_null_fraction"]).to_numpy()
+    if "min_non_zero_fraction" in rules:
+        keep |= (stats["NON_ZERO"] / stats["ROWS"] > rules["min_non_zero_fraction"]).to_numpy()
+    for value in map(str, rules.get("any_value_for_label", [])):
+        keep |= (stats[f"NON_NULL_{value}"] > 0).to_numpy()
+    exclusive = [str(value) for value in rules.get("exclusive_to_label", [])]
+    if exclusive:
+        others = [value for value in classes if value not in exclusive]
+        in_label = (stats[[f"NON_ZERO_{value}" for value in exclusive]] > 0).any(axis=1).to_numpy()
+        in_others = (stats[[f"NON_ZERO_{value}" for value in others]] > 0).any(axis=1).to_numpy() if others else False
+        keep |= in_label & ~in_others
+
+    return stats.index[keep].tolist()
+
+def age_in_years(dates, reference_date):
+    """
+    Whole years from each date to `reference_date`, computed on the whole column at once.
+
+    Gives the same result as `relativedelta(reference_date, date).years`: Feb 29 dates
+    reach their anniversary on Feb 28 in non-leap years, and dates after the reference
+    date give negative values truncated towards zero. Missing dates give NaN.
+
+    Args:
+    - dates (Series): datetime64 Series, e.g. DOB.
+    - reference_date (datetime): Date the ages are computed at.
+
+    Returns:
+    - Series: Float ages aligned with `dates`.
+    """
+    reference_date = pd.Timestamp(reference_date)
+    month, day = dates.dt.month, dates.dt.day
+
+    # Anniversary day in the reference year, clipped to the end of month like relativedelta
+    if not reference_date.is_leap_year:
+        day = day.where(~((month == 2) & (day == 29)), 28)
+
+    anniversary_after = (month > reference_date.month) | ((month == reference_date.month) & (day > reference_date.day))
+    anniversary_before = (month < reference_date.month) | ((month == reference_date.month) & (day < reference_date.day))
+
+    years = reference_date.year - dates.dt.year
+    past_age = years - anniversary_after.astype("int64")
+    future_age = years + anniversary_before.astype("int64")
+    return past_age.where(dates <= reference_date, future_age).where(dates.notnull())
+
+def load_nationality_table(file_path=None):
+    """
+    Load the nationality reference table (NATIONALITY -> COUNTRY, CONTINENT, REGION).
+
+    The table is read from `file_path` (csv) when given, so new nationalities can be added
+    without code edits; otherwise it is compiled from the dictionaries at the bottom of
+    this module. Columns are categorical and the index is the nationality.
+    """
+    if file_path:
+        table = pd.read_csv(file_path, dtype=str, keep_default_na=False, na_values=[""], encoding="utf-8")
+    else:
+        nationalities = list(dict.fromkeys([*nationality_to_country, *nationality_to_continent_and_region]))
+        table = pd.DataFrame({
+            "NATIONALITY": nationalities,
+            "COUNTRY": [nationality_to_country.get(x) for x in nationalities],
+            "CONTINENT": [nationality_to_continent_and_region.get(x, {}).get("continent") for x in nationalities],
+            "REGION": [nationality_to_continent_and_region.get(x, {}).get("region") for x in nationalities],
+        })
+    return table.set_index("NATIONALITY").astype("category")
+
+def lookup_categorical(keys, table):
+    """
+    Join `keys` against the index of a reference table in one vectorized pass.
+
+    Each distinct key is looked up once and the result is broadcast back through the
+    factorized codes, so the output columns stay categorical. Keys missing from the
+    table give NaN.
+
+    Args:
+    - keys (Series): Values to look up, e.g. NATIONALITY.
+    - table (DataFrame): Reference table with categorical columns, indexed by key.
+
+    Returns:
+    - DataFrame: One categorical column per table column, aligned with `keys`.
+    """
+    key_codes, uniques = pd.factorize(keys)
+    positions = table.index.get_indexer(uniques)
+    # Append a "missing" slot so that unknown and null keys map to code -1
+    positions = np.append(positions, -1)[key_codes]
+
+    result = {}
+    for column in table.columns:
+        categorical = table[column].array
+        codes = np.where(positions >= 0, categorical.codes[positions], -1)
+        result[column] = pd.Categorical.from_codes(codes, dtype=categorical.dtype)
+    return pd.DataFrame(result, index=keys.index)
+
 def construct_path(base_path, name, file_format, compression=None):
     """Utility function to construct file paths based on given parameters."""
     if compression:
@@ -54,6 +1380,303 @@ def construct_path(base_path, name, file_format, compression=None):
     else:
         return f"{base_path}{name}.{file_format}"
 
+def resolve_paths(config):
+    """Return the (source file path, destination file path) of a dataframe config block."""
+    source, destination = config["source"], config["destination"]
+    source_compression_method = source["compression"]["method"] if source["compression"]["enabled"] else None
+    destination_compression_method = destination["compression"]["method"] if destination["compression"]["enabled"] else None
+    file_path = construct_path(source["path"], config["name"], source["format"], compression=source_compression_method)
+    save_path = construct_path(destination["path"], config["name"], destination["format"], compression=destination_compression_method)
+    return file_path, save_path
+
+def resolve_state_path(config):
+    """Return the path of the reduced event table kept for incremental updates (`<name>_state`)."""
+    destination = config["destination"]
+    compression = destination["compression"]["method"] if destination["compression"]["enabled"] else None
+    return construct_path(destination["path"], f"{config['name']}_state", destination["format"], compression=compression)
+
+def resolve_numeric_results(config):
+    """Return the `parameters.numeric_results` block if it is enabled, else None."""
+    numeric_results = config["parameters"].get("numeric_results", {})
+    return numeric_results if numeric_results.get("enabled") else None
+
+def resolve_text_results_path(config):
+    """Return the path of the side table of non-numeric results (`<name>_text`), see `parameters.numeric_results`."""
+    destination = config["destination"]
+    compression = destination["compression"]["method"] if destination["compression"]["enabled"] else None
+    return construct_path(destination["path"], f"{config['name']}_text", destination["format"], compression=compression)
+
+def write_text_results(df, config):
+    """
+    Write the side table of results that are not numbers (see `parameters.numeric_results`).
+
+    Args:
+    - df (DataFrame): The events whose result does not parse as a number.
+    - config (dict): The stage's config block.
+    """
+    destination = config["destination"]
+    compression = destination["compression"]["method"] if destination["compression"]["enabled"] else None
+    write_data(df, resolve_text_results_path(config), destination["format"], index=False, compression=compression,
+               options=resolve_writer_options(config))
+    logging.info(f"Kept {len(df)} non-numeric results of {config['name']} in the side table.")
+
+def resolve_writer_options(config):
+    """Return the `destination.options` block of a config (codec, row groups, dictionary encoding, threads), see write_columnar."""
+    return config["destination"].get("options")
+
+def resolve_partitioning(config):
+    """
+    Return the `pipeline.partitioning` block for a stage's output, or None if partitioning is
+    disabled or the output is not parquet/feather.
+
+    Range boundaries are computed from the cohort (`<destination>cohort.npy`), which every
+    stage shares, so all outputs are partitioned the same way.
+    """
+    partitioning = load_pipeline_config().get("partitioning", {})
+    if not partitioning.get("enabled") or config["destination"]["format"] not in COLUMNAR_FORMATS:
+        return None
+    partitioning = dict(partitioning)
+    if partitioning.get("method", "hash") == "range":
+        cohort = load_cohort(f'{config["destination"]["path"]}cohort.npy')
+        partitioning["boundaries"] = range_boundaries(cohort, partitioning["partitions"])
+    return partitioning
+
+def resolve_sharding(config):
+    """Return the `parameters.sharding` block if it is enabled, else None."""
+    sharding = config["parameters"].get("sharding", {})
+    return sharding if sharding.get("enabled") else None
+
+def resolve_execution(config, persist=True):
+    """
+    Resolve how an event stage (labs, clinical, drugs) runs and reject the combinations it does not support.
+
+    Sharding and `parameters.batched_pivot` need the pandas engine, the `numeric_results`
+    side table is written in a single pass only, and a batched output cannot be updated
+    incrementally.
+
+    Args:
+    - config (dict): The stage's config block.
+    - persist (bool): Whether the stage writes its output; the batched pivot and the side
+      table only apply then.
+
+    Returns:
+    - tuple: (engine module, sharding block or None, batched pivot, side table) flags for the stage.
+    """
+    from engines import get_engine, pandas_engine
+
+    engine, sharding = get_engine(config), resolve_sharding(config)
+    batched = bool(persist and config["parameters"].get("batched_pivot", {}).get("enabled"))
+    text_results = bool(persist and (resolve_numeric_results(config) or {}).get("side_table"))
+    if engine is not pandas_engine and (sharding or batched):
+        raise ValueError(f"{'Sharding' if sharding else 'batched_pivot'} is only supported with the pandas engine.")
+    if text_results and (sharding or batched):
+        raise ValueError("The numeric_results side table is not supported with sharding or batched_pivot.")
+    if batched and config["parameters"].get("incremental", {}).get("enabled"):
+        raise ValueError("Incremental updates are not supported with batched_pivot enabled.")
+    return engine, sharding, batched, text_results
+
+def resolve_arrow_strings(config):
+    """Return the columns listed in `parameters.arrow_strings` if it is enabled, else None."""
+    arrow_strings = config["parameters"].get("arrow_strings", {})
+    return arrow_strings.get("columns") if arrow_strings.get("enabled") else None
+
+def resolve_quarantine_path(config):
+    """Return the path of the stage's report of rows rejected during cleaning (`<destination>quarantine/<name>.csv`)."""
+    return construct_path(f'{config["destination"]["path"]}quarantine/', config["name"], "csv")
+
+def resolve_stats_path(config):
+    """Return the path of the column statistics written next to the stage output (`<name>_stats.csv`)."""
+    return construct_path(config["destination"]["path"], f"{config['name']}_stats", "csv")
+
+def write_statistics(stats, config):
+    """Persist column statistics next to the stage output, see resolve_stats_path."""
+    write_data(stats, resolve_stats_path(config), "csv")
+
+def read_statistics(config):
+    """Load the column statistics of a stage, or None if the stage has not written any."""
+    file_path = resolve_stats_path(config)
+    if not os.path.exists(file_path):
+        return None
+    return pd.read_csv(file_path, index_col="COLUMN", dtype={"COLUMN": str}, keep_default_na=False)
+
+def resolve_delta_path(config):
+    """Return the path of the delta extract configured in `parameters.incremental.delta_path`."""
+    source = config["source"]
+    compression = source["compression"]["method"] if source["compression"]["enabled"] else None
+    delta_path = config["parameters"]["incremental"]["delta_path"]
+    return construct_path(delta_path, config["name"], source["format"], compression=compression)
+
+def read_delta(config, delta_path=None):
+    """
+    Read a stage's delta extract of new events, restricted to the cohort like its source.
+
+    Args:
+    - config (dict): The stage's config block.
+    - delta_path (str, optional): Path of the delta file. Defaults to `parameters.incremental.delta_path`.
+
+    Returns:
+    - DataFrame: The raw delta events of the cohort.
+    """
+    source = config["source"]
+    cohort = load_cohort(f'{config["destination"]["path"]}cohort.npy')
+    return read_data(delta_path or resolve_delta_path(config), source["format"], ids=cohort,
+                     columns=source.get("columns"), filters=source.get("filters"),
+                     arrow_strings=resolve_arrow_strings(config))
+
+def update_from_delta(config, clean, reduce, transform, delta_path=None, fill_value=None):
+    """
+    Read an event stage's delta extract and fold it into its output (see read_delta and apply_delta).
+
+    Args:
+    - config (dict): The stage's config block.
+    - clean, reduce, transform (callable): The stage's steps, see apply_delta.
+    - delta_path (str, optional): Path of the delta file. Defaults to `parameters.incremental.delta_path`.
+    - fill_value (scalar, optional): See merge_rows.
+
+    Returns:
+    - DataFrame: The updated output.
+    """
+    from metrics import track
+
+    if config["parameters"].get("sparse_output", {}).get("enabled"):
+        raise ValueError("Incremental updates are not supported with sparse_output enabled.")
+
+    # READ FILE
+    with track("read") as step:
+        df = step.output(read_delta(config, delta_path))
+
+    # UPDATE OUTPUT
+    with track("update", df) as step:
+        return step.output(apply_delta(config, df, clean, reduce, transform, fill_value=fill_value))
+
+def event_stage_files(config):
+    """
+    List the files an event stage (labs, clinical, drugs) reads and writes.
+
+    Args:
+    - config (dict): The stage's config block.
+
+    Returns:
+    - dict: "inputs" and "outputs" lists of file paths, used by the stage cache.
+    """
+    file_path, save_path = resolve_paths(config)
+    destination_path = config["destination"]["path"]
+    if config["parameters"].get("sparse_output", {}).get("enabled"):
+        save_path = construct_path(destination_path, config["name"], "npz")
+    outputs = [save_path, resolve_quarantine_path(config), resolve_stats_path(config)]
+    if config["parameters"].get("incremental", {}).get("enabled"):
+        outputs.append(resolve_state_path(config))
+    if (resolve_numeric_results(config) or {}).get("side_table"):
+        outputs.append(resolve_text_results_path(config))
+    return {
+        "inputs": [file_path, f'{destination_path}cohort.npy'],
+        "outputs": outputs,
+    }
+
+def merge_rows(output, updates, id_column="PERSONID", trailing_columns=("POMPE",), fill_value=None):
+    """
+    Replace the rows of `output` whose id appears in `updates` and extend the column vocabulary.
+
+    Feature columns are kept in sorted order between the id column and the trailing
+    columns, matching the layout produced by a full pivot/crosstab.
+
+    Args:
+    - output (DataFrame): Persisted wide output, one row per id.
+    - updates (DataFrame): Recomputed rows for the touched ids.
+    - id_column (str): Row key.
+    - trailing_columns (tuple): Columns kept after the feature columns.
+    - fill_value (scalar, optional): Value for cells of columns that are new to a row
+      (e.g. 0 for count matrices), cast back to the dtype the column has in `output` or
+      `updates`; left missing when None.
+
+    Returns:
+    - DataFrame: The merged output sorted by `id_column`.
+    """
+    kept = output[~output[id_column].isin(updates[id_column])]
+    merged = pd.concat([kept, updates], ignore_index=True)
+
+    trailing = [column for column in trailing_columns if column in merged.columns]
+    features = sorted(column for column in merged.columns if column != id_column and column not in trailing)
+    if fill_value is not None:
+        new_columns = [column for column in features if column not in output.columns or column not in updates.columns]
+        # Keep the (count) dtype the column has in the frame it comes from
+        dtypes = {column: (updates if column in updates.columns else output)[column].dtype for column in new_columns}
+        merged[new_columns] = merged[new_columns].fillna(fill_value).astype(dtypes)
+
+    return merged[[id_column, *features, *trailing]].sort_values(id_column, ignore_index=True)
+
+def apply_delta(config, delta, clean, reduce, transform, fill_value=None, id_column="PERSONID"):
+    """
+    Fold a delta extract into a stage's persisted state and output.
+
+    Only the ids present in the delta are recomputed: their rows of the reduced state
+    (e.g. latest value per key) are combined with the cleaned delta and reduced again,
+    then transformed and merged into the persisted output.
+
+    Args:
+    - config (dict): The stage's config block.
+    - delta (DataFrame): Raw delta events, already filtered to the cohort.
+    - clean (callable): The stage's cleaning step, raw events -> cleaned events.
+    - reduce (callable): The stage's reduction step, cleaned events -> state rows.
+    - transform (callable): The stage's transformation, state rows -> wide rows.
+    - fill_value (scalar, optional): See merge_rows.
+    - id_column (str): Row key.
+
+    Returns:
+    - DataFrame: The updated output.
+    """
+    destination = config["destination"]
+    compression = destination["compression"]["method"] if destination["compression"]["enabled"] else None
+    _, save_path = resolve_paths(config)
+    state_path = resolve_state_path(config)
+    if not os.path.exists(state_path):
+        raise FileNotFoundError(f"No state at {state_path}; run the stage once with incremental enabled first.")
+
+    delta = reduce(clean(delta))
+    touched = delta[id_column].unique()
+
+    state = read_data(state_path, destination["format"], compression=compression)
+    touched_mask = state[id_column].isin(touched)
+    touched_state = reduce(pd.concat([state[touched_mask], delta], ignore_index=True))
+    state = pd.concat([state[~touched_mask], touched_state], ignore_index=True)
+
+    output = read_data(save_path, destination["format"], compression=compression)
+    output = merge_rows(output, transform(touched_state), id_column=id_column, fill_value=fill_value)
+
+    options = resolve_writer_options(config)
+    write_data(state, state_path, destination["format"], index=False, compression=compression, options=options)
+    write_data(output, save_path, destination["format"], index=False, compression=compression, options=options,
+               partitioning=resolve_partitioning(config))
+    write_statistics(column_statistics(output), config)
+    logging.info(f"Applied delta: {len(delta)} reduced rows touching {len(touched)} ids.")
+    return output
+
+def apply_label_corrections(df, file_path, id_column="PERSONID"):
+    """
+    Overwrite labels of individual patients from a corrections table.
+
+    The table (csv) has an `id_column` column and one column per label to correct, e.g.
+    "PERSONID,POMPE". Ids that are not in `df` are logged and skipped.
+
+    Args:
+    - df (DataFrame): Data with an `id_column` column, modified in place.
+    - file_path (str): Path of the corrections csv.
+    - id_column (str): Row key.
+
+    Returns:
+    - DataFrame: `df` with the corrected labels.
+    """
+    corrections = pd.read_csv(file_path)
+    positions = pd.Index(df[id_column]).get_indexer(corrections[id_column])
+    found = positions >= 0
+    if not found.all():
+        logging.warning(f"Label corrections for unknown {id_column}s: {corrections.loc[~found, id_column].tolist()}")
+
+    for column in corrections.columns.drop(id_column):
+        df.iloc[positions[found], df.columns.get_loc(column)] = corrections.loc[found, column].to_numpy()
+    logging.info(f"Applied {found.sum()} label corrections from {file_path}.")
+    return df
+
 def setup_logging(log_filename):
     log_path = f"logs/{log_filename}.log"
     if not os.path.exists(os.path.dirname(log_path)):
@@ -62,7 +1685,8 @@ def setup_logging(log_filename):
     logging.basicConfig(filename=log_path, 
                         level=logging.INFO,
                         format='%(asctime)s - %(levelname)s - %(message)s',
-                        datefmt='%d-%b-%Y %H:%M:%S')
+                        datefmt='%d-%b-%Y %H:%M:%S',
+                        force=True)
 
 nationality_to_country = {
     'EMIRATI': 'United Arab Emirates',
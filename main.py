@@ -2,37 +2,292 @@
 Main Preprocessing Script
 
 This script coordinates the cleaning and preprocessing of multiple datasets
-including demographic, diagnosis, drugs, labs, and clinical data. 
+including demographic, diagnosis, drugs, labs, and clinical data.
 
-Each data type has its own preprocessing module, and this script invokes 
-the cleaning function from each module sequentially.
+Each data type has its own preprocessing module. The stages are modelled as a
+dependency graph: demographic runs first because it produces the cohort index `cohort.npy`,
+after which the remaining stages are independent and run concurrently in a
+process pool. The dataset stage (preprocess/merge.py) then joins their outputs into
+the final `dataset.parquet`. Stages whose inputs, config and code are unchanged are restored from
+the stage cache (see cache.py) instead of being rerun.
+
+For notebooks and tests, run_in_process() runs the same stages in the current process
+and passes their DataFrames along in memory, writing files only when asked to.
 """
 
+import argparse
+import logging
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
 # Importing necessary preprocessing modules for each data type
 from tqdm import tqdm
-from preprocess import demographic, diagnosis, drugs, labs, clinical
+from cache import load_manifest, save_manifest, stage_key, restore, store, invalidate
+from helper import load_pipeline_config, setup_logging, as_cohort
+from metrics import collect_run, summary_table, stage_metrics
+from preprocess import demographic, diagnosis, drugs, labs, clinical, merge
+
+# Stage name -> (preprocessing module, names of the stages it depends on)
+STAGES = {
+    "demographic": (demographic, []),
+    "diagnosis": (diagnosis, ["demographic"]),
+    "drugs": (drugs, ["demographic"]),
+    "labs": (labs, ["demographic"]),
+    "clinical": (clinical, ["demographic"]),
+    "dataset": (merge, ["demographic", "diagnosis", "drugs", "labs", "clinical"]),
+}
+
+
+def topological_order(stages):
+    """
+    Order the stages so that every stage comes after its dependencies.
+
+    Args:
+    - stages (dict): Stage name -> (module, dependencies).
+
+    Returns:
+    - list: Stage names in a valid execution order.
+    """
+    order, visiting, done = [], set(), set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"Cycle detected in stage dependencies at: {name}")
+        if name not in stages:
+            raise ValueError(f"Unknown stage dependency: {name}")
+        visiting.add(name)
+        for dependency in stages[name][1]:
+            visit(dependency)
+        visiting.discard(name)
+        done.add(name)
+        order.append(name)
+
+    for name in stages:
+        visit(name)
+    return order
+
+
+def _restore_from_cache(name, module, cache):
+    """Compute the stage's cache key and restore its outputs on a hit. Returns True on a hit."""
+    if cache is None:
+        return False
+    key = stage_key(name, module, cache["manifest"])
+    cache["keys"][name] = key
+    if cache["force"] is True or name in cache["force"]:
+        return False
+    if restore(cache["path"], cache["manifest"], name, key):
+        logging.info(f"Stage {name} restored from cache ({key[:12]})")
+        save_manifest(cache["path"], cache["manifest"])
+        return True
+    return False
+
+
+def _store_in_cache(name, module, cache):
+    """Store the outputs of a stage that just finished."""
+    if cache is None:
+        return
+    store(cache["path"], cache["manifest"], name, cache["keys"][name],
+          module.stage_files()["outputs"], max_entries=cache.get("max_entries"))
+    save_manifest(cache["path"], cache["manifest"])
+
+
+def _stage_function(module, incremental):
+    """Return the entry point of a stage: run_incremental in incremental mode when the stage supports it."""
+    if incremental and _runs_incrementally(module):
+        return module.run_incremental
+    return module.run_cleaning
+
+
+def _runs_incrementally(module):
+    """Whether a stage has incremental updates enabled in its config."""
+    return hasattr(module, "run_incremental") and module.CONFIG["parameters"].get("incremental", {}).get("enabled", False)
+
+
+def _stage_cache(name, module, cache, incremental):
+    """
+    Return the cache a stage runs with: none for a stage that folds its delta in incremental mode.
+
+    The delta updates the stage's outputs in place, so its stored entries are deleted;
+    otherwise a later full run would restore the outputs from before the delta.
+    """
+    if cache is None or not (incremental and _runs_incrementally(module)):
+        return cache
+    invalidate(cache["path"], cache["manifest"], name)
+    save_manifest(cache["path"], cache["manifest"])
+    return None
+
 
+def run_stages(stages, max_workers=None, cache=None, incremental=False):
+    """
+    Run the stages as a DAG, submitting each one as soon as its dependencies finish.
+
+    A stage whose dependency failed is skipped. With `max_workers` of 1 the stages
+    run in the current process in topological order. When a `cache` is given, a stage
+    whose cache key matches a stored entry is restored instead of being run. In
+    `incremental` mode, stages with incremental updates enabled fold their delta file
+    into their existing output instead, bypassing the cache and deleting its entries for them.
 
-def main():
+    Args:
+    - stages (dict): Stage name -> (module, dependencies).
+    - max_workers (int, optional): Size of the process pool. Defaults to one worker per CPU.
+    - cache (dict, optional): Cache settings: "path", "manifest", "keys", "force"
+      (True or a collection of stage names) and "max_entries".
+    - incremental (bool): Run run_incremental instead of run_cleaning where enabled.
+
+    Returns:
+    - dict: Stage name -> "done", "cached", "failed" or "skipped".
+    """
+    order = topological_order(stages)
+    status = {}
+
+    if max_workers == 1:
+        for name in tqdm(order, desc="Processing Datasets", unit="dataset"):
+            module, dependencies = stages[name]
+            if any(status[dependency] not in ("done", "cached") for dependency in dependencies):
+                status[name] = "skipped"
+                continue
+            stage_cache = _stage_cache(name, module, cache, incremental)
+            if _restore_from_cache(name, module, stage_cache):
+                status[name] = "cached"
+                continue
+            try:
+                _stage_function(module, incremental)()
+                _store_in_cache(name, module, stage_cache)
+                status[name] = "done"
+            except Exception as e:
+                logging.error(f"Stage {name} failed: {e}\n{traceback.format_exc()}")
+                status[name] = "failed"
+        return status
+
+    pending = list(order)
+    running = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor, \
+            tqdm(total=len(order), desc="Processing Datasets", unit="dataset") as progress:
+        while pending or running:
+            for name in list(pending):
+                module, dependencies = stages[name]
+                if any(status.get(dependency) in ("failed", "skipped") for dependency in dependencies):
+                    status[name] = "skipped"
+                    pending.remove(name)
+                    progress.update(1)
+                elif all(status.get(dependency) in ("done", "cached") for dependency in dependencies):
+                    pending.remove(name)
+                    stage_cache = _stage_cache(name, module, cache, incremental)
+                    if _restore_from_cache(name, module, stage_cache):
+                        status[name] = "cached"
+                        progress.update(1)
+                    else:
+                        running[executor.submit(_stage_function(module, incremental))] = name
+
+            if not running:
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    module = stages[name][0]
+                    _store_in_cache(name, module, None if incremental and _runs_incrementally(module) else cache)
+                    status[name] = "done"
+                except Exception as e:
+                    # The worker's traceback is chained to the re-raised exception and printed with it
+                    logging.error(f"Stage {name} failed: {e}\n{traceback.format_exc()}")
+                    status[name] = "failed"
+                progress.update(1)
+
+    return status
+
+
+def run_in_process(inputs=None, persist=False):
+    """
+    Run the whole pipeline in the current process, handing DataFrames from stage to stage.
+
+    Nothing is read back from disk between stages: demographic's PERSONIDs are passed to
+    the event stages as the cohort, and their outputs go straight to the dataset stage.
+    Meant for notebooks and tests; the command line keeps running the stages in a process
+    pool through the files (see main).
+
+    Args:
+    - inputs (dict, optional): Stage name -> raw extract, used instead of the source file.
+    - persist (bool): Also write every stage's outputs to their destinations, as main() does.
+
+    Returns:
+    - dict: Stage name -> output DataFrame, including "dataset".
+    """
+    inputs = inputs or {}
+    results, cohort = {}, None
+    for name in topological_order(STAGES):
+        module, dependencies = STAGES[name]
+        with stage_metrics(name):
+            if module is demographic:
+                results[name] = module.preprocess(inputs.get(name), persist=persist)
+                cohort = as_cohort(results[name]["PERSONID"])
+            elif module is merge:
+                results[name] = module.preprocess({dependency: results[dependency] for dependency in dependencies},
+                                                  persist=persist)
+            else:
+                results[name] = module.preprocess(inputs.get(name), cohort=cohort, persist=persist)
+    return results
+
+
+def main(max_workers=None, use_cache=True, force=(), incremental=False, summary=None):
     """
     Main function to run the data preprocessing.
-    
-    Invokes the cleaning functions from each preprocessing module in sequence.
-    """
-    
-   # List of all the preprocessing functions you want to run
-    tasks = [
-        ("demographic", demographic.run_cleaning),
-        ("diagnosis", diagnosis.run_cleaning),
-        ("drugs", drugs.run_cleaning),
-        ("labs", labs.run_cleaning),
-        ("clinical", clinical.run_cleaning)
-    ]
-    
-    # Use tqdm to iterate over tasks and show progress
-    for _, task_func in tqdm(tasks, desc="Processing Datasets", unit="dataset"):
-        task_func()
+
+    Runs demographic first, then the remaining stages concurrently, then the dataset
+    merge. Stages whose config,
+    code and inputs are unchanged since a previous run are restored from the cache.
+
+    Args:
+    - max_workers (int, optional): Process pool size. Falls back to `pipeline.max_workers` in config.json.
+    - use_cache (bool): Whether to use the stage cache configured in `pipeline.cache`.
+    - force (True or iterable): Stage names to rerun even on a cache hit; True reruns all.
+    - incremental (bool): Apply the configured delta files instead of rebuilding the
+      stages that have `parameters.incremental.enabled`.
+    - summary (bool, optional): Print a table of the step metrics of this run. Falls back
+      to `pipeline.metrics.summary` in config.json.
+    """
+    setup_logging("pipeline")
+    pipeline_config = load_pipeline_config()
+    if max_workers is None:
+        max_workers = pipeline_config.get("max_workers")
+
+    cache = None
+    cache_config = pipeline_config.get("cache", {})
+    if use_cache and cache_config.get("enabled"):
+        cache = {
+            "path": cache_config["path"],
+            "manifest": load_manifest(cache_config["path"]),
+            "keys": {},
+            "force": force if force is True else set(force),
+            "max_entries": cache_config.get("max_entries"),
+        }
+
+    status = run_stages(STAGES, max_workers=max_workers, cache=cache, incremental=incremental)
+
+    metrics_config = pipeline_config.get("metrics", {})
+    report = collect_run(status, metrics_config)
+    if report is not None and (metrics_config.get("summary") if summary is None else summary):
+        print(summary_table(report))
+
+    failed = [name for name, state in status.items() if state not in ("done", "cached")]
+    if failed:
+        raise RuntimeError(f"Stages did not complete: {', '.join(failed)}")
 
 # Ensuring the main function is only run when this script is executed directly
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Run the preprocessing pipeline.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes for independent stages.")
+    parser.add_argument("--no-cache", action="store_true", help="Run every stage without reading or writing the stage cache.")
+    parser.add_argument("--force", nargs="*", choices=list(STAGES), default=None,
+                        help="Rerun these stages (all stages if none are named) even if they are cached.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Fold the delta files into the existing outputs of stages with incremental updates enabled.")
+    parser.add_argument("--summary", action="store_true", default=None,
+                        help="Print a table of the time, CPU, memory and row counts of every step after the run.")
+    args = parser.parse_args()
+    force = () if args.force is None else (args.force or True)
+    main(max_workers=args.workers, use_cache=not args.no_cache, force=force, incremental=args.incremental, summary=args.summary)
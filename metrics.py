@@ -0,0 +1,245 @@
+"""
+Step-level performance metrics.
+
+Inside a stage, each named step (read, filter, dtype conversion, date parsing, sort,
+group, pivot, merge, write, ...) is wrapped in `track()`, which records its wall time,
+CPU time, the peak RSS reached while the step ran, and the rows and columns going in and
+out. The peak comes from the kernel's high-water mark (VmHWM), which is reset when a step
+starts. Where it cannot be reset (outside Linux) the peaks are left empty and the stage
+records the process's lifetime maximum as `max_rss_mb` instead. `stage_metrics()` collects the steps of one stage run and writes them to
+`<metrics path>/<stage>.json`; after a pipeline run, main.py combines the stage files
+into one `run_<timestamp>.json` and can print a summary table.
+
+Settings live in the `pipeline.metrics` block of config.json.
+"""
+
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_METRICS_PATH = "logs/metrics/"
+
+# Steps recorded in this process since the current stage started
+_steps = []
+
+# Peak RSS (MB) seen so far by each step (and stage) still running, outermost first
+_open_peaks = []
+
+
+def metrics_config():
+    """Return the `pipeline.metrics` block of config.json (empty dict if absent)."""
+    from helper import load_pipeline_config
+    return load_pipeline_config().get("metrics", {})
+
+
+def max_rss_mb():
+    """Peak resident set size of this process over its lifetime in MB, or None where it cannot be measured."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1 << 20)
+    except (ImportError, AttributeError):
+        return None
+
+
+def _high_water_mb():
+    """Peak RSS since the last _reset_high_water() in MB (VmHWM), or None outside Linux."""
+    try:
+        with open("/proc/self/status", 'r') as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / (1 << 10)
+    except OSError:
+        return None
+    return None
+
+
+def _reset_high_water():
+    """Reset the kernel's peak RSS of this process to its current RSS; False where that is not possible."""
+    try:
+        with open("/proc/self/clear_refs", 'w') as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _fold_high_water():
+    """Add the peak since the last reset to every running step, so resetting it loses nothing."""
+    peak = _high_water_mb()
+    if peak is not None:
+        for position, seen in enumerate(_open_peaks):
+            _open_peaks[position] = None if seen is None else max(seen, peak)
+
+
+def _begin_peak():
+    """Start measuring the peak RSS of a step or stage."""
+    _fold_high_water()
+    _open_peaks.append(0.0 if _reset_high_water() else None)
+
+
+def _end_peak():
+    """Stop measuring the innermost step or stage and return its peak RSS in MB (None if unmeasured)."""
+    _fold_high_water()
+    return _open_peaks.pop()
+
+
+def _shape(data):
+    """(rows, columns) of a DataFrame/Series/array, or (None, None)."""
+    shape = getattr(data, "shape", None)
+    if shape is None:
+        return None, None
+    return shape[0], (shape[1] if len(shape) > 1 else 1)
+
+
+class Step:
+    """Handle yielded by track(); call output() with the step's result to record its shape."""
+
+    def __init__(self, name, data=None):
+        self.record = {"step": name}
+        self.record["rows_in"], self.record["columns_in"] = _shape(data)
+        self.record["rows_out"], self.record["columns_out"] = None, None
+
+    def output(self, data):
+        self.record["rows_out"], self.record["columns_out"] = _shape(data)
+        return data
+
+
+@contextmanager
+def track(name, data=None):
+    """
+    Record the cost of one step of a stage.
+
+    Args:
+    - name (str): Step name, e.g. "read" or "pivot".
+    - data (DataFrame, optional): Input of the step, for the rows/columns in.
+
+    Yields:
+    - Step: Pass the step's result to `step.output()` for the rows/columns out.
+    """
+    step = Step(name, data)
+    _begin_peak()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield step
+    finally:
+        step.record["wall_seconds"] = time.perf_counter() - wall
+        step.record["cpu_seconds"] = time.process_time() - cpu
+        step.record["peak_rss_mb"] = _end_peak()
+        _steps.append(step.record)
+
+
+@contextmanager
+def stage_metrics(stage):
+    """
+    Collect the steps of one stage run and write them to `<metrics path>/<stage>.json`.
+
+    The file is written even if the stage fails, with "status" set to "failed", so the
+    step that was running can be found. Nothing is written when metrics are disabled.
+
+    Args:
+    - stage (str): Stage name.
+    """
+    config = metrics_config()
+    _steps.clear()
+    _begin_peak()
+    wall, cpu = time.perf_counter(), time.process_time()
+    status = "failed"
+    try:
+        yield
+        status = "done"
+    finally:
+        peak = _end_peak()
+        if config.get("enabled"):
+            report = {
+                "stage": stage,
+                "status": status,
+                "pid": os.getpid(),
+                "wall_seconds": time.perf_counter() - wall,
+                "cpu_seconds": time.process_time() - cpu,
+                "peak_rss_mb": peak,
+                "steps": list(_steps),
+            }
+            if peak is None:
+                report["max_rss_mb"] = max_rss_mb()
+            write_json(report, stage_metrics_path(stage, config))
+        _steps.clear()
+
+
+def stage_metrics_path(stage, config=None):
+    """Path of the metrics file of the latest run of `stage`."""
+    config = metrics_config() if config is None else config
+    return os.path.join(config.get("path", DEFAULT_METRICS_PATH), f"{stage}.json")
+
+
+def write_json(data, file_path):
+    if os.path.dirname(file_path) and not os.path.exists(os.path.dirname(file_path)):
+        os.makedirs(os.path.dirname(file_path))
+    with open(file_path, 'w') as file:
+        json.dump(data, file, indent=2, default=str)
+
+
+def collect_run(status, config=None):
+    """
+    Combine the stage metrics of a pipeline run into `<metrics path>/run_<timestamp>.json`.
+
+    Only stages that ran in this run ("done" or "failed") have step metrics; cached and
+    skipped stages are listed with their status only.
+
+    Args:
+    - status (dict): Stage name -> status, as returned by main.run_stages.
+
+    Returns:
+    - dict: The run report, or None if metrics are disabled.
+    """
+    config = metrics_config() if config is None else config
+    if not config.get("enabled"):
+        return None
+
+    stages = {}
+    for name, state in status.items():
+        path = stage_metrics_path(name, config)
+        if state in ("done", "failed") and os.path.exists(path):
+            with open(path, 'r') as file:
+                stages[name] = json.load(file)
+        stages.setdefault(name, {"stage": name})["status"] = state
+
+    run = time.strftime("%Y%m%d_%H%M%S")
+    report = {"run": run, "stages": stages}
+    write_json(report, os.path.join(config.get("path", DEFAULT_METRICS_PATH), f"run_{run}.json"))
+    return report
+
+
+def summary_table(report):
+    """
+    Format a run report as a text table with one line per step and a total line per stage.
+
+    Args:
+    - report (dict): Output of collect_run().
+
+    Returns:
+    - str: The table.
+    """
+    import pandas as pd
+
+    rows = []
+    for name, stage in report["stages"].items():
+        for step in stage.get("steps", []):
+            rows.append({"stage": name, **step})
+        rows.append({"stage": name, "step": f"[{stage['status']}]", "wall_seconds": stage.get("wall_seconds"),
+                     "cpu_seconds": stage.get("cpu_seconds"), "peak_rss_mb": stage.get("peak_rss_mb")})
+    table = pd.DataFrame(rows, columns=["stage", "step", "wall_seconds", "cpu_seconds", "peak_rss_mb",
+                                        "rows_in", "columns_in", "rows_out", "columns_out"])
+    shape_columns = ["rows_in", "columns_in", "rows_out", "columns_out"]
+    table[shape_columns] = table[shape_columns].astype("Int64")
+    return table.to_string(index=False, float_format=lambda value: f"{value:.2f}", na_rep="")
@@ -4,82 +4,112 @@ Module for demographic data preprocessing.
 This module provides functionalities to preprocess demographic data.
 """
 
-import json
 import traceback
-import pandas as pd
 import logging
 from datetime import datetime
-from dateutil.relativedelta import relativedelta
-from helper import (load_config, read_data, write_data, nationality_to_country, nationality_to_continent_and_region, construct_path, setup_logging)
+from helper import (load_config, write_data, construct_path, resolve_paths, setup_logging, age_in_years, write_cohort,
+                    load_nationality_table, lookup_categorical, parse_dates,
+                    column_statistics, write_statistics, resolve_stats_path, resolve_writer_options,
+                    resolve_partitioning, read_source, apply_dtype_optimization, clean_columns)
+from metrics import track, stage_metrics
 
 CONFIG = load_config("demographic")
 
-def preprocess() -> None:
+def preprocess(df=None, persist=True):
     """
     Preprocess the demographic data.
 
     Args:
-    - data (DataFrame or other suitable type): The input data to be preprocessed.
+    - df (DataFrame, optional): Raw demographic rows; read from the source file when omitted.
+    - persist (bool): Write the output, its column statistics and the cohort index.
 
     Returns:
-    - DataFrame (or other suitable type): The preprocessed data.
+    - DataFrame: The demographic output, one row per PERSONID; its PERSONIDs are the cohort.
     """
 
     file_name = CONFIG["name"]
     
-    source_path, source_format, source_compression = CONFIG["source"]["path"], CONFIG["source"]["format"], CONFIG["source"]["compression"]
     destination_path, destination_format, destination_compression = CONFIG["destination"]["path"], CONFIG["destination"]["format"], CONFIG["destination"]["compression"]
 
-    source_compression_method = source_compression["method"] if source_compression["enabled"] else None
     destination_compression_method = destination_compression["method"] if destination_compression["enabled"] else None
 
-    file_path = construct_path(source_path, file_name, source_format, compression=source_compression_method)
     save_path = construct_path(destination_path, file_name, destination_format, compression=destination_compression_method)
 
     # READ FILE
-    df = read_data(file_path, source_format)
-    df['DOB'] = pd.to_datetime(df['DOB'].str.strip(), format='%d/%b/%Y')
-    df['DOE'] = pd.to_datetime(df['DOE'].str.strip(), format='%d/%b/%Y')
+    with track("read") as step:
+        df = step.output(read_source(CONFIG, df))
+    with track("date parsing", df) as step:
+        df['DOB'] = parse_dates(df['DOB'], '%d/%b/%Y')
+        df['DOE'] = parse_dates(df['DOE'], '%d/%b/%Y')
+        step.output(df)
 
     # CLEAN DATA
-    total_duplicates = df.duplicated(subset=['PERSONID', 'GENDER', 'NATIONALITY']).sum()
-    if total_duplicates > 0:
-        logging.info(f"There were {df.duplicated(subset=['PERSONID', 'GENDER', 'NATIONALITY']).sum()} duplicated rows.")
-        df.drop_duplicates(subset=['PERSONID', 'GENDER', 'NATIONALITY'], inplace=True)
-        logging.info(f"Dropped {total_duplicates} duplicated rows.")
+    with track("filter", df) as step:
+        total_duplicates = df.duplicated(subset=['PERSONID', 'GENDER', 'NATIONALITY']).sum()
+        if total_duplicates > 0:
+            logging.info(f"There were {df.duplicated(subset=['PERSONID', 'GENDER', 'NATIONALITY']).sum()} duplicated rows.")
+            df.drop_duplicates(subset=['PERSONID', 'GENDER', 'NATIONALITY'], inplace=True)
+            logging.info(f"Dropped {total_duplicates} duplicated rows.")
+        step.output(df)
 
     age_date, age_date_format = CONFIG["parameters"]["age_date"]["date"], CONFIG["parameters"]["age_date"]["format"]
     age_date = datetime.strptime(age_date, age_date_format)
-    df["AGE"] = df['DOB'].apply(lambda x: relativedelta(age_date, x).years if pd.notnull(x) else None)
+    df["AGE"] = age_in_years(df['DOB'], age_date)
     df.loc[df['AGE'] < 0, 'AGE'] = None
 
     df['DEATH'] = df['DOE'].notnull().astype('int8')
 
-    df.replace({
-        "POMPE": {"YES": 1, "NO": 0, "UNKNOWN": None},
-        "GENDER": {"Male": 1, "Female": 2, "Unknown": None}
-    }, inplace=True)
-    
-    dtype_conversion = CONFIG["parameters"]["dtype_conversion"]
-    for col, dtype in dtype_conversion.items():
-        df[col] = df[col].astype(dtype)
-
-    df["COUNTRY"] = df["NATIONALITY"].map(lambda x: nationality_to_country.get(x, None))
-    df['CONTINENT'] = df['NATIONALITY'].map(lambda x: nationality_to_continent_and_region.get(x, {}).get('continent'))
-    df['REGION'] = df['NATIONALITY'].map(lambda x: nationality_to_continent_and_region.get(x, {}).get('region'))
-
-    # SAVE FILE
-    write_data(df, save_path, destination_format, index=False, compression=destination_compression_method)
+    with track("dtype conversion", df) as step:
+        df = clean_columns(df, CONFIG["parameters"]["cleaning"])
+
+        dtype_conversion = CONFIG["parameters"]["dtype_conversion"]
+        for col, dtype in dtype_conversion.items():
+            df[col] = df[col].astype(dtype)
+        step.output(df)
+
+    with track("dtype optimization", df) as step:
+        df = step.output(apply_dtype_optimization(df, CONFIG))
+
+    with track("merge", df) as step:
+        nationality_table = load_nationality_table(CONFIG["parameters"].get("nationality_table"))
+        df[["COUNTRY", "CONTINENT", "REGION"]] = lookup_categorical(df["NATIONALITY"], nationality_table)
+        step.output(df)
+
+    if persist:
+        # SAVE COHORT (range partitioning of every output is based on it)
+        json_path = f'{destination_path}unique_ids.json' if CONFIG["parameters"].get("export_unique_ids_json") else None
+        write_cohort(df['PERSONID'], f'{destination_path}cohort.npy', json_path=json_path)
+
+        # SAVE FILE
+        with track("write", df):
+            write_data(df, save_path, destination_format, index=False, compression=destination_compression_method,
+                       options=resolve_writer_options(CONFIG), partitioning=resolve_partitioning(CONFIG))
+        with track("statistics", df) as step:
+            write_statistics(step.output(column_statistics(df)), CONFIG)
     print(df.head())
+    return df
 
-    # SAVE UNIQUE PATIENT IDs
-    unique_patient_ids = df['PERSONID'].unique().tolist()
-    with open(f'{destination_path}unique_ids.json', 'w') as f:
-        json.dump(unique_patient_ids, f)
+def stage_files():
+    """
+    List the files this stage reads and writes.
+
+    Returns:
+    - dict: "inputs" and "outputs" lists of file paths, used by the stage cache.
+    """
+    file_path, save_path = resolve_paths(CONFIG)
+    destination_path = CONFIG["destination"]["path"]
+    outputs = [save_path, f'{destination_path}cohort.npy', resolve_stats_path(CONFIG)]
+    if CONFIG["parameters"].get("export_unique_ids_json"):
+        outputs.append(f'{destination_path}unique_ids.json')
+    return {
+        "inputs": [file_path, CONFIG["parameters"].get("nationality_table")],
+        "outputs": outputs,
+    }
 
 def run_cleaning():
     setup_logging(CONFIG["name"])
-    preprocess()
+    with stage_metrics(CONFIG["name"]):
+        preprocess()
 
 if __name__ == "__main__":
     try:
@@ -8,76 +8,176 @@ import json
 import traceback
 import pandas as pd
 import logging
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
-from helper import (load_config, read_data, write_data, nationality_to_country, nationality_to_continent_and_region, construct_path, setup_logging)
+from helper import (load_config, write_data, construct_path, resolve_paths, setup_logging, load_cohort,
+                    build_indicator_matrix, write_sparse, resolve_state_path, read_delta, apply_delta,
+                    column_statistics, indicator_statistics, write_statistics, resolve_stats_path, resolve_writer_options,
+                    resolve_partitioning, read_source, indicator_frame, apply_dtype_optimization, crosstab_counts,
+                    clean_columns)
+from metrics import track, stage_metrics
 
 CONFIG = load_config("diagnosis")
 
-def preprocess() -> None:
+def clean(df):
+    """Apply the configured dtype conversions to raw diagnosis rows, then shrink the remaining dtypes."""
+    dtype_conversion = CONFIG["parameters"]["dtype_conversion"]
+    with track("dtype conversion", df) as step:
+        df = step.output(df.astype(dtype_conversion))
+    with track("dtype optimization", df) as step:
+        return step.output(apply_dtype_optimization(df, CONFIG))
+
+def reduce_events(df):
+    """Keep one row per (PERSONID, ENCNTRID, ICDCODE)."""
+    with track("group", df) as step:
+        return step.output(df.groupby(['PERSONID', 'ENCNTRID', 'ICDCODE'], observed=True).last().reset_index())
+
+def transform(df):
+    """Count the encounters per PERSONID x ICDCODE and attach POMPE."""
+    with track("pivot", df) as step:
+        df['VALUE'] = 1
+        pivot_df = crosstab_counts(df['PERSONID'], df['ICDCODE'])
+        pivot_df.reset_index(inplace=True)
+        step.output(pivot_df)
+
+    with track("merge", pivot_df) as step:
+        df = clean_columns(df.drop_duplicates(subset='PERSONID')[['PERSONID', 'POMPE']], CONFIG["parameters"]["cleaning"])
+
+        df = step.output(pd.merge(pivot_df, df, on='PERSONID', how='left'))
+    with track("dtype optimization", df) as step:
+        return step.output(apply_dtype_optimization(df, CONFIG, categories=False))
+
+def preprocess(df=None, cohort=None, persist=True):
     """
     Preprocess the diagnosis data.
 
     Args:
-    - data (DataFrame or other suitable type): The input data to be preprocessed.
+    - df (DataFrame, optional): Raw diagnosis rows; read from the source file when omitted.
+    - cohort (array-like, optional): Cohort PERSONIDs; loaded from `cohort.npy` when omitted.
+    - persist (bool): Write the output, its column statistics and the incremental state.
 
     Returns:
-    - DataFrame (or other suitable type): The preprocessed data.
+    - DataFrame: The diagnosis output, one row per PERSONID.
     """
 
     file_name = CONFIG["name"]
     
-    source_path, source_format, source_compression = CONFIG["source"]["path"], CONFIG["source"]["format"], CONFIG["source"]["compression"]
     destination_path, destination_format, destination_compression = CONFIG["destination"]["path"], CONFIG["destination"]["format"], CONFIG["destination"]["compression"]
 
-    source_compression_method = source_compression["method"] if source_compression["enabled"] else None
     destination_compression_method = destination_compression["method"] if destination_compression["enabled"] else None
 
-    file_path = construct_path(source_path, file_name, source_format, compression=source_compression_method)
     save_path = construct_path(destination_path, file_name, destination_format, compression=destination_compression_method)
 
-    # READ UNIQUE IDs
-    with open(f'{destination_path}unique_ids.json', 'r') as f:
-        unique_ids_list = json.load(f)
+    # READ COHORT
+    if cohort is None:
+        cohort = load_cohort(f'{destination_path}cohort.npy')
 
     # READ FILE
-    df = read_data(file_path, source_format)
-    df = df[df['PERSONID'].isin(unique_ids_list)]
-    df = df[["PERSONID", "ENCNTRID", "ICDCODE", "ICDDESCRIPTION", "POMPE"]]
+    with track("read") as step:
+        df = step.output(read_source(CONFIG, df, ids=cohort))
 
     # CLEAN DATA
-    dtype_conversion = CONFIG["parameters"]["dtype_conversion"]
-    df = df.astype(dtype_conversion)
+    df = reduce_events(clean(df))
+    if persist and CONFIG["parameters"].get("incremental", {}).get("enabled"):
+        with track("write state", df):
+            write_data(df, resolve_state_path(CONFIG), destination_format, index=False, compression=destination_compression_method,
+                       options=resolve_writer_options(CONFIG))
 
-    df = df.groupby(['PERSONID', 'ENCNTRID', 'ICDCODE']).last().reset_index()
-
-    description_map = df.groupby('ICDCODE')['ICDDESCRIPTION'].first()
+    description_map = df.groupby('ICDCODE', observed=True)['ICDDESCRIPTION'].first()
     df['ICDDESCRIPTION'] = df['ICDCODE'].map(description_map)
     code_to_description_dict = description_map.to_dict()
 
-    with open(f'{destination_path}icdcodes.json', 'w') as file:
-        json.dump(code_to_description_dict, file)
+    if persist:
+        with open(f'{destination_path}icdcodes.json', 'w') as file:
+            json.dump(code_to_description_dict, file)
 
     # TRANSFORM DATA
-    df['VALUE'] = 1
-    pivot_df = pd.crosstab(df['PERSONID'], df['ICDCODE'])
-    pivot_df.reset_index(inplace=True)
-    df = df.drop_duplicates(subset='PERSONID')[['PERSONID', 'POMPE']]
-
-    df.replace({
-        "POMPE": {"YES": 1, "NO": 0, "UNKNOWN": None}
-    }, inplace=True)
-
-    df = pd.merge(pivot_df, df, on='PERSONID', how='left')
+    sparse_output = CONFIG["parameters"].get("sparse_output", {})
+    if sparse_output.get("enabled"):
+        pompe_mapping = df.drop_duplicates(subset='PERSONID')[['PERSONID', 'POMPE']]
+        pompe_mapping = clean_columns(pompe_mapping, CONFIG["parameters"]["cleaning"])
+        with track("pivot", df) as step:
+            matrix = build_indicator_matrix(df['PERSONID'], df['ICDCODE'], binary=sparse_output.get("binary", True))
+            step.record["rows_out"], step.record["columns_out"] = map(int, matrix["shape"])
+        if persist:
+            with track("write"):
+                write_sparse(matrix, construct_path(destination_path, file_name, "npz"), labels=pompe_mapping.set_index('PERSONID'))
+            with track("statistics") as step:
+                write_statistics(step.output(indicator_statistics(matrix, pompe_mapping.set_index('PERSONID')['POMPE'])), CONFIG)
+        print(matrix["shape"])
+        return indicator_frame(matrix, pompe_mapping.set_index('PERSONID'))
+
+    df = transform(df)
 
     # SAVE FILE
-    write_data(df, save_path, destination_format, index=False, compression=destination_compression_method)
+    if persist:
+        with track("write", df):
+            write_data(df, save_path, destination_format, index=False, compression=destination_compression_method,
+                       options=resolve_writer_options(CONFIG), partitioning=resolve_partitioning(CONFIG))
+        with track("statistics", df) as step:
+            write_statistics(step.output(column_statistics(df)), CONFIG)
     print(df.head())
     print(df.shape)
+    return df
+
+def preprocess_delta(delta_path=None) -> None:
+    """
+    Update the diagnosis output with a delta extract of new events.
+
+    Only the PERSONIDs present in the delta are recomputed; see helper.apply_delta.
+
+    Args:
+    - delta_path (str, optional): Path of the delta file. Defaults to `parameters.incremental.delta_path`.
+    """
+    if CONFIG["parameters"].get("sparse_output", {}).get("enabled"):
+        raise ValueError("Incremental updates are not supported with sparse_output enabled.")
+
+    destination_path = CONFIG["destination"]["path"]
+
+    # READ FILE
+    with track("read") as step:
+        df = step.output(read_delta(CONFIG, delta_path))
+
+    # EXTEND ICD CODE DESCRIPTIONS
+    with open(f'{destination_path}icdcodes.json', 'r') as file:
+        code_to_description_dict = json.load(file)
+    new_codes = clean(df).groupby('ICDCODE', observed=True)['ICDDESCRIPTION'].first()
+    for code, description in new_codes.items():
+        code_to_description_dict.setdefault(code, description)
+    with open(f'{destination_path}icdcodes.json', 'w') as file:
+        json.dump(code_to_description_dict, file)
+
+    # UPDATE OUTPUT
+    with track("update", df) as step:
+        df = step.output(apply_delta(CONFIG, df, clean, reduce_events, transform, fill_value=0))
+    print(df.shape)
+
+def stage_files():
+    """
+    List the files this stage reads and writes.
+
+    Returns:
+    - dict: "inputs" and "outputs" lists of file paths, used by the stage cache.
+    """
+    file_path, save_path = resolve_paths(CONFIG)
+    destination_path = CONFIG["destination"]["path"]
+    if CONFIG["parameters"].get("sparse_output", {}).get("enabled"):
+        save_path = construct_path(destination_path, CONFIG["name"], "npz")
+    outputs = [save_path, f'{destination_path}icdcodes.json', resolve_stats_path(CONFIG)]
+    if CONFIG["parameters"].get("incremental", {}).get("enabled"):
+        outputs.append(resolve_state_path(CONFIG))
+    return {
+        "inputs": [file_path, f'{destination_path}cohort.npy'],
+        "outputs": outputs,
+    }
 
 def run_cleaning():
     setup_logging(CONFIG["name"])
-    preprocess()
+    with stage_metrics(CONFIG["name"]):
+        preprocess()
+
+def run_incremental(delta_path=None):
+    setup_logging(CONFIG["name"])
+    with stage_metrics(CONFIG["name"]):
+        preprocess_delta(delta_path)
 
 if __name__ == "__main__":
     try:
@@ -4,75 +4,167 @@ Module for drugs data preprocessing.
 This module provides functionalities to preprocess drugs data.
 """
 
-import json
 import traceback
-import pandas as pd
 import logging
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
-from helper import (load_config, read_data, write_data, nationality_to_country, nationality_to_continent_and_region, construct_path, setup_logging)
+from helper import (load_config, write_data, construct_path, setup_logging, load_cohort,
+                    build_indicator_matrix, write_sparse, resolve_state_path, resolve_quarantine_path,
+                    resolve_execution, update_from_delta, event_stage_files,
+                    column_statistics, indicator_statistics, write_statistics, resolve_writer_options,
+                    resolve_partitioning, indicator_frame, apply_dtype_optimization, crosstab_counts,
+                    run_sharded)
+from metrics import track, stage_metrics
+from engines import pandas_engine
 
 CONFIG = load_config("drugs")
 
-def preprocess() -> None:
+def clean(df, report_path=None, engine=pandas_engine):
+    """
+    Parse ORDERDATE, strip ORDERMNEMONIC and encode POMPE on raw drug orders.
+
+    Args:
+    - df (DataFrame): Raw drug orders (a LazyFrame with the polars engine).
+    - report_path (str, optional): Quarantine report to write instead of the stage's own.
+    - engine (module): Engine running the steps (see engines).
+
+    Returns:
+    - DataFrame: The cleaned orders.
+    """
+    with track("date parsing", df) as step:
+        df = step.output(engine.quarantine_dates(df, "ORDERDATE", CONFIG['parameters']['date_format'],
+                                                 report_path=report_path or resolve_quarantine_path(CONFIG)))
+
+    with track("cleaning", df) as step:
+        df = step.output(engine.clean_columns(df, CONFIG["parameters"]["cleaning"]))
+    with track("dtype optimization", df) as step:
+        return step.output(engine.optimize_dtypes(df, CONFIG))
+
+def reduce_events(df, engine=pandas_engine):
+    """Keep one row per (PERSONID, ENCNTRID, ORDERMNEMONIC), by default the first order of the encounter."""
+    with track("group", df) as step:
+        return step.output(engine.latest_per_key(df, ['PERSONID', 'ENCNTRID', 'ORDERMNEMONIC'], 'ORDERDATE',
+                                                 **CONFIG["parameters"].get("latest_observation", {})))
+
+def transform(df):
+    """Count the encounters per PERSONID x ORDERMNEMONIC and attach POMPE."""
+    with track("pivot", df) as step:
+        df['VALUE'] = 1
+        pivot_drugs_df = crosstab_counts(df['PERSONID'], df['ORDERMNEMONIC'])
+        pivot_drugs_df.reset_index(inplace=True)
+        step.output(pivot_drugs_df)
+
+    with track("merge", pivot_drugs_df) as step:
+        pompe_mapping = df.drop_duplicates(subset='PERSONID')[['PERSONID', 'POMPE']]
+        df = pivot_drugs_df.merge(pompe_mapping, on='PERSONID', how='left')
+        step.output(df)
+    with track("dtype optimization", df) as step:
+        return step.output(apply_dtype_optimization(df, CONFIG, categories=False))
+
+def reduce_shard(df, report_path=None):
+    """Clean and reduce the drug orders of one PERSONID shard (see helper.run_sharded)."""
+    return reduce_events(clean(df, report_path=report_path))
+
+def preprocess(df=None, cohort=None, persist=True):
     """
     Preprocess the drugs data.
 
     Args:
-    - data (DataFrame or other suitable type): The input data to be preprocessed.
+    - df (DataFrame, optional): Raw drug orders; read from the source file when omitted.
+    - cohort (array-like, optional): Cohort PERSONIDs; loaded from `cohort.npy` when omitted.
+    - persist (bool): Write the output, its column statistics and the incremental state.
 
     Returns:
-    - DataFrame (or other suitable type): The preprocessed data.
+    - DataFrame: The drugs output, one row per PERSONID.
     """
 
     file_name = CONFIG["name"]
     
-    source_path, source_format, source_compression = CONFIG["source"]["path"], CONFIG["source"]["format"], CONFIG["source"]["compression"]
     destination_path, destination_format, destination_compression = CONFIG["destination"]["path"], CONFIG["destination"]["format"], CONFIG["destination"]["compression"]
 
-    source_compression_method = source_compression["method"] if source_compression["enabled"] else None
     destination_compression_method = destination_compression["method"] if destination_compression["enabled"] else None
 
-    file_path = construct_path(source_path, file_name, source_format, compression=source_compression_method)
     save_path = construct_path(destination_path, file_name, destination_format, compression=destination_compression_method)
 
-    # READ UNIQUE IDs
-    with open(f'{destination_path}unique_ids.json', 'r') as f:
-        unique_ids_list = json.load(f)
+    # READ COHORT
+    if cohort is None:
+        cohort = load_cohort(f'{destination_path}cohort.npy')
+
+    engine, sharding, _, _ = resolve_execution(CONFIG, persist)
 
     # READ FILE
-    df = read_data(file_path, source_format)
-    df = df[df["PERSONID"].isin(unique_ids_list)]
-    df.ORDERDATE = df.ORDERDATE.str.strip()
-    df.ORDERDATE = pd.to_datetime(df.ORDERDATE, format=CONFIG['parameters']['date_format'])
+    with track("read") as step:
+        df = step.output(engine.scan(CONFIG, df, ids=cohort))
 
     # CLEAN DATA
-    df.ORDERMNEMONIC = df.ORDERMNEMONIC.str.strip()
-    df.replace({
-        "POMPE": {
-            "YES": 1,
-            "NO": 0
-        }
-    }, inplace=True)
-
-    df.sort_values('ORDERDATE', ascending=False, inplace=True)
-    drugs_grp_by = df.groupby(['PERSONID', 'ENCNTRID', 'ORDERMNEMONIC']).last().reset_index()
-
-    drugs_grp_by['VALUE'] = 1
-    pivot_drugs_df = pd.crosstab(drugs_grp_by['PERSONID'], drugs_grp_by['ORDERMNEMONIC'])
-    pivot_drugs_df.reset_index(inplace=True)
-
-    pompe_mapping = df.drop_duplicates(subset='PERSONID')[['PERSONID', 'POMPE']]
-    df = pivot_drugs_df.merge(pompe_mapping, on='PERSONID', how='left')
+    if sharding:
+        with track("sharded", df) as step:
+            df = step.output(run_sharded(df, reduce_shard, sharding, report_path=resolve_quarantine_path(CONFIG)))
+    else:
+        df = reduce_events(clean(df, engine=engine), engine=engine)
+        with track("collect") as step:
+            df = step.output(engine.collect(df))
+    if persist and CONFIG["parameters"].get("incremental", {}).get("enabled"):
+        with track("write state", df):
+            write_data(df, resolve_state_path(CONFIG), destination_format, index=False, compression=destination_compression_method,
+                       options=resolve_writer_options(CONFIG))
+
+    # TRANSFORM DATA
+    sparse_output = CONFIG["parameters"].get("sparse_output", {})
+    if sparse_output.get("enabled"):
+        pompe_mapping = df.drop_duplicates(subset='PERSONID')[['PERSONID', 'POMPE']]
+        with track("pivot", df) as step:
+            matrix = build_indicator_matrix(df['PERSONID'], df['ORDERMNEMONIC'], binary=sparse_output.get("binary", True))
+            step.record["rows_out"], step.record["columns_out"] = map(int, matrix["shape"])
+        if persist:
+            with track("write"):
+                write_sparse(matrix, construct_path(destination_path, file_name, "npz"), labels=pompe_mapping.set_index('PERSONID'))
+            with track("statistics") as step:
+                write_statistics(step.output(indicator_statistics(matrix, pompe_mapping.set_index('PERSONID')['POMPE'])), CONFIG)
+        print(matrix["shape"])
+        return indicator_frame(matrix, pompe_mapping.set_index('PERSONID'))
+
+    df = transform(df)
     
     # SAVE FILE
-    write_data(df, save_path, destination_format, index=False, compression=destination_compression_method)
+    if persist:
+        with track("write", df):
+            write_data(df, save_path, destination_format, index=False, compression=destination_compression_method,
+                       options=resolve_writer_options(CONFIG), partitioning=resolve_partitioning(CONFIG))
+        with track("statistics", df) as step:
+            write_statistics(step.output(column_statistics(df)), CONFIG)
     print(df.head())
     print(df.shape)
+    return df
+
+def preprocess_delta(delta_path=None) -> None:
+    """
+    Update the drugs output with a delta extract of new events.
+
+    Only the PERSONIDs present in the delta are recomputed; see helper.apply_delta.
+
+    Args:
+    - delta_path (str, optional): Path of the delta file. Defaults to `parameters.incremental.delta_path`.
+    """
+    df = update_from_delta(CONFIG, clean, reduce_events, transform, delta_path=delta_path, fill_value=0)
+    print(df.shape)
+
+def stage_files():
+    """
+    List the files this stage reads and writes (see helper.event_stage_files).
+
+    Returns:
+    - dict: "inputs" and "outputs" lists of file paths, used by the stage cache.
+    """
+    return event_stage_files(CONFIG)
 
 def run_cleaning():
     setup_logging(CONFIG["name"])
-    preprocess()
+    with stage_metrics(CONFIG["name"]):
+        preprocess()
+
+def run_incremental(delta_path=None):
+    setup_logging(CONFIG["name"])
+    with stage_metrics(CONFIG["name"]):
+        preprocess_delta(delta_path)
 
 if __name__ == "__main__":
     try:
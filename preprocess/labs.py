@@ -4,74 +4,179 @@ Module for labs data preprocessing.
 This module provides functionalities to preprocess labs data.
 """
 
-import json
 import traceback
-import pandas as pd
 import logging
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
-from helper import (load_config, read_data, write_data, nationality_to_country, nationality_to_continent_and_region, construct_path, setup_logging)
+from helper import (load_config, write_data, construct_path, setup_logging, load_cohort,
+                    resolve_state_path, resolve_quarantine_path, resolve_execution, update_from_delta, event_stage_files,
+                    column_statistics, write_statistics, resolve_writer_options,
+                    resolve_partitioning, apply_dtype_optimization, remove_unused_categories,
+                    iter_source, write_batched_pivot, run_sharded,
+                    resolve_numeric_results, write_text_results, parse_numeric)
+from metrics import track, stage_metrics
+from engines import pandas_engine
 
 CONFIG = load_config("labs")
 
-def preprocess() -> None:
+def clean(df, append_report=False, report_path=None, engine=pandas_engine, text_results=False):
+    """
+    Convert dtypes, parse ORDERDATE and encode POMPE on raw labs events.
+
+    Args:
+    - df (DataFrame): Raw labs events (a LazyFrame with the polars engine).
+    - append_report (bool): Add to the quarantine report instead of replacing it.
+    - report_path (str, optional): Quarantine report to write instead of the stage's own.
+    - engine (module): Engine running the steps (see engines).
+    - text_results (bool): Write the events with a non-numeric result to the side table.
+
+    Returns:
+    - DataFrame: The cleaned events.
+    """
+    with track("dtype conversion", df) as step:
+        dtype_conversion = CONFIG["parameters"]["dtype_conversion"]
+        df = step.output(engine.cast(df, dtype_conversion))
+
+    with track("date parsing", df) as step:
+        df = step.output(engine.quarantine_dates(df, "ORDERDATE", CONFIG['parameters']['date_format'],
+                                                 report_path=report_path or resolve_quarantine_path(CONFIG),
+                                                 append=append_report))
+
+    with track("cleaning", df) as step:
+        df = step.output(engine.clean_columns(df, CONFIG["parameters"]["cleaning"]))
+    if text_results:
+        with track("text results", df):
+            write_text_results(engine.collect(engine.keep_text(df, "RESULTVALUE")), CONFIG)
+    with track("dtype optimization", df) as step:
+        return step.output(engine.optimize_dtypes(df, CONFIG))
+
+def reduce_events(df, engine=pandas_engine):
+    """Keep the most recent result per (PERSONID, ORDERCATALOG)."""
+    with track("group", df) as step:
+        return step.output(engine.latest_per_key(df, ['PERSONID', 'ORDERCATALOG'], 'ORDERDATE',
+                                                 **CONFIG["parameters"].get("latest_observation", {})))
+
+def transform(df):
+    """
+    Pivot the latest results to one row per PERSONID and attach POMPE.
+
+    With `parameters.numeric_results` enabled, RESULTVALUE is parsed into numbers before
+    the pivot; results that are not numbers become missing.
+    """
+    numeric_results = resolve_numeric_results(CONFIG)
+    if numeric_results:
+        with track("parse results", df) as step:
+            df['RESULTVALUE'] = step.output(parse_numeric(df['RESULTVALUE'], numeric_results["dtype"]))
+    with track("pivot", df) as step:
+        df = remove_unused_categories(df)
+        pivot_labs_df = df.pivot(index='PERSONID', columns='ORDERCATALOG', values='RESULTVALUE')
+        pivot_labs_df.reset_index(inplace=True)
+        step.output(pivot_labs_df)
+    with track("merge", pivot_labs_df) as step:
+        df = pivot_labs_df.merge(df[['PERSONID', 'POMPE']].drop_duplicates(), on='PERSONID')
+        step.output(df)
+    with track("dtype optimization", df) as step:
+        return step.output(apply_dtype_optimization(df, CONFIG, categories=False))
+
+def reduce_shard(df, report_path=None):
+    """Clean and reduce the raw events of one PERSONID shard (see helper.run_sharded)."""
+    return reduce_events(clean(df, report_path=report_path))
+
+def preprocess(df=None, cohort=None, persist=True):
     """
     Preprocess the labs data.
 
     Args:
-    - data (DataFrame or other suitable type): The input data to be preprocessed.
+    - df (DataFrame, optional): Raw lab results; read from the source file when omitted.
+    - cohort (array-like, optional): Cohort PERSONIDs; loaded from `cohort.npy` when omitted.
+    - persist (bool): Write the output, its column statistics and the incremental state.
 
     Returns:
-    - DataFrame (or other suitable type): The preprocessed data.
+    - DataFrame: The labs output, one row per PERSONID, or None when it was pivoted in
+      batches straight to the destination (see `parameters.batched_pivot`).
     """
 
     file_name = CONFIG["name"]
     
-    source_path, source_format, source_compression = CONFIG["source"]["path"], CONFIG["source"]["format"], CONFIG["source"]["compression"]
     destination_path, destination_format, destination_compression = CONFIG["destination"]["path"], CONFIG["destination"]["format"], CONFIG["destination"]["compression"]
 
-    source_compression_method = source_compression["method"] if source_compression["enabled"] else None
     destination_compression_method = destination_compression["method"] if destination_compression["enabled"] else None
 
-    file_path = construct_path(source_path, file_name, source_format, compression=source_compression_method)
     save_path = construct_path(destination_path, file_name, destination_format, compression=destination_compression_method)
 
-    # READ UNIQUE IDs
-    with open(f'{destination_path}unique_ids.json', 'r') as f:
-        unique_ids_list = json.load(f)
+    # READ COHORT
+    if cohort is None:
+        cohort = load_cohort(f'{destination_path}cohort.npy')
+
+    engine, sharding, batched, text_results = resolve_execution(CONFIG, persist)
+
+    # PIVOT IN BATCHES
+    if batched:
+        with track("batched pivot") as step:
+            stats = step.output(write_batched_pivot(CONFIG, iter_source(CONFIG, df, ids=cohort), clean, reduce_events,
+                                                    transform, "ORDERCATALOG", cohort))
+        write_statistics(stats, CONFIG)
+        return None
 
     # READ FILE
-    df = read_data(file_path, source_format)
-    df = df[df["PERSONID"].isin(unique_ids_list)]
+    with track("read") as step:
+        df = step.output(engine.scan(CONFIG, df, ids=cohort))
 
     # CLEAN DATA
-    dtype_conversion = CONFIG["parameters"]["dtype_conversion"]
-    df = df.astype(dtype_conversion)
-
-    df.ORDERDATE = df.ORDERDATE.str.strip()
-    df.ORDERDATE = pd.to_datetime(df.ORDERDATE, format=CONFIG['parameters']['date_format'])
-    df.sort_values('ORDERDATE', ascending=False, inplace=True)
-
-    df.replace({
-        "POMPE": {
-            "YES": 1,
-            "NO": 0
-        }
-    }, inplace=True)
-
-    df.drop_duplicates(subset=['PERSONID', 'ORDERCATALOG'], keep='first', inplace=True)
-    pivot_labs_df = df.pivot(index='PERSONID', columns='ORDERCATALOG', values='RESULTVALUE')
-    pivot_labs_df.reset_index(inplace=True)
-    df = pivot_labs_df.merge(df[['PERSONID', 'POMPE']].drop_duplicates(), on='PERSONID')
+    if sharding:
+        with track("sharded", df) as step:
+            df = step.output(run_sharded(df, reduce_shard, sharding, report_path=resolve_quarantine_path(CONFIG)))
+    else:
+        df = reduce_events(clean(df, engine=engine, text_results=text_results), engine=engine)
+        with track("collect") as step:
+            df = step.output(engine.collect(df))
+    if persist and CONFIG["parameters"].get("incremental", {}).get("enabled"):
+        with track("write state", df):
+            write_data(df, resolve_state_path(CONFIG), destination_format, index=False, compression=destination_compression_method,
+                       options=resolve_writer_options(CONFIG))
+
+    # TRANSFORM DATA
+    df = transform(df)
     
     # SAVE FILE
-    write_data(df, save_path, destination_format, index=False, compression=destination_compression_method)
+    if persist:
+        with track("write", df):
+            write_data(df, save_path, destination_format, index=False, compression=destination_compression_method,
+                       options=resolve_writer_options(CONFIG), partitioning=resolve_partitioning(CONFIG))
+        with track("statistics", df) as step:
+            write_statistics(step.output(column_statistics(df)), CONFIG)
     print(df.head())
     print(df.shape)
+    return df
+
+def preprocess_delta(delta_path=None) -> None:
+    """
+    Update the labs output with a delta extract of new events.
+
+    Only the PERSONIDs present in the delta are recomputed; see helper.apply_delta.
+
+    Args:
+    - delta_path (str, optional): Path of the delta file. Defaults to `parameters.incremental.delta_path`.
+    """
+    df = update_from_delta(CONFIG, clean, reduce_events, transform, delta_path=delta_path)
+    print(df.shape)
+
+def stage_files():
+    """
+    List the files this stage reads and writes (see helper.event_stage_files).
+
+    Returns:
+    - dict: "inputs" and "outputs" lists of file paths, used by the stage cache.
+    """
+    return event_stage_files(CONFIG)
 
 def run_cleaning():
     setup_logging(CONFIG["name"])
-    preprocess()
+    with stage_metrics(CONFIG["name"]):
+        preprocess()
+
+def run_incremental(delta_path=None):
+    setup_logging(CONFIG["name"])
+    with stage_metrics(CONFIG["name"]):
+        preprocess_delta(delta_path)
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,290 @@
+"""
+Module for building the final dataset.
+
+This module joins the outputs of the preprocessing stages into one row per PERSONID,
+reconciles the features that more than one stage produces (e.g. ACTH in clinical and
+labs) and applies the per-patient label corrections.
+"""
+
+import traceback
+import numpy as np
+import pandas as pd
+import logging
+from helper import (load_config, read_data, write_data, construct_path, resolve_paths, setup_logging, read_sparse,
+                    apply_label_corrections, column_statistics, read_statistics, select_columns, resolve_stats_path,
+                    resolve_writer_options, resolve_partitioning)
+from metrics import track, stage_metrics
+
+CONFIG = load_config("dataset")
+
+def stage_output_path(config):
+    """Return the path of a stage's output: the sparse .npz when sparse_output is enabled, else the destination file."""
+    if config["parameters"].get("sparse_output", {}).get("enabled"):
+        return construct_path(config["destination"]["path"], config["name"], "npz")
+    return resolve_paths(config)[1]
+
+def selected_columns(name, config):
+    """
+    Columns of a stage output to carry into the dataset.
+
+    Either the list in `parameters.columns[name]`, or the features chosen by the rules in
+    `parameters.feature_selection[name]` from the statistics the stage wrote next to its
+    output (see helper.select_columns), plus PERSONID and the label. Returns None when
+    neither is configured, or when the rules apply but the statistics are missing.
+
+    Args:
+    - name (str): Stage name, e.g. "labs".
+    - config (dict): The stage's config block.
+
+    Returns:
+    - list: Columns to read, or None for all of them.
+    """
+    parameters = CONFIG["parameters"]
+    columns = parameters.get("columns", {}).get(name)
+    rules = parameters.get("feature_selection", {}).get(name)
+    if columns is not None or not rules:
+        return columns
+
+    stats = read_statistics(config)
+    if stats is None:
+        return None
+    return ["PERSONID", *select_columns(stats, rules), parameters.get("label_column", "POMPE")]
+
+def read_stage_output(name):
+    """
+    Read the output of a preprocessing stage and prepare it with stage_frame.
+
+    Only the selected columns are read (see selected_columns); parquet outputs never decode
+    the others.
+
+    Args:
+    - name (str): Stage name, e.g. "labs".
+
+    Returns:
+    - DataFrame: The stage output, indexed by PERSONID.
+    """
+    config = load_config(name)
+    columns = selected_columns(name, config)
+    file_path = stage_output_path(config)
+    if file_path.endswith(".npz"):
+        df = read_sparse(file_path)
+    else:
+        destination = config["destination"]
+        compression = destination["compression"]["method"] if destination["compression"]["enabled"] else None
+        df = read_data(file_path, destination["format"], columns=columns, compression=compression)
+
+    if columns is None and CONFIG["parameters"].get("feature_selection", {}).get(name):
+        logging.warning(f"No column statistics for {name}; computing them from the data.")
+    return stage_frame(name, df, columns)
+
+def stage_frame(name, df, columns=None):
+    """
+    Keep the selected columns of a stage output and index it by PERSONID.
+
+    When `columns` is not given, the configured `parameters.columns[name]` are kept, or the
+    feature selection rules are applied to statistics computed from `df` in one pass.
+    Sparse columns (from `sparse_output`) are made dense, as the dataset is written to
+    formats that cannot store them.
+
+    Args:
+    - name (str): Stage name, e.g. "labs".
+    - df (DataFrame): The stage output.
+    - columns (list, optional): Columns already chosen, e.g. by selected_columns.
+
+    Returns:
+    - DataFrame: The selected columns, indexed by PERSONID and sorted.
+    """
+    parameters = CONFIG["parameters"]
+    if columns is None:
+        columns = parameters.get("columns", {}).get(name)
+    rules = parameters.get("feature_selection", {}).get(name)
+    if columns is None and rules:
+        label_column = parameters.get("label_column", "POMPE")
+        columns = ["PERSONID", *select_columns(column_statistics(df, label_column=label_column), rules), label_column]
+    if columns is not None:
+        df = df[columns]
+    sparse_columns = {column: dtype.subtype for column, dtype in df.dtypes.items() if isinstance(dtype, pd.SparseDtype)}
+    if sparse_columns:
+        df = df.astype(sparse_columns)
+    logging.info(f"Using {df.shape[1]} columns of {name}.")
+    return df.set_index("PERSONID").sort_index()
+
+def coalesce_and_flag(values, tolerance=1e-9):
+    """
+    Reconcile several aligned versions of the same feature.
+
+    The result takes the first non-missing value in order. A row is flagged when two of
+    its non-missing values disagree: numerically (beyond `tolerance`) when both parse as
+    numbers, otherwise as strings.
+
+    Args:
+    - values (list): Series of the same feature from different stages, aligned on PERSONID.
+    - tolerance (float): Absolute tolerance for numeric comparisons.
+
+    Returns:
+    - tuple: (coalesced Series, boolean flag Series).
+    """
+    coalesced = values[0]
+    for other in values[1:]:
+        coalesced = coalesced.where(coalesced.notna(), other)
+
+    # Every non-missing value must agree with the coalesced one (the first non-missing value)
+    coalesced_numeric = pd.to_numeric(coalesced, errors="coerce").to_numpy(dtype="float64")
+    coalesced_text = coalesced.astype(str).to_numpy()
+    flags = np.zeros(len(coalesced), dtype=bool)
+    for series in values[1:]:
+        numeric = pd.to_numeric(series, errors="coerce").to_numpy(dtype="float64")
+        both_numeric = ~np.isnan(numeric) & ~np.isnan(coalesced_numeric)
+        differs = np.where(both_numeric,
+                           np.abs(numeric - coalesced_numeric) > tolerance,
+                           series.astype(str).to_numpy() != coalesced_text)
+        flags |= differs & series.notna().to_numpy()
+
+    # Keep one type per column so it can be written to parquet: numbers if every value is one, else strings.
+    # Float features (e.g. the float32 results of labs and clinical) keep their width
+    if np.array_equal(np.isnan(coalesced_numeric), coalesced.isna().to_numpy()):
+        dtype = "float64"
+        if all(isinstance(series.dtype, np.dtype) and series.dtype.kind == "f" for series in values):
+            dtype = np.result_type(*(series.dtype for series in values))
+        coalesced = pd.Series(coalesced_numeric.astype(dtype), index=coalesced.index, name=coalesced.name)
+    else:
+        coalesced = coalesced.astype(str).where(coalesced.notna())
+
+    return coalesced, pd.Series(flags, index=coalesced.index)
+
+def merge_frames(frames, label_column="POMPE", flag_suffix="_FLAG", tolerance=1e-9):
+    """
+    Outer join stage outputs on PERSONID in one pass.
+
+    The union of all PERSONIDs is sorted once and every frame is aligned to it. Features
+    found in more than one frame are reconciled with coalesce_and_flag, which adds a
+    `<feature><flag_suffix>` column. The label is coalesced across frames in the same
+    way, placed last and cast back to the integer type the stages give it.
+
+    Args:
+    - frames (dict): Stage name -> DataFrame indexed by PERSONID, in order of precedence.
+    - label_column (str): Label column present in the stage outputs.
+    - flag_suffix (str): Suffix of the conflict flag columns.
+    - tolerance (float): See coalesce_and_flag.
+
+    Returns:
+    - DataFrame: One row per PERSONID, with PERSONID as the first column.
+    """
+    label_dtypes = [frame[label_column].dtype for frame in frames.values() if label_column in frame.columns]
+    index = pd.Index(np.unique(np.concatenate([frame.index.to_numpy() for frame in frames.values()])), name="PERSONID")
+    frames = {name: frame if frame.index.equals(index) else frame.reindex(index) for name, frame in frames.items()}
+
+    owners = {}
+    for name, frame in frames.items():
+        for column in frame.columns:
+            owners.setdefault(column, []).append(name)
+    overlapping = [column for column, names in owners.items() if len(names) > 1 and column != label_column]
+
+    reconciled, flags = {}, {}
+    for column in overlapping:
+        reconciled[column], flag = coalesce_and_flag([frames[name][column] for name in owners[column]], tolerance)
+        flags[f"{column}{flag_suffix}"] = flag.astype("int8")
+        if flag.any():
+            logging.warning(f"{flag.sum()} conflicting values for {column} across {', '.join(owners[column])}.")
+
+    label = None
+    if label_column in owners:
+        label, _ = coalesce_and_flag([frames[name][label_column] for name in owners[label_column]], tolerance)
+        # Aligning and coalescing make the label float; give it back the narrowest integer type
+        # the stages use that holds it, nullable when some PERSONIDs have no label
+        values = label.dropna()
+        integer_dtypes = sorted((dtype for dtype in label_dtypes if isinstance(dtype, np.dtype) and dtype.kind in "iu"
+                                 and (values.empty or np.iinfo(dtype).min <= values.min() <= values.max() <= np.iinfo(dtype).max)),
+                                key=lambda dtype: dtype.itemsize)
+        if integer_dtypes:
+            dtype = integer_dtypes[0]
+            if label.isna().any():
+                dtype = f"{'UInt' if dtype.kind == 'u' else 'Int'}{dtype.itemsize * 8}"
+            label = label.astype(dtype)
+
+    # Features of each frame in order, then the reconciled features, the flags and the label
+    parts = [frame.drop(columns=[column for column in frame.columns if column in reconciled or column == label_column])
+             for frame in frames.values()]
+    parts.append(pd.DataFrame(reconciled, index=index))
+    parts.append(pd.DataFrame(flags, index=index))
+    if label is not None:
+        parts.append(label.rename(label_column).to_frame())
+    return pd.concat(parts, axis=1).reset_index()
+
+def preprocess(frames=None, persist=True):
+    """
+    Build the final dataset from the stage outputs.
+
+    Args:
+    - frames (dict, optional): Stage name -> stage output, for every stage in `inputs`.
+      The outputs are read from their destinations when omitted, and so are the ones
+      given as None (e.g. pivoted in batches straight to disk).
+    - persist (bool): Write the dataset to the destination.
+
+    Returns:
+    - DataFrame: The dataset, one row per PERSONID.
+    """
+
+    file_name = CONFIG["name"]
+    parameters = CONFIG["parameters"]
+
+    destination_path, destination_format, destination_compression = CONFIG["destination"]["path"], CONFIG["destination"]["format"], CONFIG["destination"]["compression"]
+    destination_compression_method = destination_compression["method"] if destination_compression["enabled"] else None
+    save_path = construct_path(destination_path, file_name, destination_format, compression=destination_compression_method)
+
+    # READ FILES
+    if frames is None:
+        frames = {}
+        for name in CONFIG["inputs"]:
+            with track(f"read {name}") as step:
+                frames[name] = step.output(read_stage_output(name))
+    else:
+        with track("select"):
+            frames = {name: read_stage_output(name) if frames.get(name) is None else stage_frame(name, frames[name])
+                      for name in CONFIG["inputs"]}
+
+    # MERGE DATA
+    with track("merge") as step:
+        df = step.output(merge_frames(frames, label_column=parameters.get("label_column", "POMPE"),
+                                      flag_suffix=parameters.get("flag_suffix", "_FLAG"),
+                                      tolerance=parameters.get("tolerance", 1e-9)))
+
+    # CORRECT LABELS
+    if parameters.get("label_corrections"):
+        df = apply_label_corrections(df, parameters["label_corrections"])
+
+    # SAVE FILE
+    if persist:
+        with track("write", df):
+            write_data(df, save_path, destination_format, index=False, compression=destination_compression_method,
+                       options=resolve_writer_options(CONFIG), partitioning=resolve_partitioning(CONFIG))
+    print(df.head())
+    print(df.shape)
+    return df
+
+def stage_files():
+    """
+    List the files this stage reads and writes.
+
+    Returns:
+    - dict: "inputs" and "outputs" lists of file paths, used by the stage cache.
+    """
+    destination = CONFIG["destination"]
+    compression = destination["compression"]["method"] if destination["compression"]["enabled"] else None
+    inputs = [stage_output_path(load_config(name)) for name in CONFIG["inputs"]]
+    inputs += [resolve_stats_path(load_config(name)) for name in CONFIG["parameters"].get("feature_selection", {})]
+    return {
+        "inputs": inputs + [CONFIG["parameters"].get("label_corrections")],
+        "outputs": [construct_path(destination["path"], CONFIG["name"], destination["format"], compression=compression)],
+    }
+
+def run_cleaning():
+    setup_logging(CONFIG["name"])
+    with stage_metrics(CONFIG["name"]):
+        preprocess()
+
+if __name__ == "__main__":
+    try:
+        run_cleaning()
+    except Exception as e:
+        logging.error(f"An error occurred: {e}\n{traceback.format_exc()}")
@@ -0,0 +1,37 @@
+import os
+import sys
+
+# The modules load config.json from the working directory when they are imported
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def clinical_events():
+    """Raw clinical events with an unparseable date, a missing result and a text result."""
+    return pd.DataFrame({
+        "PERSONID": [1, 1, 1, 2, 2, 3, 3],
+        "EVENTNAME": ["Weight.", "Weight", "Height", "Weight", "Height", "Weight", "Height"],
+        "EVENTRESULT": [" 70 ", "72", "180", "nan", "165", "see note", "170"],
+        "EVENTDATETIME": ["01/Jan/2020 10:00:00", "02/Jan/2020 10:00:00", "01/Jan/2020 10:00:00",
+                          "03/Feb/2021 08:30:00", "04/Feb/2021 08:30:00", "05/Mar/4557 00:00:00",
+                          "05/Mar/2022 00:00:00"],
+        "POMPE": ["YES", "YES", "YES", "NO", "NO", "NO", "NO"],
+    })
+
+
+@pytest.fixture
+def lab_events():
+    """Raw lab events with an unparseable date and repeated orders."""
+    return pd.DataFrame({
+        "PERSONID": [1, 1, 1, 2, 2, 3],
+        "ORDERCATALOG": ["CK", "CK", "ALT", "CK", "ALT", "CK"],
+        "RESULTVALUE": ["150", "180", "30", "90", "<5", "200"],
+        "ORDERDATE": ["01/Jan/2020 10:00:00", "02/Jan/2020 10:00:00", "01/Jan/2020 10:00:00",
+                      "03/Feb/2021 08:30:00", "04/Feb/2021 08:30:00", "bad date"],
+        "POMPE": ["YES", "YES", "YES", "NO", "NO", "NO"],
+    })
@@ -0,0 +1,46 @@
+import types
+
+import cache
+import helper
+import main
+from preprocess import labs
+
+
+def test_stage_key_depends_on_partitioning(monkeypatch):
+    manifest = {"stages": {}, "files": {}}
+    pipeline = helper.load_pipeline_config()
+    monkeypatch.setattr(helper, "load_pipeline_config", lambda: pipeline)
+
+    pipeline["partitioning"] = {"enabled": False}
+    key = cache.stage_key("labs", labs, manifest)
+    assert cache.stage_key("labs", labs, manifest) == key
+
+    pipeline["partitioning"] = {"enabled": True, "method": "hash", "partitions": 4}
+    assert cache.stage_key("labs", labs, manifest) != key
+
+
+def test_incremental_run_invalidates_the_stage_cache(tmp_path, monkeypatch):
+    # The stage's code and inputs do not change between the runs
+    monkeypatch.setattr(main, "stage_key", lambda name, module, manifest: "key")
+
+    output = tmp_path / "events.txt"
+    stage = types.SimpleNamespace(
+        CONFIG={"parameters": {"incremental": {"enabled": True}}},
+        stage_files=lambda: {"inputs": [], "outputs": [str(output)]},
+        run_cleaning=lambda: output.write_text("full"),
+        run_incremental=lambda: output.write_text(output.read_text() + "+delta"),
+    )
+    stages = {"events": (stage, [])}
+    cache_path = str(tmp_path / "cache")
+
+    def run(incremental=False):
+        settings = {"path": cache_path, "manifest": cache.load_manifest(cache_path), "keys": {}, "force": set()}
+        return main.run_stages(stages, max_workers=1, cache=settings, incremental=incremental)["events"]
+
+    assert run() == "done"
+    assert run() == "cached"
+    assert run(incremental=True) == "done"
+    assert output.read_text() == "full+delta"
+    # The entry stored before the delta must not be restored over the updated output
+    assert run() == "done"
+    assert output.read_text() == "full"
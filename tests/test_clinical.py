@@ -0,0 +1,13 @@
+import pandas as pd
+import pytest
+
+from preprocess import clinical
+
+
+@pytest.mark.filterwarnings("error::pandas.errors.SettingWithCopyWarning")
+def test_clean_does_not_write_into_views(clinical_events, tmp_path):
+    df = clinical.clean(clinical_events, report_path=str(tmp_path / "quarantine.csv"))
+
+    assert df["EVENTNAME"].astype(str).tolist() == ["Weight", "Weight", "Height", "Height", "Height"]
+    assert df["EVENTRESULT"].tolist() == [70.0, 72.0, 180.0, 165.0, 170.0]
+    assert pd.read_csv(tmp_path / "quarantine.csv")["ROWS"].sum() == 1
@@ -0,0 +1,25 @@
+import pandas as pd
+import pytest
+
+from engines import pandas_engine
+from preprocess import clinical, labs
+
+pytest.importorskip("polars")
+from engines import polars_engine  # noqa: E402
+
+
+def run(stage, df, engine, report_path):
+    events = engine.scan(stage.CONFIG, df)
+    return engine.collect(stage.reduce_events(stage.clean(events, report_path=report_path, engine=engine), engine=engine))
+
+
+@pytest.mark.parametrize("stage, fixture", [(labs, "lab_events"), (clinical, "clinical_events")])
+def test_engines_give_the_same_events(stage, fixture, request, tmp_path):
+    raw = request.getfixturevalue(fixture)
+    expected = run(stage, raw.copy(), pandas_engine, str(tmp_path / "pandas.csv"))
+    result = run(stage, raw.copy(), polars_engine, str(tmp_path / "polars.csv"))
+
+    # The polars engine leaves the downcasting to the pivoted output, so the events only match in value
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_categorical=False)
+    pd.testing.assert_frame_equal(stage.transform(result), stage.transform(expected))
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / "polars.csv"), pd.read_csv(tmp_path / "pandas.csv"))
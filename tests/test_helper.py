@@ -0,0 +1,213 @@
+import copy
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+from dateutil.relativedelta import relativedelta
+
+from helper import (_smallest_integer_dtype, age_in_years, as_cohort, build_indicator_matrix, in_cohort, latest_per_key,
+                    optimize_dtypes, parse_dates, quarantine_dates, read_report, read_sparse, resolve_execution,
+                    write_sparse)
+from preprocess import demographic, drugs, labs
+
+
+@pytest.mark.parametrize("reference", [datetime(2023, 4, 24), datetime(2023, 2, 28), datetime(2024, 2, 28),
+                                       datetime(2024, 2, 29), datetime(2023, 3, 1)])
+def test_age_in_years_matches_relativedelta(reference):
+    dates = pd.to_datetime(pd.Series([
+        "2000-02-29", "2004-02-29", "1999-02-28", "1999-03-01",  # Feb 29 birthdays and their neighbours
+        "1990-04-23", "1990-04-24", "1990-04-25",  # the day before, of and after the birthday
+        "2025-01-01", "2023-04-25", "2028-02-29",  # after the reference date
+        None,
+    ]))
+
+    expected = [float(relativedelta(reference, date).years) if pd.notna(date) else np.nan for date in dates]
+    pd.testing.assert_series_equal(age_in_years(dates, reference), pd.Series(expected), check_names=False)
+
+
+def test_demographic_nulls_future_dates_of_birth():
+    df = pd.DataFrame({"PERSONID": [1, 2, 3], "GENDER": ["Male", "Female", "Unknown"],
+                       "NATIONALITY": ["EMIRATI", "FILIPINO", "EMIRATI"],
+                       "DOB": ["29/Feb/2000", "01/Jan/2099", None], "DOE": [None, None, "01/Jan/2020"],
+                       "POMPE": ["YES", "NO", "NO"]})
+
+    age = demographic.preprocess(df, persist=False)["AGE"]
+    assert age.tolist()[0] == 23
+    assert age.isna().tolist() == [False, True, True]
+
+
+def reference_latest(df, keys, order_by, keep, ties):
+    """One row per key with a stable sort and groupby().last(), missing `order_by` ranking lowest."""
+    ordered = df.iloc[::-1] if ties == "first" else df
+    ordered = ordered.sort_values(order_by, ascending=keep == "latest", na_position="first", kind="stable")
+    return ordered.groupby(keys, sort=True).last().reset_index()
+
+
+def test_latest_per_key_keeps_the_ranked_row():
+    df = pd.DataFrame({"PERSONID": [1, 1, 1, 2, 2, 3],
+                       "EVENTNAME": ["A", "A", "A", "A", "A", "A"],
+                       "EVENTDATETIME": pd.to_datetime(["2020-01-02", "2020-01-01", "2020-01-02",
+                                                        None, "2020-01-01", None]),
+                       "EVENTRESULT": [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]})
+    results = {(keep, ties): latest_per_key(df, ["PERSONID", "EVENTNAME"], "EVENTDATETIME", keep=keep, ties=ties)["EVENTRESULT"].tolist()
+               for keep in ("latest", "earliest") for ties in ("first", "last")}
+
+    # Missing dates rank below every date, whichever end is kept
+    assert results["latest", "first"] == [1.0, 5.0, 6.0]
+    assert results["latest", "last"] == [3.0, 5.0, 6.0]
+    assert results["earliest", "first"] == [2.0, 5.0, 6.0]
+    assert results["earliest", "last"] == [2.0, 5.0, 6.0]
+
+
+@pytest.mark.parametrize("keep", ["latest", "earliest"])
+@pytest.mark.parametrize("ties", ["first", "last"])
+def test_latest_per_key_matches_sorted_groupby(keep, ties):
+    rng = np.random.default_rng(0)
+    n = 2000
+    dates = pd.Series(pd.to_datetime("2020-01-01") + pd.to_timedelta(rng.integers(0, 20, n), unit="D"))
+    dates[rng.random(n) < 0.1] = pd.NaT
+    dates[:3] = pd.NaT
+    df = pd.DataFrame({"PERSONID": rng.integers(0, 50, n), "EVENTNAME": rng.choice(["A", "B", "C"], n),
+                       "EVENTDATETIME": dates, "EVENTRESULT": np.arange(n, dtype="float64")})
+    df.loc[:2, ["PERSONID", "EVENTNAME"]] = [99, "A"]  # a key with only missing dates
+
+    expected = reference_latest(df, ["PERSONID", "EVENTNAME"], "EVENTDATETIME", keep, ties)
+    pd.testing.assert_frame_equal(latest_per_key(df, ["PERSONID", "EVENTNAME"], "EVENTDATETIME", keep=keep, ties=ties),
+                                  expected)
+
+
+def test_latest_per_key_rejects_unknown_options():
+    df = pd.DataFrame({"PERSONID": [1], "EVENTDATETIME": pd.to_datetime(["2020-01-01"])})
+    with pytest.raises(ValueError):
+        latest_per_key(df, ["PERSONID"], "EVENTDATETIME", keep="newest")
+    with pytest.raises(ValueError):
+        latest_per_key(df, ["PERSONID"], "EVENTDATETIME", ties="any")
+
+
+DATE_FORMAT = "%d/%b/%Y %H:%M:%S"
+RAW_DATES = [" 01/Jan/2020 10:00:00", "01/Jan/2020 10:00:00", None, "05/Mar/4557 00:00:00",
+             "02/Feb/2021 08:30:00 ", "not a date", "05/Mar/4557 00:00:00"]
+
+
+@pytest.mark.parametrize("dtype", [object, "string[pyarrow]"])
+def test_parse_dates_matches_to_datetime(dtype):
+    values = pd.Series(RAW_DATES, dtype=dtype, index=np.arange(10, 17), name="EVENTDATETIME")
+
+    expected = pd.to_datetime(values.astype(object).str.strip(), format=DATE_FORMAT, errors="coerce")
+    pd.testing.assert_series_equal(parse_dates(values, DATE_FORMAT, errors="coerce"), expected)
+    # The placeholder year lies outside the datetime64[ns] range
+    assert parse_dates(values, DATE_FORMAT, errors="coerce").isna().tolist() == [False, False, True, True, False, True, True]
+
+
+@pytest.mark.parametrize("token", ["not a date", "05/Mar/4557 00:00:00"])
+def test_parse_dates_raises_on_unparseable_values(token):
+    with pytest.raises(ValueError):
+        parse_dates(pd.Series(["01/Jan/2020 10:00:00", token]), DATE_FORMAT)
+
+
+def test_quarantine_dates_reports_dropped_values(tmp_path):
+    report_path = str(tmp_path / "quarantine.csv")
+    df = pd.DataFrame({"EVENTDATETIME": RAW_DATES, "EVENTRESULT": range(7)})
+
+    kept = quarantine_dates(df, "EVENTDATETIME", DATE_FORMAT, report_path=report_path)
+
+    # Missing dates are kept, unparseable ones are dropped
+    assert kept["EVENTRESULT"].tolist() == [0, 1, 2, 4]
+    assert kept["EVENTDATETIME"].isna().tolist() == [False, False, True, False]
+    report = read_report(report_path)
+    assert report.sort_values("VALUE").to_dict("records") == [
+        {"COLUMN": "EVENTDATETIME", "VALUE": "05/Mar/4557 00:00:00", "ROWS": 2},
+        {"COLUMN": "EVENTDATETIME", "VALUE": "not a date", "ROWS": 1},
+    ]
+
+    # Appending adds the counts of another chunk; replacing starts over
+    chunk = pd.DataFrame({"EVENTDATETIME": ["not a date", "later"], "EVENTRESULT": [7, 8]})
+    quarantine_dates(chunk.copy(), "EVENTDATETIME", DATE_FORMAT, report_path=report_path, append=True)
+    assert read_report(report_path).set_index("VALUE")["ROWS"].to_dict() == {
+        "05/Mar/4557 00:00:00": 2, "not a date": 2, "later": 1}
+    quarantine_dates(chunk.copy(), "EVENTDATETIME", DATE_FORMAT, report_path=report_path)
+    assert read_report(report_path).set_index("VALUE")["ROWS"].to_dict() == {"not a date": 1, "later": 1}
+
+
+def test_quarantine_dates_writes_an_empty_report(tmp_path):
+    report_path = str(tmp_path / "quarantine.csv")
+    df = pd.DataFrame({"EVENTDATETIME": ["01/Jan/2020 10:00:00"]})
+
+    assert len(quarantine_dates(df, "EVENTDATETIME", DATE_FORMAT, report_path=report_path)) == 1
+    assert read_report(report_path).empty
+
+
+@pytest.mark.parametrize("binary", [True, False])
+def test_sparse_round_trip_matches_dense_pivot(binary, tmp_path):
+    rows = pd.Series([30, 10, 30, 20, 10, 30, 30], name="PERSONID")
+    codes = pd.Series(["I10", "E11", "E11", "Z00", "E11", "I10", "A01"], name="ICDCODE")
+    labels = pd.DataFrame({"POMPE": [0, 1, 1]}, index=pd.Index([20, 30, 10], name="PERSONID"))
+
+    file_path = str(tmp_path / "diagnosis.npz")
+    write_sparse(build_indicator_matrix(rows, codes, binary=binary), file_path, labels=labels)
+    df = read_sparse(file_path)
+
+    dense = pd.crosstab(rows, codes)
+    if binary:
+        dense = dense.clip(upper=1)
+    assert df.columns.tolist() == ["PERSONID", *dense.columns, "POMPE"]
+    assert df["PERSONID"].tolist() == dense.index.tolist()
+    np.testing.assert_array_equal(df[dense.columns].sparse.to_dense().to_numpy(), dense.to_numpy())
+    assert df["POMPE"].tolist() == labels["POMPE"].reindex(dense.index).tolist()
+
+    csr, ids, columns, _ = read_sparse(file_path, as_frame=False)
+    np.testing.assert_array_equal(csr.toarray(), dense.to_numpy())
+    assert ids.tolist() == dense.index.tolist() and columns.tolist() == dense.columns.tolist()
+
+
+@pytest.mark.parametrize("cohort", [[], [5], [3, 1, 7, 7, 100]])
+def test_in_cohort_matches_isin(cohort):
+    values = pd.Series([0, 1, 2, 3, 7, 8, 99, 100, 101, 1])
+    np.testing.assert_array_equal(in_cohort(values, as_cohort(cohort)), values.isin(cohort).to_numpy())
+
+
+@pytest.mark.parametrize("low, high, dtype", [
+    (-128, 127, np.int8), (-129, 0, np.int16), (0, 128, np.int16),
+    (-32768, 32767, np.int16), (-32769, 0, np.int32), (0, 32768, np.int32),
+    (-2**31, 2**31 - 1, np.int32), (-2**31 - 1, 0, np.int64), (0, 2**31, np.int64),
+])
+def test_smallest_integer_dtype_boundaries(low, high, dtype):
+    assert _smallest_integer_dtype(np.array([low, high], dtype=np.int64)) == dtype
+
+
+def test_optimize_dtypes_keeps_values():
+    df = pd.DataFrame({
+        "INT8": np.array([-128, 0, 127]), "INT16": np.array([-129, 0, 128]), "INT32": np.array([0, 1, 2**31 - 1]),
+        "INT64": np.array([0, 1, 2**31]), "UINT64": np.array([0, 1, 2**63], dtype=np.uint64),
+        "EXACT": [0.5, np.nan, 1.25], "INEXACT": [0.1, 1.0, 2.0],
+        "CODE": ["A", "A", np.nan], "TEXT": ["a", "b", "c"],
+    })
+
+    optimized, report = optimize_dtypes(df, max_unique_fraction=0.7)
+
+    assert optimized.dtypes.astype(str).to_dict() == {
+        "INT8": "int8", "INT16": "int16", "INT32": "int32", "INT64": "int64", "UINT64": "uint64",
+        "EXACT": "float32", "INEXACT": "float64", "CODE": "category", "TEXT": "object"}
+    assert set(report["COLUMN"]) == {"INT8", "INT16", "INT32", "EXACT", "CODE"}
+    pd.testing.assert_frame_equal(optimized.astype(df.dtypes.to_dict()), df)
+
+
+@pytest.mark.parametrize("parameters, message", [
+    ({"engine": "polars", "sharding": {"enabled": True}}, "Sharding is only supported"),
+    ({"engine": "polars", "batched_pivot": {"enabled": True}}, "batched_pivot is only supported"),
+    ({"numeric_results": {"enabled": True, "side_table": True}, "sharding": {"enabled": True}}, "side table"),
+    ({"batched_pivot": {"enabled": True}, "incremental": {"enabled": True}}, "Incremental updates"),
+])
+def test_resolve_execution_rejects_unsupported_combinations(parameters, message):
+    config = copy.deepcopy(labs.CONFIG)
+    config["parameters"].update(parameters)
+    with pytest.raises(ValueError, match=message):
+        resolve_execution(config)
+
+
+def test_resolve_execution_only_batches_persisted_output():
+    config = copy.deepcopy(labs.CONFIG)
+    config["parameters"].update({"batched_pivot": {"enabled": True}, "numeric_results": {"enabled": True, "side_table": True}})
+    assert resolve_execution(config, persist=False)[2:] == (False, False)
+    assert resolve_execution(drugs.CONFIG)[1:] == (None, False, False)
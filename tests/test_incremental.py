@@ -0,0 +1,51 @@
+import copy
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from helper import apply_delta, read_data, resolve_paths
+from preprocess import clinical, drugs
+
+
+@pytest.fixture
+def drug_orders():
+    return pd.DataFrame({
+        "PERSONID": [1, 1, 2, 2, 3, 1, 3, 3],
+        "ENCNTRID": [10, 11, 20, 20, 30, 12, 31, 31],
+        "ORDERMNEMONIC": ["aspirin", "aspirin", "insulin ", "insulin", "aspirin", "statin", "statin", "insulin"],
+        "ORDERDATE": ["01/Jan/2020 10:00:00", "02/Jan/2020 10:00:00", "01/Feb/2020 10:00:00",
+                      "01/Feb/2020 11:00:00", "01/Mar/2020 10:00:00", "01/Jan/2021 10:00:00",
+                      "01/Feb/2021 10:00:00", "01/Feb/2021 10:00:00"],
+        "POMPE": ["YES", "YES", "NO", "NO", "NO", "YES", "NO", "NO"],
+    })
+
+
+def use_config(monkeypatch, stage, tmp_path):
+    config = copy.deepcopy(stage.CONFIG)
+    config["destination"]["path"] = f"{tmp_path}/"
+    config["parameters"]["incremental"]["enabled"] = True
+    monkeypatch.setattr(stage, "CONFIG", config)
+    return config
+
+
+@pytest.mark.parametrize("stage, fixture, history_rows, fill_value, new_column", [
+    # The delta adds the "statin" code and new encounters of known patients
+    (drugs, "drug_orders", 5, 0, "statin"),
+    # The delta adds a new patient
+    (clinical, "clinical_events", 5, None, None),
+])
+def test_apply_delta_matches_full_rebuild(stage, fixture, history_rows, fill_value, new_column, request, tmp_path,
+                                          monkeypatch):
+    events = request.getfixturevalue(fixture)
+    config = use_config(monkeypatch, stage, tmp_path)
+    cohort = np.unique(events["PERSONID"])
+
+    stage.preprocess(events.iloc[:history_rows].copy(), cohort=cohort)
+    apply_delta(config, events.iloc[history_rows:].reset_index(drop=True),
+                stage.clean, stage.reduce_events, stage.transform, fill_value=fill_value)
+
+    expected = stage.preprocess(events.copy(), cohort=cohort, persist=False)
+    assert new_column is None or new_column in expected.columns
+    _, save_path = resolve_paths(config)
+    pd.testing.assert_frame_equal(read_data(save_path, config["destination"]["format"]), expected)
@@ -0,0 +1,55 @@
+import copy
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from helper import read_data, read_report, resolve_paths, resolve_quarantine_path
+from preprocess import labs
+
+
+@pytest.fixture
+def many_lab_events():
+    rng = np.random.default_rng(0)
+    n = 600
+    dates = pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 5000, n), unit="h")
+    ids = rng.integers(1, 60, n)
+    return pd.DataFrame({
+        "PERSONID": ids,
+        "ORDERCATALOG": rng.choice(["CK", "ALT", "AST", "LDH", "TSH"], n),
+        "RESULTVALUE": np.where(rng.random(n) < 0.05, "<5", rng.integers(1, 500, n).astype(str)),
+        "ORDERDATE": np.where(rng.random(n) < 0.02, "05/Mar/4557 00:00:00", dates.strftime("%d/%b/%Y %H:%M:%S")),
+        "POMPE": np.where(ids % 7 == 0, "YES", "NO"),
+    })
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    config = copy.deepcopy(labs.CONFIG)
+    config["destination"]["path"] = f"{tmp_path}/"
+    monkeypatch.setattr(labs, "CONFIG", config)
+    return config
+
+
+def test_batched_pivot_matches_single_pivot(many_lab_events, config):
+    cohort = np.unique(many_lab_events["PERSONID"])
+    expected = labs.preprocess(many_lab_events.copy(), cohort=cohort, persist=False)
+
+    # A tiny budget and chunk size give several spilled chunks and batches
+    config["source"]["chunksize"] = 100
+    config["parameters"]["batched_pivot"] = {"enabled": True, "memory_budget_mb": 0.001}
+    assert labs.preprocess(many_lab_events.copy(), cohort=cohort) is None
+
+    _, save_path = resolve_paths(config)
+    df = read_data(save_path, config["destination"]["format"]).sort_values("PERSONID", ignore_index=True)
+    pd.testing.assert_frame_equal(df, expected)
+
+
+def test_sharded_run_matches_single_run(many_lab_events, config):
+    cohort = np.unique(many_lab_events["PERSONID"])
+    expected = labs.preprocess(many_lab_events.copy(), cohort=cohort, persist=False)
+    expected_report = read_report(resolve_quarantine_path(config))
+
+    config["parameters"]["sharding"] = {"enabled": True, "shards": 3, "max_workers": 2}
+    pd.testing.assert_frame_equal(labs.preprocess(many_lab_events.copy(), cohort=cohort, persist=False), expected)
+    pd.testing.assert_frame_equal(read_report(resolve_quarantine_path(config)), expected_report)
@@ -0,0 +1,46 @@
+import copy
+
+import numpy as np
+import pandas as pd
+
+from helper import build_indicator_matrix, column_statistics, load_config, read_data, write_data, write_sparse
+from preprocess import merge
+
+
+def test_merge_reads_sparse_stage_output(tmp_path, monkeypatch):
+    config = copy.deepcopy(load_config("diagnosis"))
+    config["destination"]["path"] = f"{tmp_path}/"
+    config["parameters"]["sparse_output"]["enabled"] = True
+    monkeypatch.setattr(merge, "load_config", lambda name: config)
+
+    matrix = build_indicator_matrix(pd.Series([1, 1, 2]), pd.Series(["E11", "I10", "E11"]))
+    labels = pd.DataFrame({"POMPE": [1, 0]}, index=pd.Index([1, 2], name="PERSONID"))
+    write_sparse(matrix, merge.stage_output_path(config), labels=labels)
+
+    demographic = pd.DataFrame({"PERSONID": [1, 2, 3], "AGE": [30.0, 40.0, 50.0],
+                                "POMPE": np.array([1, 0, 0], dtype="int8")})
+    frames = {"demographic": merge.stage_frame("demographic", demographic, ["PERSONID", "AGE", "POMPE"]),
+              "diagnosis": merge.read_stage_output("diagnosis")}
+    df = merge.merge_frames(frames)
+
+    assert not any(isinstance(dtype, pd.SparseDtype) for dtype in df.dtypes)
+    save_path = str(tmp_path / "dataset.parquet")
+    write_data(df, save_path, "parquet", index=False)
+    written = read_data(save_path, "parquet")
+    assert written["PERSONID"].tolist() == [1, 2, 3]
+    assert written["E11"].tolist()[:2] == [1, 1]
+    assert written["I10"].tolist()[:2] == [1, 0]
+
+
+def test_merge_keeps_integer_label():
+    labs = pd.DataFrame({"CK": [1.5, 2.5]}, index=pd.Index([1, 2], name="PERSONID"))
+    labs["POMPE"] = np.array([1, 0], dtype="int64")
+    drugs = pd.DataFrame({"DRUG": [1, 0]}, index=pd.Index([2, 3], name="PERSONID"))
+    drugs["POMPE"] = np.array([0, 1], dtype="int8")
+    assert merge.merge_frames({"labs": labs, "drugs": drugs})["POMPE"].dtype == np.int8
+
+    drugs["POMPE"] = np.nan
+    df = merge.merge_frames({"labs": labs, "drugs": drugs})
+    assert df["POMPE"].dtype == "Int64"
+    assert df["POMPE"].isna().tolist() == [False, False, True]
+    assert column_statistics(df).loc["CK", "NON_NULL_1"] == 1